@@ -0,0 +1 @@
+"""Performance measurements of the bot parts. Run from the project root, f.e. `python -m benchmarks.indexes_benchmark`"""
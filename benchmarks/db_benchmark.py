@@ -0,0 +1,143 @@
+"""Micro-benchmarks of db_operations on synthetic collections of production sizes.
+
+Every size is measured on a fresh db, generated with a fixed seed, so the runs are comparable.
+Results are printed, or written to a file, as JSON.
+
+Usage: `python -m benchmarks.db_benchmark --sizes 10000 100000 1000000 --users 100000 --output results.json`
+"""
+
+import argparse, datetime, json, os, platform, random, sqlite3, statistics, tempfile, time
+from types import SimpleNamespace
+from typing import Callable
+
+import emoji
+
+from db_operations import (aggregates, connection, daily_db, migrations, snapshot, stats_buffer,
+                           sticker_index, stickers_db, users_db)
+from db_operations.tablenames import stickers_tablename, users_statistics_tablename
+
+
+# Stickers in a synthetic set
+SET_SIZE = 40
+
+
+def generate_db(db_filename: os.PathLike, stickers: int, users: int, rng: random.Random) -> list[str]:
+    """Creates the db with the stickers in sets of SET_SIZE and the users with random counters.
+
+    Returns:
+        list[str]: emoji codes, which stickers are generated with.
+    """
+    migrations.migrate(db_filename=db_filename)
+    emoji_chars = sorted({char for char, data in emoji.EMOJI_DATA.items() if data['status'] == emoji.STATUS['fully_qualified']})
+    # Codes are normalized the same way as of the saved stickers, variants collapse
+    emoji_codes = sorted(set(map(stickers_db.normalize_emoji, emoji_chars)))
+    # Popular emoji are used much more often than the others, like in real sets
+    weights = [1 / (rank + 1) for rank in range(len(emoji_codes))]
+
+    db_connection = connection.get_connection(db_filename)
+    rows = ((f'file{i}', code, f'set{i // SET_SIZE}')
+            for i, code in enumerate(rng.choices(emoji_codes, weights=weights, k=stickers)))
+    with db_connection:
+        db_connection.executemany(f'INSERT OR IGNORE INTO {stickers_tablename} VALUES (?, ?, ?);', rows)
+
+    today = datetime.date.today().isoformat()
+    users_rows = ((user_id, today, today, rng.randint(0, 50), rng.randint(0, 500), rng.randint(0, 50))
+                  for user_id in range(1, users + 1))
+    with db_connection:
+        db_connection.executemany(f'''INSERT INTO {users_statistics_tablename}
+                                  (user_id, first_usage, last_usage, commands_use, stickers_send_to, other_messages)
+                                  VALUES (?, ?, ?, ?, ?, ?);''', users_rows)
+    daily_db.add_daily_record(db_filename=db_filename)
+    return emoji_codes
+
+
+def measure(func: Callable[[int], object], runs: int) -> dict[str, float]:
+    """Calls func(run number) `runs` times.
+
+    Returns:
+        dict[str, float]: timings in milliseconds.
+    """
+    timings = []
+    for run in range(runs):
+        started = time.perf_counter()
+        func(run)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {'runs': runs, 'mean_ms': statistics.fmean(timings), 'p50_ms': timings[len(timings) // 2],
+            'p95_ms': timings[int(len(timings) * 0.95)], 'max_ms': timings[-1]}
+
+
+def benchmark_size(stickers: int, users: int, runs: int, seed: int) -> dict[str, dict[str, float]]:
+    """Measures all the operations on a db with the given number of stickers."""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_filename = os.path.join(tmp_dir, 'benchmark.db')
+        emoji_codes = generate_db(db_filename, stickers=stickers, users=users, rng=rng)
+        sets_num = (stickers + SET_SIZE - 1) // SET_SIZE
+
+        def incoming_sticker(run: int) -> SimpleNamespace:
+            # Existing set, but different file id, so that lookups go past the primary key
+            return SimpleNamespace(file_id=f'incoming{run}', emoji=emoji.emojize(rng.choice(emoji_codes)),
+                                   set_name=f'set{rng.randrange(sets_num)}')
+
+        def new_set(run: int) -> list[SimpleNamespace]:
+            return [SimpleNamespace(file_id=f'new{run}_{i}', emoji=emoji.emojize(code), set_name=f'new_set{run}')
+                    for i, code in enumerate(rng.sample(emoji_codes, SET_SIZE))]
+
+        user_id = lambda run: rng.randint(1, users)
+        results = {
+            'add_set': measure(lambda run: stickers_db.add_set(*new_set(run), db_filename=db_filename), runs),
+            'check_sticker': measure(lambda run: stickers_db.check_sticker(incoming_sticker(run), db_filename=db_filename), runs),
+            'select_reply_sql': measure(lambda run: stickers_db.select_reply(incoming_sticker(run), db_filename=db_filename), runs),
+            'select_reply_fallback': measure(lambda run: stickers_db.select_reply(incoming_sticker(run), anything=True,
+                                                                                  db_filename=db_filename), runs),
+            'sticker_index_load': measure(lambda run: sticker_index.load(db_filename=db_filename), 1),
+            'snapshot_save': measure(lambda run: snapshot.save(os.path.join(tmp_dir, 'benchmark.snapshot'),
+                                                               db_filename=db_filename), 1),
+            'snapshot_load': measure(lambda run: snapshot.load(os.path.join(tmp_dir, 'benchmark.snapshot'),
+                                                               db_filename=db_filename), 1),
+            'select_reply_index': measure(lambda run: stickers_db.select_reply(incoming_sticker(run), db_filename=db_filename), runs),
+            'count_sets': measure(lambda run: stickers_db.count_sets(db_filename=db_filename), min(runs, 5)),
+            'count_emoji': measure(lambda run: stickers_db.count_emoji(db_filename=db_filename), min(runs, 5)),
+            'count_users': measure(lambda run: users_db.count_users(db_filename=db_filename), min(runs, 5)),
+            'count_stickers': measure(lambda run: users_db.count_stickers(db_filename=db_filename), min(runs, 5)),
+            'aggregates_get_stats': measure(lambda run: aggregates.get_stats(db_filename=db_filename), runs),
+            'users_add_sticker_send': measure(lambda run: users_db.add_sticker_send(user_id(run), db_filename=db_filename), runs),
+            'daily_add_stickers_send': measure(lambda run: daily_db.add_stickers_send(day=daily_db.todays_date(),
+                                                                                      db_filename=db_filename), runs),
+            'stats_buffer_record': measure(lambda run: stats_buffer.add_sticker_send(user_id(run)), runs),
+            'stats_buffer_flush': measure(lambda run: (stats_buffer.add_sticker_send(user_id(run)),
+                                                       stats_buffer.flush(db_filename=db_filename)), runs),
+        }
+        connection.close_connections()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help='numbers of stickers')
+    parser.add_argument('--users', type=int, default=100_000, help='number of users')
+    parser.add_argument('--runs', type=int, default=200, help='calls of each operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write, stdout if not set')
+    args = parser.parse_args()
+
+    # Buffer is flushed only explicitly, so that record timings don't include flushes
+    stats_buffer.flush_threshold = float('inf')
+    report = {
+        'meta': {'seed': args.seed, 'users': args.users, 'runs': args.runs, 'set_size': SET_SIZE,
+                 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                 'created': datetime.datetime.now().isoformat(timespec='seconds')},
+        'results': {str(size): benchmark_size(size, users=args.users, runs=args.runs, seed=args.seed) for size in args.sizes},
+    }
+
+    report_text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report_text)
+    else:
+        print(report_text)
+
+
+if __name__ == '__main__':
+    main()
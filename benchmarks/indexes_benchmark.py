@@ -0,0 +1,92 @@
+"""Measures hot queries before and after the index migrations.
+
+Usage: `python -m benchmarks.indexes_benchmark --rows 1000000`
+"""
+
+import argparse, datetime, os, random, tempfile, time
+from types import SimpleNamespace
+
+import emoji
+
+from db_operations import connection, daily_db, migrations, stickers_db
+from db_operations.tablenames import stickers_tablename, daily_statistics_tablename
+
+
+def fill_db(db_filename: os.PathLike, rows: int, sets: int, days: int, seed: int) -> list[tuple[str, str, str]]:
+    """Fills stickers and daily stats tables with synthetic data.
+
+    Returns:
+        list[tuple[str, str, str]]: sample of saved stickers to query.
+    """
+    rng = random.Random(seed)
+    emoji_codes = sorted({data['en'] for data in emoji.EMOJI_DATA.values()})
+    db_connection = connection.get_connection(db_filename)
+
+    stickers = ((f'file{i}', rng.choice(emoji_codes), f'set{rng.randrange(sets)}') for i in range(rows))
+    with db_connection:
+        db_connection.executemany(f'INSERT INTO {stickers_tablename} VALUES (?, ?, ?);', stickers)
+
+    first_day = datetime.date(2020, 1, 1)
+    days_rows = ((str(first_day + datetime.timedelta(days=i)), ) for i in range(days))
+    with db_connection:
+        db_connection.executemany(f'INSERT INTO {daily_statistics_tablename} (day) VALUES (?);', days_rows)
+
+    sample_ids = [rng.randrange(rows) for _ in range(1000)]
+    return [db_connection.execute(f'SELECT file_id, emoji, setname FROM {stickers_tablename} WHERE rowid=?;',
+                                  (rowid + 1, )).fetchone() for rowid in sample_ids]
+
+
+def time_queries(db_filename: os.PathLike, sample: list[tuple[str, str, str]], days: int, repeat: int) -> dict[str, float]:
+    """Runs each hot query `repeat` times.
+
+    Returns:
+        dict[str, float]: query name -> mean time in milliseconds.
+    """
+    # Different file id, so that the (set, emoji) part of the query matters
+    stickers = [SimpleNamespace(file_id=f'new{i}', emoji=emoji.emojize(code), set_name=setname)
+                for i, (_, code, setname) in enumerate(sample)]
+    first_day = datetime.date(2020, 1, 1)
+    cases = {
+        'check_sticker': lambda i: stickers_db.check_sticker(stickers[i % len(stickers)], db_filename=db_filename),
+        'select_reply': lambda i: stickers_db.select_reply(stickers[i % len(stickers)], db_filename=db_filename),
+        'check_daily_record_exists': lambda i: daily_db.check_daily_record_exists(
+            day=str(first_day + datetime.timedelta(days=i % days)), db_filename=db_filename),
+    }
+
+    results = {}
+    for name, case in cases.items():
+        started = time.perf_counter()
+        for i in range(repeat):
+            case(i)
+        results[name] = (time.perf_counter() - started) / repeat * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1_000_000, help='number of stickers')
+    parser.add_argument('--sets', type=int, default=20_000, help='number of sets')
+    parser.add_argument('--days', type=int, default=3_650, help='number of daily records')
+    parser.add_argument('--repeat', type=int, default=50, help='runs of each query')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_filename = os.path.join(tmp_dir, 'benchmark.db')
+        # Only the tables, which existed before migrations
+        migrations.migrate(db_filename=db_filename, target_version=1)
+        sample = fill_db(db_filename, rows=args.rows, sets=args.sets, days=args.days, seed=args.seed)
+
+        before = time_queries(db_filename, sample, days=args.days, repeat=args.repeat)
+        migrations.migrate(db_filename=db_filename)
+        after = time_queries(db_filename, sample, days=args.days, repeat=args.repeat)
+        connection.close_connections()
+
+    print(f'{args.rows} stickers, {args.days} daily records, mean of {args.repeat} runs')
+    print(f'{"query":<28}{"before, ms":>12}{"after, ms":>12}{"speedup":>10}')
+    for name in before:
+        print(f'{name:<28}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>9.0f}x')
+
+
+if __name__ == '__main__':
+    main()
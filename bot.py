@@ -1,216 +1,351 @@
-import os, json, shutil
+import asyncio, datetime, io, os, shutil, time
+# Imports are the first phase of startup
+imports_started = time.perf_counter()
 import dotenv
+import emoji
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.utils import executor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
-from logs.log import activity_logger, improvements_logger
-from db_operations import daily_db, stickers_db, users_db
-import make_report as mr
+from logs.log import activity_logger, improvements_logger, stop_logging
+from db_operations import analytics, async_db, date_func, sets_cache, stats_buffer
+from db_operations.tablenames import db_name
+from chat_dispatch import chat_dispatcher, per_chat
+from delivery import DeliveryScheduler
+from locales import locale_resolver
+import metrics
+import webhook
+import workers
 
 
 # Read the token from .env file 
 # IMPORTANT: never share the token, otherwise the bot can be stollen. 
 dotenv.load_dotenv()
 token = os.getenv('DEMO_TOKEN')
+# Way to receive updates: 'polling' or 'webhook'
+bot_mode = os.getenv('BOT_MODE', 'polling')
+# Chat of the admin, who gets reports and can use admin commands
+admin_id = os.getenv('ADMIN_ID')
+# Send a notice before a sticker with related emoji, off by default: then a related reply is a single send
+notify_related = os.getenv('NOTIFY_RELATED_EMOJI', '0') == '1'
+# Bot API server, f.e. local one for tests
+api_server = TelegramAPIServer.from_base(os.getenv('BOT_API_SERVER')) if os.getenv('BOT_API_SERVER') else TELEGRAM_PRODUCTION
 
 # Create bot and dispatcher 
-bot = Bot(token)
+bot = metrics.InstrumentedBot(token, server=api_server)
 dp = Dispatcher(bot=bot)
+# All outbound messages go through it
+sender = DeliveryScheduler(bot)
+# Running tasks, which are not bound to updates
+background_tasks: set[asyncio.Task] = set()
 
-# Define default user locale
-user_locale_global = 'en'
+# Queues, which grow under load
+metrics.Gauge('bot_pending_updates', 'Accepted updates, which are not handled yet', lambda: chat_dispatcher.pending)
+metrics.Gauge('bot_delivery_queue_depth', 'Outbound messages, which are not sent yet', lambda: sender.metrics()['queue_depth'])
 
-# Read message templates data
-with open(os.path.abspath('data/message_templates.json')) as templates_file:
-    message_templates = json.load(templates_file)
-    
-    
-def create_daily_row():
-    if not daily_db.check_daily_record_exists():
-        daily_db.add_daily_record()
+# Seconds spent in each phase of startup of this process
+startup_phases: dict[str, float] = {'imports': time.perf_counter() - imports_started}
+metrics.Gauge('bot_startup_seconds', 'Duration of the startup, imports included', lambda: sum(startup_phases.values()))
 
 
-async def startup(_):
-    # Check tables exsit on startup
-    daily_db.create_dailystats_table()
-    stickers_db.create_stickers_table()
-    users_db.create_userstats_table()
-    create_daily_row()
-        
-    activity_logger.info('Bot startup')
+def startup_phase(name: str, started: float) -> float:
+    """Records the phase, which started at the time, and returns the start of the next one."""
+    finished = time.perf_counter()
+    startup_phases[name] = finished - started
+    return finished
 
 
-async def shutdown(_):
-    activity_logger.info('Bot shut down')
+async def startup(_):
+    started = time.perf_counter()
+    # Start db thread, which holds shared db connection
+    async_db.start()
+    sender.start()
+    await metrics.start()
+    started = startup_phase('services', started)
+    # Bring db schema up to date on startup
+    await async_db.migrations.migrate()
+    started = startup_phase('migrations', started)
+    # Caches are restored from the snapshot made on the last shutdown, unless it doesn't match the db
+    if not await async_db.snapshot.load():
+        await async_db.sets_cache.load_known_sets()
+        await async_db.sticker_index.load()
+    started = startup_phase('caches', started)
+    await async_db.stickers_db.warm_up()
+    startup_phase('warm up', started)
+    elect_scheduler()
+        
+    activity_logger.info('Bot startup: ' + ', '.join(f'{phase} {seconds:.3f} s' for phase, seconds in startup_phases.items()))
 
 
-def update_user_locale(message: types.Message) -> str:
-    """Func gets message to define user locale and current locale status. 
-    Depending on the results, returns either user locale, or 'en'.
+async def flush_stats():
+    await async_db.stats_buffer.flush()
 
-    Args:
-        message (types.Message): message from user. 
 
-    Returns:
-        str: new locale. 
-    """
-    global message_templates
-    global user_locale_global
-    
-    current_locale = user_locale_global
-    
-    possible_locales = list(message_templates.keys())
-    if message.from_user.locale != current_locale:
-        user_locale = str(message.from_user.locale)
-        if user_locale in possible_locales:
-            return user_locale
-        else:
-            improvements_logger.info(f'As {user_locale} is not a supported locale, english locale was turned on')
-            return 'en'
-    else:
-        return current_locale
+async def shutdown(_):
+    # Finish accepted updates
+    await chat_dispatcher.wait_closed(timeout=10)
+    await sender.stop()
+    # Save buffered stats, finish db queries and close db connections
+    await flush_stats()
+    # Next start doesn't read caches from stickers table
+    try:
+        await async_db.snapshot.save()
+    except Exception:
+        activity_logger.exception('Cache snapshot is not saved')
+    await async_db.stop()
+    await metrics.stop()
+    # Another worker takes daily jobs over
+    scheduler_lock.release()
+    activity_logger.info('Bot shut down')
 
 
 # Handles incoming stickers
 @dp.message_handler(content_types=['sticker'])
+@per_chat
+@metrics.instrument_handler
 async def echo_sticker(message: types.Message):
     """Accepts message with a sticker and sends some sticker in return 
 
     Args:
         message (types.Message): message from user. 
     """
-    global user_locale_global
-    
     # Gather received sticker
     received_sticker = message.sticker     
-    # Define it's set  
-    received_set = await bot.get_sticker_set(name=received_sticker.set_name)
-    # Add set to db, if necessary
-    stickers_db.add_set(*received_set.stickers)
+    # Collect it's set, unless it was collected recently
+    if received_sticker.set_name and not sets_cache.is_fresh(received_sticker.set_name):
+        received_set = await bot.get_sticker_set(name=received_sticker.set_name)
+        await async_db.stickers_db.add_set(*received_set.stickers)
+        await async_db.sets_cache.mark_checked(received_sticker.set_name)
     # Choose sticker in return 
-    chosen_answer = stickers_db.select_reply(sticker_to_reply=received_sticker)
+    chosen_answer, related_emoji = await async_db.stickers_db.select_related_reply(sticker_to_reply=received_sticker)
     
     # If return sticker was not found
-    # which means that other packages do not have a sticker with such emoji
+    # which means that other packages do not have a sticker with such or related emoji
     if chosen_answer is None:
         # then any sticker is chosen
-        chosen_answer = stickers_db.select_reply(sticker_to_reply=received_sticker, anything=True)
+        chosen_answer = await async_db.stickers_db.select_reply(sticker_to_reply=received_sticker, anything=True)
         # and send to user with a notification
-        user_locale_global = update_user_locale(message=message)
-        await bot.send_message(chat_id=message.chat.id, text=message_templates[user_locale_global]['no answer'])
-        await bot.send_sticker(chat_id=message.chat.id, sticker=chosen_answer)
+        await sender.send_message(chat_id=message.chat.id, text=locale_resolver.text(message.from_user, 'no answer'))
+        await sender.send_sticker(chat_id=message.chat.id, sticker=chosen_answer)
         improvements_logger.info(f'No answer for {received_sticker.emoji}')
     # Though, if sticker in return is found, then it is send to user
     else:
-        await bot.send_sticker(chat_id=message.chat.id, sticker=chosen_answer)
+        # Sticker with related emoji is good enough to reply without notification, unless it is turned on
+        if related_emoji is not None:
+            if notify_related:
+                await sender.send_message(chat_id=message.chat.id,
+                                          text=locale_resolver.format(message.from_user, 'related answer',
+                                                                      received_sticker.emoji, emoji.emojize(related_emoji)))
+            improvements_logger.info(f'No answer for {received_sticker.emoji}, replied with {related_emoji}')
+        await sender.send_sticker(chat_id=message.chat.id, sticker=chosen_answer)
     
     activity_logger.info('Sent sticker in return')
     
     # Update DB stats 
-    users_db.update_last_usage(user_id=message.from_user.id)
-    users_db.add_sticker_send(user_id=message.from_user.id)
-    daily_db.add_stickers_send()
+    await async_db.stats_buffer.add_sticker_send(user_id=message.from_user.id)
 
  
 # Handles commands
 @dp.message_handler(commands=['start', 'help', 'stats', 'about'])
+@per_chat
+@metrics.instrument_handler
 async def define_command(message: types.Message):
-    global user_locale_global
-    
     this_command = message.get_command()
     
     # Start command sends start text
     if this_command == '/start':
         
         # Add user, if they aren't in db already
-        if not users_db.user_exists(user_id=message.from_user.id):
-            users_db.add_user_on_start(user_id=message.from_user.id)
-        user_locale_global = update_user_locale(message=message)
-        await bot.send_message(chat_id=message.chat.id, text=message_templates[user_locale_global]['start'])
+        await async_db.users_db.add_user_on_start(user_id=message.from_user.id)
+        await sender.send_message(chat_id=message.chat.id, text=locale_resolver.text(message.from_user, 'start'))
         activity_logger.info('Command - /start')
     
     # Help command sends help text
     elif this_command == '/help':      
-        user_locale_global = update_user_locale(message=message)  
-        await bot.send_message(chat_id=message.chat.id, text=message_templates[user_locale_global]['help'])
+        await sender.send_message(chat_id=message.chat.id, text=locale_resolver.text(message.from_user, 'help'))
         activity_logger.info('Command - /help')
     
     # Staats command counts statistics and sends it
     elif this_command == '/stats':
-        sets_num = stickers_db.count_sets()
-        emoji_num = stickers_db.count_emoji()
-        users_count = users_db.count_users()
-        stickers_send_count = users_db.count_stickers()
-        
+        stats = await async_db.aggregates.get_stats()
         
-        user_locale_global = update_user_locale(message=message)
-        stats_text = message_templates[user_locale_global]['stats'].format(sets_num, 
-                                                                           emoji_num, 
-                                                                           stickers_send_count, 
-                                                                           users_count)
-        await bot.send_message(chat_id=message.chat.id, text=stats_text)
+        stats_text = locale_resolver.format(message.from_user, 'stats', 
+                                            stats['sets'], stats['emoji'], stats['stickers_send'], stats['users'])
+        await sender.send_message(chat_id=message.chat.id, text=stats_text)
         activity_logger.info('Command - /stats')
     
     elif this_command == '/about':
-        user_locale_global = update_user_locale(message=message)
-        await bot.send_message(chat_id=message.chat.id, text=message_templates[user_locale_global]['about'])
+        await sender.send_message(chat_id=message.chat.id, text=locale_resolver.text(message.from_user, 'about'))
     
     
     # Update DB stats 
-    users_db.update_last_usage(user_id=message.from_user.id)
-    users_db.add_command_use(user_id=message.from_user.id)
-    daily_db.add_commands_use()
+    await async_db.stats_buffer.add_command_use(user_id=message.from_user.id)
     activity_logger.info('Command sucessfull')
 
+
+def is_admin(message: types.Message) -> bool:
+    return admin_id is not None and str(message.from_user.id) == admin_id
+
+
+async def send_profile(chat_id: int, session, **options):
+    report = await session.run(processed=lambda: chat_dispatcher.processed, **options)
+    filename = f'Profile{datetime.datetime.now():%Y-%m-%d_%H-%M-%S}.txt'
+    await sender.send_document(chat_id=chat_id, 
+                               document=types.InputFile(path_or_bytesio=io.BytesIO(report.encode()), filename=filename), 
+                               caption=f'Profile ({session.mode})')
+    activity_logger.info('Profile sent')
+
+
+# Handles profiling command of the admin. 
+# It is not processed per chat, so that profiling doesn't hold the admin chat
+@dp.message_handler(is_admin, commands=['profile'])
+async def profile_command(message: types.Message):
+    # Imported on first use, it is not needed to reply
+    import profiling
+    try:
+        options = profiling.parse_options(message.get_args())
+    except ValueError:
+        await sender.send_message(chat_id=message.chat.id, text=profiling.USAGE)
+        return
+    # Started at once, so that another /profile can't start it before the task runs
+    session = profiling.try_start(options.pop('mode'))
+    if session is None:
+        await sender.send_message(chat_id=message.chat.id, text='Profiling is already running')
+        return
+    
+    # Profile is sent, when it is ready
+    task = asyncio.create_task(send_profile(message.chat.id, session, **options))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    await sender.send_message(chat_id=message.chat.id, text=f'Profiling ({session.mode}) started')
+    activity_logger.info('Command - /profile')
+
+
+
+# Handles trends command of the admin: stats of the last N days against the previous N days
+@dp.message_handler(is_admin, commands=['trends'])
+@per_chat
+@metrics.instrument_handler
+async def trends_command(message: types.Message):
+    import make_report as mr
+    try:
+        periods = [int(arg) for arg in message.get_args().split()] or mr.report_periods
+    except ValueError:
+        periods = []
+    if not periods or min(periods) <= 0 or max(periods) > analytics.max_range_days:
+        await sender.send_message(chat_id=message.chat.id, 
+                                  text=f'/trends [days ...], from 1 to {analytics.max_range_days} days, f.e. /trends 7 30 365')
+        return
+    
+    await flush_stats()
+    trends = [await async_db.analytics.last_days_stats(days) for days in periods]
+    await sender.send_message(chat_id=message.chat.id, text='\n\n'.join(map(analytics.format_stats, trends)))
+    activity_logger.info('Command - /trends')
+
         
 # Handles all other messages
 @dp.message_handler()
+@per_chat
+@metrics.instrument_handler
 async def unknown_message(message: types.Message):  
-    global user_locale_global  
     # Send notification to user 
-    user_locale_global = update_user_locale(message=message)
-    await bot.send_message(chat_id=message.chat.id, text=message_templates[user_locale_global]['message is not sticker'])
+    await sender.send_message(chat_id=message.chat.id, text=locale_resolver.text(message.from_user, 'message is not sticker'))
     activity_logger.info('Message is nor sticker, neither command')
     
     # Update DB stats
-    users_db.update_last_usage(user_id=message.from_user.id)
-    users_db.add_other_message(user_id=message.from_user.id)
-    daily_db.add_other_messages()
+    await async_db.stats_buffer.add_other_message(user_id=message.from_user.id)
     activity_logger.info(f'Unknown message: {message.text}')
 
 
 """ Report sending function """
 
 async def daily_stats():
-    # Collect report text 
-    report_text = mr.collect_stats()
-    # Send report file and report text 
-    await bot.send_message(chat_id=os.environ.get('ADMIN_ID'), text=report_text)
-    
-    for filepath, filename, caption in zip(mr.filepaths, mr.filenames, mr.file_captions):
-        await bot.send_document(chat_id=os.environ.get('ADMIN_ID'), 
-                                document=types.InputFile(path_or_bytesio=filepath, 
-                                                         filename=filename), 
-                                caption=caption, disable_notification=True)
+    # Imported on first use, it is not needed to reply
+    import make_report as mr
+    # Collect report text from up to date stats
+    await flush_stats()
+    await async_db.aggregates.check_consistency()
+    # Text is collected in db thread, while logs are packed in another one
+    report_text, (archive_path, log_offsets) = await asyncio.gather(async_db.run(mr.collect_stats), 
+                                                                    asyncio.to_thread(mr.pack_new_logs))
+    # Send report text and logs written since the last report 
+    sending = [sender.send_message(chat_id=admin_id, text=report_text)]
+    if archive_path is not None:
+        archive = types.InputFile(path_or_bytesio=archive_path, filename=f'Logs{date_func.todays_date()}.zip')
+        sending.append(sender.send_document(chat_id=admin_id, document=archive, caption='New logs', 
+                                            disable_notification=True))
+    try:
+        results = await asyncio.gather(*sending, return_exceptions=True)
+    finally:
+        if archive_path is not None:
+            os.remove(archive_path)
+    # Sent log parts are not sent again, the rest are sent with the next report
+    if archive_path is None or not isinstance(results[-1], Exception):
+        await asyncio.to_thread(mr.commit_offsets, log_offsets)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
     # Log report is sent
     activity_logger.info('Daily report sent')
 
 
 """ Scheduler setup """
 
+async def refresh_caches():
+    # Other workers save stickers and check sets too
+    await async_db.sticker_index.refresh()
+    await async_db.sets_cache.refresh()
+
+
 # Initialize scheduler 
 scheduler = AsyncIOScheduler()
+# Only one process of the deployment runs daily jobs
+scheduler_lock = workers.SchedulerLock(f'{db_name}.scheduler.lock')
 # Create triggers 
-midnight_cron = CronTrigger(hour=0, minute=0, jitter=120)
-report_cron = CronTrigger(hour=23, minute=0, jitter=360)
-# Create jobs 
-scheduler.add_job(func=create_daily_row, trigger=midnight_cron)  # creates daily row in db
-scheduler.add_job(func=daily_stats, trigger=report_cron)  # sends report to admin
+report_cron = CronTrigger(hour=23, minute=0, jitter=360, timezone=date_func.bot_timezone)
+stats_interval = IntervalTrigger(seconds=stats_buffer.flush_interval)
+election_interval = IntervalTrigger(seconds=30)
+# Create jobs of every process
+scheduler.add_job(func=flush_stats, trigger=stats_interval)  # writes buffered stats to db
+if workers.bot_workers > 1:
+    scheduler.add_job(func=refresh_caches, trigger=stats_interval)  # reads stickers and sets of other workers
+
+
+def elect_scheduler():
+    """Adds daily jobs, if this process takes the scheduler lock. 
+    Is repeated, so that another process takes over, when the holder exits."""
+    if not scheduler_lock.acquired and scheduler_lock.try_acquire():
+        scheduler.add_job(func=daily_stats, trigger=report_cron)  # sends report to admin
+
+
+scheduler.add_job(func=elect_scheduler, trigger=election_interval)
+
+
+def run_worker():
+    """Runs one worker process of multi-worker webhook deployment."""
+    workers.detach()
+    scheduler.start()
+    # Webhook is registered once for all workers
+    webhook.start_webhook(dispatcher=dp, on_startup=startup, on_shutdown=shutdown, 
+                          set_webhook_on_startup=workers.worker_index == 0, reuse_port=True)
+    # Worker processes exit without atexit handlers
+    stop_logging()
    
     
 if __name__ == '__main__':
-    scheduler.start()
-    executor.start_polling(dispatcher=dp, skip_updates=True, on_startup=startup, on_shutdown=shutdown)
\ No newline at end of file
+    if workers.bot_workers > 1:
+        if bot_mode != 'webhook':
+            raise SystemExit('Several workers require BOT_MODE=webhook: only one process may poll updates')
+        # Checked before the workers start, otherwise they would be restarted again and again
+        webhook.check_secret()
+        workers.run(run_worker)
+    else:
+        scheduler.start()
+        if bot_mode == 'webhook':
+            webhook.start_webhook(dispatcher=dp, on_startup=startup, on_shutdown=shutdown)
+        else:
+            executor.start_polling(dispatcher=dp, skip_updates=True, on_startup=startup, on_shutdown=shutdown)
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""Concurrent processing of updates from different chats.
+
+Updates of the same chat are processed one by one in the order they came,
+updates of different chats are processed concurrently up to a limit.
+When too many updates are waiting, new ones wait for free space, which slows down
+receiving of updates instead of growing the queue without bound. Waiting updates are
+accepted in the order they came, so that a newer update of a chat doesn't overtake an older one.
+"""
+
+import asyncio, functools, os
+from collections import deque
+from typing import Awaitable, Callable
+
+from aiogram import types
+
+from logs.log import activity_logger
+
+
+# Number of chats, which updates are processed at the same time
+max_concurrent_chats = int(os.environ.get('MAX_CONCURRENT_CHATS', default=32))
+# Number of accepted, but not processed updates, after which new ones wait
+max_pending_updates = int(os.environ.get('MAX_PENDING_UPDATES', default=1000))
+
+
+class ChatDispatcher:
+    """Runs handlers with strict order within a chat and concurrency between chats."""
+
+    def __init__(self, max_concurrency: int = max_concurrent_chats, max_pending: int = max_pending_updates):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.pending = 0  # accepted, but not finished updates
+        self.processed = 0  # finished updates
+        self._queues: dict[int, deque] = {}  # chat id -> jobs, first one is being processed
+        self._workers: set[asyncio.Task] = set()
+        self._semaphore: asyncio.Semaphore | None = None
+        self._waiters: deque[asyncio.Future] = deque()  # updates waiting for free space, oldest first
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._queues)
+
+    def _setup(self) -> None:
+        # Created on first use, so that they belong to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def submit(self, chat_id: int, handler: Callable[..., Awaitable], *args) -> None:
+        """Puts the job to the chat queue. Returns as soon as the job is accepted, not processed.
+
+        Args:
+            chat_id (int): chat the update belongs to.
+            handler (Callable[..., Awaitable]): handler to run.
+            *args: handler arguments.
+        """
+        self._setup()
+        # Backpressure. New update waits also while others wait, so that it doesn't overtake them
+        if self.pending >= self.max_pending or self._waiters:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                # Place of a finished update is handed over, pending is not changed
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.cancelled():
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                else:
+                    # The place was handed over already, it goes to the next one
+                    self._release()
+                raise
+        else:
+            self.pending += 1
+
+        queue = self._queues.get(chat_id)
+        if queue is not None:
+            # The chat worker is running and will take the job
+            queue.append((handler, args))
+            return
+
+        self._queues[chat_id] = deque([(handler, args)])
+        worker = asyncio.create_task(self._process_chat(chat_id))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    async def _process_chat(self, chat_id: int) -> None:
+        """Processes the jobs of the chat until its queue is empty."""
+        queue = self._queues[chat_id]
+        while queue:
+            handler, args = queue[0]
+            try:
+                async with self._semaphore:
+                    await handler(*args)
+            except Exception:
+                activity_logger.exception(f'{handler.__name__} failed in chat {chat_id}')
+            finally:
+                queue.popleft()
+                self.processed += 1
+                self._release()
+        # No await between the check and deletion, so no job is lost
+        del self._queues[chat_id]
+
+    def _release(self) -> None:
+        """Hands the place of a finished update over to the oldest waiting one or frees it."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.pending -= 1
+
+    async def wait_closed(self, timeout: float | None = None) -> None:
+        """Waits for all accepted updates to be processed. Is called on shutdown.
+
+        Args:
+            timeout (float | None, optional): seconds to wait. Defaults to None, without limit.
+        """
+        if self._workers:
+            await asyncio.wait(self._workers.copy(), timeout=timeout)
+
+
+chat_dispatcher = ChatDispatcher()
+
+
+def per_chat(handler: Callable[[types.Message], Awaitable]) -> Callable[[types.Message], Awaitable]:
+    """Decorator, which passes messages to chat_dispatcher instead of handling them at once.
+
+    Args:
+        handler (Callable[[types.Message], Awaitable]): message handler.
+
+    Returns:
+        Callable[[types.Message], Awaitable]: handler to register in aiogram dispatcher.
+    """
+    @functools.wraps(handler)
+    async def wrapper(message: types.Message):
+        await chat_dispatcher.submit(message.chat.id, handler, message)
+
+    return wrapper
@@ -1,5 +1,15 @@
 """Operations performed with the database"""
 
+from . import aggregates
+from . import analytics
+from . import connection
 from . import daily_db
+from . import emoji_fallback
+from . import migrations
+from . import sets_cache
+from . import snapshot
+from . import stats_buffer
+from . import sticker_index
 from . import stickers_db
-from . import users_db
\ No newline at end of file
+from . import users_db
+from . import async_db
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""Materialized statistics for /stats.
+
+Values are kept in aggregates table and are maintained by triggers on stickers
+and users tables (see migrations.add_aggregates), so they are correct whatever
+process or function changes the data. Reading them costs a single lookup.
+"""
+
+import os
+
+from logs.log import db_logger
+from .connection import get_connection
+from .tablenames import aggregates_tablename, stickers_tablename, users_statistics_tablename, db_name
+
+
+# Aggregate name -> query, which computes it from scratch
+aggregates_queries = {
+    'sets': f'SELECT COUNT(DISTINCT setname) FROM {stickers_tablename}',
+    'emoji': f'SELECT COUNT(DISTINCT emoji) FROM {stickers_tablename}',
+    'users': f'SELECT COUNT(*) FROM {users_statistics_tablename}',
+    'stickers_send': f'SELECT COALESCE(SUM(stickers_send_to), 0) FROM {users_statistics_tablename}',
+}
+
+
+def get_stats(tablename: str = aggregates_tablename, db_filename: os.PathLike = db_name) -> dict[str, int]:
+    """Reads all the aggregates.
+
+    Args:
+        tablename (str, optional): name of the table. Defaults to aggregates_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        dict[str, int]: aggregate name -> value.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    return dict(db_connection.execute(f'SELECT name, value FROM {tablename};').fetchall())
+
+
+def get_value(name: str, tablename: str = aggregates_tablename, db_filename: os.PathLike = db_name) -> int:
+    """Reads a single aggregate.
+
+    Args:
+        name (str): name of the aggregate, f.e. 'sets'.
+        tablename (str, optional): name of the table. Defaults to aggregates_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        int: value of the aggregate.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    return db_connection.execute(f'SELECT value FROM {tablename} WHERE name=?;', (name, )).fetchone()[0]
+
+
+def compute_stats(db_filename: os.PathLike = db_name) -> dict[str, int]:
+    """Computes the aggregates from scratch with full scans.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        dict[str, int]: aggregate name -> actual value.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    return {name: db_connection.execute(query).fetchone()[0] for name, query in aggregates_queries.items()}
+
+
+def rebuild(tablename: str = aggregates_tablename, db_filename: os.PathLike = db_name) -> dict[str, int]:
+    """Recomputes all the aggregates and saves them.
+
+    Args:
+        tablename (str, optional): name of the table. Defaults to aggregates_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        dict[str, int]: aggregate name -> new value.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Write lock is taken before computing, so that concurrent changes are not lost
+    db_connection.execute('BEGIN IMMEDIATE;')
+    with db_connection:
+        actual = compute_stats(db_filename)
+        db_connection.executemany(f'INSERT OR REPLACE INTO {tablename} (name, value) VALUES (?, ?);', actual.items())
+
+    db_logger.info(f'AGGREGATES. Rebuilt: {actual}')
+    return actual
+
+
+def check_consistency(rebuild_on_mismatch: bool = True, tablename: str = aggregates_tablename,
+                      db_filename: os.PathLike = db_name) -> bool:
+    """Compares stored aggregates with the actual values.
+
+    Args:
+        rebuild_on_mismatch (bool, optional): rebuild aggregates, if they differ. Defaults to True.
+        tablename (str, optional): name of the table. Defaults to aggregates_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        bool: True, if stored aggregates were correct.
+    """
+    stored = get_stats(tablename=tablename, db_filename=db_filename)
+    actual = compute_stats(db_filename=db_filename)
+    if stored == actual:
+        return True
+
+    db_logger.warning(f'AGGREGATES. Stored {stored} differ from actual {actual}')
+    if rebuild_on_mismatch:
+        rebuild(tablename=tablename, db_filename=db_filename)
+    return False
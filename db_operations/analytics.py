@@ -0,0 +1,225 @@
+"""Range analytics over daily statistics.
+
+Daily records are rolled up into weekly and monthly tables, when the days close,
+that is, when they are before today and their stats are not changed any more.
+Stats, which are written for a closed day later, f.e. flushed from the buffer after midnight,
+are rolled up again by roll_up_late(). Range queries take whole months and weeks from the rollups and only the edges
+from daily records, so their cost depends on the length of the range, not on the history.
+"""
+
+import datetime, os, sqlite3
+
+from logs.log import db_logger
+from .connection import get_connection
+from .date_func import todays_date
+from .tablenames import (daily_statistics_tablename, weekly_statistics_tablename, monthly_statistics_tablename,
+                         rollup_state_tablename, db_name)
+
+
+# Counters of daily stats, which are rolled up
+COUNTERS = ('stickers_send', 'commands_use', 'other_messages')
+# Longest range of last days stats, the previous range of the same length is read too
+max_range_days = 100 * 366
+
+# Period key of the day: Monday of the week and month
+WEEK_KEY = "date(day, 'weekday 0', '-6 days')"
+MONTH_KEY = "strftime('%Y-%m', day)"
+
+
+def _week_start(day: datetime.date) -> datetime.date:
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def _month_end(day: datetime.date) -> datetime.date:
+    next_month = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return next_month - datetime.timedelta(days=1)
+
+
+def create_rollup_tables(connection: sqlite3.Connection) -> None:
+    """Creates rollup tables in the current transaction. Is called by migrations."""
+    columns = ', '.join(f'{counter} INT NOT NULL DEFAULT 0' for counter in COUNTERS)
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {weekly_statistics_tablename} (week DATE PRIMARY KEY, {columns});')
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {monthly_statistics_tablename} (month TEXT PRIMARY KEY, {columns});')
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {rollup_state_tablename} (name TEXT PRIMARY KEY, value TEXT NOT NULL);')
+
+
+def roll_up(connection: sqlite3.Connection, first_day: str, last_day: str) -> None:
+    """Recomputes weeks and months, which contain the days, in the current transaction.
+
+    Args:
+        connection (sqlite3.Connection): db connection.
+        first_day (str): first day to roll up.
+        last_day (str): last day to roll up.
+    """
+    first, last = datetime.date.fromisoformat(first_day), datetime.date.fromisoformat(last_day)
+    sums = ', '.join(f'SUM({counter})' for counter in COUNTERS)
+    for tablename, key_name, key, start, end in (
+            (weekly_statistics_tablename, 'week', WEEK_KEY, _week_start(first), _week_start(last) + datetime.timedelta(days=6)),
+            (monthly_statistics_tablename, 'month', MONTH_KEY, first.replace(day=1), _month_end(last))):
+        connection.execute(f'''INSERT OR REPLACE INTO {tablename} ({key_name}, {', '.join(COUNTERS)})
+                           SELECT {key} AS period, {sums} FROM {daily_statistics_tablename}
+                           WHERE day BETWEEN ? AND ? GROUP BY period;''', (start.isoformat(), end.isoformat()))
+
+
+def get_closed_through(db_filename: os.PathLike = db_name) -> str | None:
+    """Returns the last rolled up day, None if no day is rolled up yet."""
+    row = get_connection(db_filename).execute(f"SELECT value FROM {rollup_state_tablename} WHERE name='closed_through';").fetchone()
+    return row[0] if row else None
+
+
+def set_closed_through(connection: sqlite3.Connection, day: str) -> None:
+    """Marks the days through the day as rolled up, in the current transaction."""
+    connection.execute(f"INSERT OR REPLACE INTO {rollup_state_tablename} (name, value) VALUES ('closed_through', ?);", (day, ))
+
+
+def roll_up_late(connection: sqlite3.Connection, days: list[str]) -> None:
+    """Recomputes weeks and months of the days, which were closed before their stats were written,
+    f.e. buffered stats of the last minutes before midnight, in the current transaction.
+
+    Args:
+        connection (sqlite3.Connection): db connection.
+        days (list[str]): days, which stats are written.
+    """
+    row = connection.execute(f"SELECT value FROM {rollup_state_tablename} WHERE name='closed_through';").fetchone()
+    late_days = sorted(day for day in days if row is not None and day <= row[0])
+    if late_days:
+        roll_up(connection, late_days[0], late_days[-1])
+
+
+def close_days(today: str | None = None, db_filename: os.PathLike = db_name) -> None:
+    """Rolls up the days before today, which are not rolled up yet.
+    Buffered stats should be flushed before, so that closed days are complete.
+
+    Args:
+        today (str | None, optional): current day. Defaults to None, todays_date().
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+    """
+    last_closed = (datetime.date.fromisoformat(today or todays_date()) - datetime.timedelta(days=1)).isoformat()
+    closed_through = get_closed_through(db_filename)
+    if closed_through is not None and closed_through >= last_closed:
+        return
+
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    first_open = db_connection.execute(f'SELECT MIN(day) FROM {daily_statistics_tablename} WHERE day > ?;',
+                                       (closed_through or '', )).fetchone()[0]
+    with db_connection:
+        if first_open is not None and first_open <= last_closed:
+            roll_up(db_connection, first_open, last_closed)
+        set_closed_through(db_connection, last_closed)
+
+    db_logger.info(f'ANALYTICS. Days through {last_closed} are rolled up')
+
+
+def split_range(start: datetime.date, end: datetime.date) -> tuple[list[str], list[str], list[str]]:
+    """Covers the range with the least whole months, weeks and days.
+
+    Returns:
+        tuple[list[str], list[str], list[str]]: month keys, week keys and days.
+    """
+    months, weeks, days = [], [], []
+    day = start
+    while day <= end:
+        month_end = _month_end(day)
+        week_end = day + datetime.timedelta(days=6)
+        if day.day == 1 and month_end <= end:
+            months.append(day.strftime('%Y-%m'))
+            day = month_end
+        # Week is not taken, if it hides the start of a whole month
+        elif (day.weekday() == 0 and week_end <= end
+              and not (week_end.month != day.month and _month_end(week_end) <= end)):
+            weeks.append(day.isoformat())
+            day = week_end
+        else:
+            days.append(day.isoformat())
+        day += datetime.timedelta(days=1)
+    return months, weeks, days
+
+
+def _sum_rows(db_connection: sqlite3.Connection, tablename: str, key_name: str, keys: list[str]) -> list[int]:
+    if not keys:
+        return [0] * len(COUNTERS)
+    sums = ', '.join(f'COALESCE(SUM({counter}), 0)' for counter in COUNTERS)
+    placeholders = ', '.join('?' * len(keys))
+    return list(db_connection.execute(f'SELECT {sums} FROM {tablename} WHERE {key_name} IN ({placeholders});',
+                                      keys).fetchone())
+
+
+def range_totals(start: str, end: str, db_filename: os.PathLike = db_name) -> dict[str, int]:
+    """Sums the counters over the days from start to end, both included.
+
+    Args:
+        start (str): first day.
+        end (str): last day.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        dict[str, int]: counter name -> total.
+    """
+    close_days(db_filename=db_filename)
+    closed_through = get_closed_through(db_filename) or ''
+    first, last = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+
+    months, weeks, days = [], [], []
+    if start <= closed_through:
+        months, weeks, days = split_range(first, min(last, datetime.date.fromisoformat(closed_through)))
+    # Open days are taken from daily records
+    open_day = max(first, datetime.date.fromisoformat(closed_through) + datetime.timedelta(days=1)) if closed_through else first
+    while open_day <= last:
+        days.append(open_day.isoformat())
+        open_day += datetime.timedelta(days=1)
+
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    totals = [0] * len(COUNTERS)
+    for tablename, key_name, keys in ((monthly_statistics_tablename, 'month', months),
+                                      (weekly_statistics_tablename, 'week', weeks),
+                                      (daily_statistics_tablename, 'day', days)):
+        totals = [total + value for total, value in zip(totals, _sum_rows(db_connection, tablename, key_name, keys))]
+    return dict(zip(COUNTERS, totals))
+
+
+def range_stats(start: str, end: str, db_filename: os.PathLike = db_name) -> dict:
+    """Totals, averages per day and growth against the previous range of the same length.
+
+    Args:
+        start (str): first day.
+        end (str): last day.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        dict: start, end, days, totals, averages and growth (None, if previous total is 0) by counter.
+    """
+    first, last = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    days = (last - first).days + 1
+    previous_end = first - datetime.timedelta(days=1)
+    previous_start = previous_end - datetime.timedelta(days=days - 1)
+
+    totals = range_totals(start, end, db_filename=db_filename)
+    previous = range_totals(previous_start.isoformat(), previous_end.isoformat(), db_filename=db_filename)
+    return {
+        'start': start,
+        'end': end,
+        'days': days,
+        'totals': totals,
+        'averages': {counter: total / days for counter, total in totals.items()},
+        'growth': {counter: (total - previous[counter]) / previous[counter] if previous[counter] else None
+                   for counter, total in totals.items()},
+    }
+
+
+def last_days_stats(days: int, db_filename: os.PathLike = db_name) -> dict:
+    """Range stats of the last days, today included. Days must not be more than max_range_days."""
+    today = datetime.date.fromisoformat(todays_date())
+    start = today - datetime.timedelta(days=days - 1)
+    return range_stats(start.isoformat(), today.isoformat(), db_filename=db_filename)
+
+
+def format_stats(stats: dict) -> str:
+    """Returns range stats as report text."""
+    lines = [f'{stats["start"]} - {stats["end"]} ({stats["days"]} days)']
+    for counter in COUNTERS:
+        growth = stats['growth'][counter]
+        growth_text = f'{growth:+.1%}' if growth is not None else 'n/a'
+        lines.append(f'{counter}: {stats["totals"][counter]}, {stats["averages"][counter]:.1f}/day, {growth_text}')
+    return '\n'.join(lines)
@@ -0,0 +1,92 @@
+"""Awaitable access to the database for the bot handlers.
+
+SQLite calls are blocking, so they are executed in a single dedicated db thread
+instead of the event loop. One thread means one shared connection and no
+competition between the writers of the same process.
+"""
+
+import asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Any, Callable
+
+import metrics
+from logs.log import db_logger
+from . import aggregates, analytics, connection, daily_db, migrations, sets_cache, snapshot, stats_buffer, sticker_index, stickers_db, users_db
+
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def start() -> None:
+    """Starts db thread, if it is not started yet. Is called on startup."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        db_logger.info('ASYNC DB. DB thread is started')
+
+
+async def stop() -> None:
+    """Closes db connections and waits for the queued queries to finish. Is called on shutdown."""
+    global _executor
+    if _executor is None:
+        return
+    await run(connection.close_connections)
+    _executor.shutdown(wait=True)
+    _executor = None
+    db_logger.info('ASYNC DB. DB thread is stopped')
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """Runs the function in db thread and waits for the result without blocking the event loop.
+    Function is repeated, if the db is locked by another process (see connection.retry_locked).
+
+    Args:
+        func (Callable): function to run.
+        *args, **kwargs: arguments to pass to the function.
+
+    Returns:
+        Any: result of the function.
+    """
+    start()
+    loop = asyncio.get_running_loop()
+    # Operation is named by module and function, f.e. 'users_db.user_exists'
+    module = getattr(func, '__module__', None) or ''
+    operation = f'{module.rpartition(".")[2]}.{getattr(func, "__name__", type(func).__name__)}'
+    call = functools.partial(metrics.observe_db_call, operation, connection.retry_locked, func, *args, **kwargs)
+    return await loop.run_in_executor(_executor, call)
+
+
+class AsyncModule:
+    """Wraps db module, so that its functions become awaitable and are run in db thread.
+    F.e. `await async_db.users_db.user_exists(user_id=1)`.
+    """
+
+    def __init__(self, module: ModuleType):
+        self._module = module
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._module, name)
+        if not callable(attribute):
+            return attribute
+
+        async def wrapper(*args, **kwargs):
+            return await run(attribute, *args, **kwargs)
+
+        wrapper.__name__ = name
+        wrapper.__doc__ = attribute.__doc__
+        # Cache the wrapper, so that __getattr__ is not called next time
+        setattr(self, name, wrapper)
+        return wrapper
+
+
+aggregates = AsyncModule(aggregates)
+analytics = AsyncModule(analytics)
+daily_db = AsyncModule(daily_db)
+migrations = AsyncModule(migrations)
+sets_cache = AsyncModule(sets_cache)
+snapshot = AsyncModule(snapshot)
+stats_buffer = AsyncModule(stats_buffer)
+sticker_index = AsyncModule(sticker_index)
+stickers_db = AsyncModule(stickers_db)
+users_db = AsyncModule(users_db)
@@ -0,0 +1,123 @@
+"""Shared SQLite connections"""
+
+import sqlite3, os, random, threading, time
+from typing import Any, Callable
+
+import metrics
+from logs.log import db_logger
+from .tablenames import db_name
+
+
+# Seconds to wait for a lock held by another connection before giving up
+busy_timeout = float(os.environ.get('DB_BUSY_TIMEOUT', default=5))
+
+# Repeats of an operation, which failed because another process holds the lock longer than busy timeout
+# or because its read snapshot became stale (SQLITE_BUSY_SNAPSHOT, the busy handler is not called then)
+lock_retries = int(os.environ.get('DB_LOCK_RETRIES', default=5))
+lock_retry_delay = 0.05
+lock_retry_cap = 2
+
+# Pragmas applied to every new connection
+connection_pragmas = {
+    'journal_mode': 'WAL',  # readers do not block the writer and vice versa
+    'synchronous': 'NORMAL',  # fsync on checkpoint only, safe in WAL mode
+    'temp_store': 'MEMORY',
+    'cache_size': -16000,  # negative value is KiB, so 16 MB of page cache
+    'foreign_keys': 'ON',
+}
+
+_local = threading.local()
+_registry_lock = threading.Lock()
+_registry: list[sqlite3.Connection] = []
+# Is increased on every close, so that threads drop their closed connections
+_generation = 0
+
+
+def configure_connection(connection: sqlite3.Connection) -> None:
+    """Applies the pragmas to the connection.
+
+    Args:
+        connection (sqlite3.Connection): connection to configure.
+    """
+    connection.execute(f'PRAGMA busy_timeout = {int(busy_timeout * 1000)};')
+    for pragma, value in connection_pragmas.items():
+        connection.execute(f'PRAGMA {pragma} = {value};')
+
+
+def get_connection(db_filename: os.PathLike = db_name) -> sqlite3.Connection:
+    """Returns the connection of the current thread to the db file.
+    The connection is opened and configured on the first call only,
+    further calls from the same thread reuse it.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        sqlite3.Connection: ready to use connection.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.generation != _generation:
+        connections = _local.connections = {}
+        _local.generation = _generation
+
+    db_filename = os.fspath(db_filename)
+    connection = connections.get(db_filename)
+    if connection is None:
+        # Connection may be closed on shutdown from another thread
+        connection = sqlite3.connect(db_filename, timeout=busy_timeout, check_same_thread=False)
+        configure_connection(connection)
+        connections[db_filename] = connection
+        with _registry_lock:
+            _registry.append(connection)
+        db_logger.info(f'CONNECTION. Opened connection to {db_filename} in {threading.current_thread().name}')
+    return connection
+
+
+def close_connections() -> None:
+    """Closes all the connections, opened by any thread. Is called on shutdown."""
+    global _generation
+
+    with _registry_lock:
+        connections = _registry.copy()
+        _registry.clear()
+        _generation += 1
+
+    for connection in connections:
+        try:
+            connection.close()
+        except sqlite3.ProgrammingError:
+            pass
+    db_logger.info(f'CONNECTION. Closed {len(connections)} connections')
+
+
+def is_locked_error(error: Exception) -> bool:
+    """Checks if the error means that the db is locked by another connection."""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def retry_locked(func: Callable, *args, **kwargs) -> Any:
+    """Calls the function and repeats it with backoff, while it fails because the db is locked.
+    Function must be safe to repeat, f.e. make its changes in a single transaction.
+
+    Args:
+        func (Callable): function to call.
+        *args, **kwargs: arguments to pass to the function.
+
+    Returns:
+        Any: result of the function.
+    """
+    for attempt in range(lock_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as error:
+            if attempt == lock_retries or not is_locked_error(error):
+                raise
+            # Failed statement may leave implicitly opened transaction
+            for connection in getattr(_local, 'connections', {}).values():
+                if connection.in_transaction:
+                    connection.rollback()
+            delay = min(lock_retry_cap, lock_retry_delay * 2 ** attempt) * random.uniform(0.5, 1)
+            metrics.db_lock_retries.inc(operation=getattr(func, '__name__', type(func).__name__))
+            db_logger.warning(f'CONNECTION. {error}, attempt {attempt + 1} of {lock_retries}, retry in {delay:.2f} s')
+            time.sleep(delay)
@@ -1,10 +1,11 @@
 """ Daily activity stats """
-import sqlite3, os
+import os
 
 from functools import partial
 
 from logs.log import db_logger
 from .date_func import todays_date
+from .connection import get_connection
 from .tablenames import daily_statistics_tablename, db_name
 
 
@@ -15,8 +16,8 @@ def create_dailystats_table(tablename: str = daily_statistics_tablename, db_file
         tablename (str, optional): name of the table. Defaults to daily_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Create table 
     
@@ -30,15 +31,13 @@ def create_dailystats_table(tablename: str = daily_statistics_tablename, db_file
     db_logger.info(f'DAILY DB. Table {tablename} is setup')
     # Save changes 
     db_connection.commit()
-    # Close the connection
-    db_connection.close()
 
 
-def check_daily_record_exists(day: str = todays_date(), tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> bool:
-    """Check if there is a record of today's date.
+def check_daily_record_exists(day: str | None = None, tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> bool:
+    """Check if there is a record of the date.
 
     Args:
-        day (str, optional): date to check. Defaults to todays_date().
+        day (str | None, optional): date to check. Defaults to None, todays_date().
         tablename (str, optional): table name to look in. Defaults to daily_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
 
@@ -48,13 +47,12 @@ def check_daily_record_exists(day: str = todays_date(), tablename: str = daily_s
     Returns:
         bool: True, if exists, False, if doesn't. 
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    day = day or todays_date()
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Get value
     result = db_cursor.execute(f'''SELECT * FROM {tablename} WHERE day="{day}";''').fetchall()
-    # Close the connection
-    db_connection.close()
     
     if len(result) == 0:
         return False
@@ -64,7 +62,7 @@ def check_daily_record_exists(day: str = todays_date(), tablename: str = daily_s
         raise KeyError('There are more than 1 daily records')
  
     
-def get_daily_value(day: str, column_name: str, tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
+def get_daily_value(day: str, column_name: str, tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> int:
     """Gets a value of specified column from the day record. 
 
     Args:
@@ -74,17 +72,15 @@ def get_daily_value(day: str, column_name: str, tablename: str = daily_statistic
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
 
     Returns:
-        _type_: _description_
+        int: value of the column, 0 if there is no record of the day.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Get value
     value = db_cursor.execute(f'''SELECT {column_name} FROM {tablename} WHERE day="{day}"''').fetchone()
-    # Close the connection
-    db_connection.close()
-    # Return value
-    return value[0]
+    # Return value, day records are created with the first counted message
+    return value[0] if value is not None else 0
 
 
 get_commands_use = partial(get_daily_value, column_name='commands_use')
@@ -102,14 +98,12 @@ def update_daily_value(day: str, column_name: str, new_value: int, tablename: st
         tablename (str, optional): name of the table. Defaults to daily_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Get value
     db_cursor.execute(f'''UPDATE {tablename} SET {column_name}={new_value} WHERE day="{day}"''')
     db_connection.commit()
-    # Close the connection
-    db_connection.close()
     
     db_logger.info(f'DAILY DB. Daily record update: {column_name} is set to {new_value}')
 
@@ -119,65 +113,44 @@ update_stickers_send = partial(update_daily_value, column_name='stickers_send')
 update_other_messages = partial(update_daily_value, column_name='other_messages')
 
     
-def add_daily_record(day: str = todays_date(), tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
-    """Creates new row of the day, so called daily record. 
+def add_daily_record(day: str | None = None, tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
+    """Creates new row of the day, so called daily record, if there is none. 
+    Counters create it themselves, so it is only needed for days without messages.
 
     Args:
-        day (str, optional): this day in string format. Defaults to todays_date().
+        day (str | None, optional): day in string format. Defaults to None, todays_date().
         tablename (str, optional): name of the table. Defaults to daily_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
-    db_cursor = db_connection.cursor()
-    
-    this_day = todays_date()
-    
-    # Get value
-    query_text = f'''INSERT INTO {tablename} (day) VALUES ("{this_day}")'''
-    db_cursor.execute(query_text)
-    db_connection.commit()
+    day = day or todays_date()
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Another worker could have created it meanwhile
+    with db_connection:
+        db_connection.execute(f'INSERT OR IGNORE INTO {tablename} (day) VALUES (?);', (day, ))
     
-    # Close the connection
-    db_connection.close()
-    
-    db_logger.info(f'DAILY DB. Daily record creation: {this_day}')
-
-
-def add_stickers_send(day: str = todays_date(), tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
-    """Gets current value of stickers, sent today, and writes current + 1
-
-    Args:
-        day (str, optional): this day. Defaults to todays_date().
-        tablename (str, optional): name of the table. Defaults to daily_statistics_tablename.
-        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
-    """
-    current_value = get_stickers_send(day=day, tablename=tablename, db_filename=db_filename)
-    new_value = current_value + 1
-    update_stickers_send(day=day, new_value=new_value, tablename=tablename, db_filename=db_filename)
-
-
-def add_commands_use(day: str = todays_date(), tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
-    """Gets current value of used commands, received today, and writes current + 1
-
-    Args:
-        day (str, optional): this day. Defaults to todays_date().
-        tablename (str, optional): name of the table. Defaults to daily_statistics_tablename.
-        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
-    """
-    current_value = get_commands_use(day=day, tablename=tablename, db_filename=db_filename)
-    new_value = current_value + 1
-    update_commands_use(day=day, new_value=new_value, tablename=tablename, db_filename=db_filename)
+    db_logger.info(f'DAILY DB. Daily record creation: {day}')
 
 
-def add_other_messages(day: str = todays_date(), tablename: str = daily_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
-    """Gets current value of other messages, received today, and writes current + 1
+def increment_daily_value(column_name: str, day: str | None = None, tablename: str = daily_statistics_tablename, 
+                          db_filename: os.PathLike = db_name) -> None:
+    """Adds 1 to the column of the day record, creating the record, if it doesn't exist yet.
 
     Args:
-        day (str, optional): this day. Defaults to todays_date().
+        column_name (str): column name to increment.
+        day (str | None, optional): day of the record. Defaults to None, todays_date().
         tablename (str, optional): name of the table. Defaults to daily_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    current_value = get_other_messages(day=day, tablename=tablename, db_filename=db_filename)
-    new_value = current_value + 1
-    update_other_messages(day=day, new_value=new_value, tablename=tablename, db_filename=db_filename)
\ No newline at end of file
+    day = day or todays_date()
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Single upsert instead of existence check, read and update
+    with db_connection:
+        db_connection.execute(f'''INSERT INTO {tablename} (day, {column_name}) VALUES (?, 1)
+                              ON CONFLICT(day) DO UPDATE SET {column_name}={column_name} + 1;''', (day, ))
+
+
+add_stickers_send = partial(increment_daily_value, column_name='stickers_send')
+add_commands_use = partial(increment_daily_value, column_name='commands_use')
+add_other_messages = partial(increment_daily_value, column_name='other_messages')
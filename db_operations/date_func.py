@@ -1,6 +1,57 @@
-import datetime
+"""Days, which statistics are bucketed by.
+
+The current day is computed once and kept until its midnight in the bot time zone,
+so that it is cheap enough to be resolved for every counted message, and a long running
+process moves to the next day without restarts or scheduled jobs.
+"""
+
+import datetime, os, time
+from zoneinfo import ZoneInfo
+
+
+# Time zone of the days in statistics and of scheduled jobs, f.e. 'Europe/Moscow'. Empty for local time of the server
+bot_timezone = os.environ.get('BOT_TIMEZONE', default='') or None
+
+
+class DayBucket:
+    """Current day in the time zone, recomputed only when the day is over.
+
+    Args:
+        timezone (str | None): IANA time zone name, None for local time.
+    """
+
+    def __init__(self, timezone: str | None = None):
+        self.timezone = ZoneInfo(timezone) if timezone else None
+        # (start, end) timestamps and the day, replaced at once, so that threads never see a half updated bucket
+        self._bucket: tuple[float, float, str] = (0.0, 0.0, '')
+
+    def day(self, now: float | None = None) -> str:
+        """Returns the day of the moment in the time zone.
+
+        Args:
+            now (float | None, optional): timestamp. Defaults to None, current time.
+
+        Returns:
+            str: day in '%Y-%m-%d' format.
+        """
+        if now is None:
+            now = time.time()
+        start, end, day = self._bucket
+        # Start is checked too, as the clock can be set back
+        if start <= now < end:
+            return day
+
+        date = datetime.datetime.fromtimestamp(now, tz=self.timezone).date()
+        # Midnights are found in the time zone, so that days with DST change have their real length
+        start = datetime.datetime.combine(date, datetime.time(), tzinfo=self.timezone).timestamp()
+        end = datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time(), tzinfo=self.timezone).timestamp()
+        day = date.isoformat()
+        self._bucket = (start, end, day)
+        return day
+
+
+current_day = DayBucket(bot_timezone)
+
 
 def todays_date() -> str:
-    today = datetime.date.today()
-    today_str = datetime.datetime.strftime(today, '%Y-%m-%d')
-    return today_str
\ No newline at end of file
+    return current_day.day()
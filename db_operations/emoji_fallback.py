@@ -0,0 +1,139 @@
+"""Related emoji for replies to emoji, which have no stickers in other sets.
+
+The emoji package has no categories, so emoji are related by the words of their names,
+f.e. :grinning_cat: and :grinning_face:. Words are weighted by how rare they are among
+all emoji names, so that "cat" means more than "face". Words of directions, colours
+and skin tones only modify the emoji, so they are not counted as common words, and emoji
+with different words of one contrast group, f.e. :thumbs_up: and :thumbs_down:, are not related.
+
+For every emoji asked, the few most related emoji, which have stickers, are found once
+and then kept up to date by add_covered(), when the index gets stickers of a new emoji,
+so a reply to an uncovered emoji costs a dict lookup. It is used from db thread only, like the index.
+"""
+
+import math, os
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+import emoji
+
+
+# Number of related emoji kept for each emoji
+related_limit = int(os.environ.get('RELATED_EMOJI_LIMIT', default=3))
+# Emoji less similar than this are not related, 1 means the same words
+min_similarity = float(os.environ.get('RELATED_EMOJI_MIN_SIMILARITY', default=0.3))
+
+# Words, which tell nothing about the emoji
+STOP_WORDS = frozenset({'a', 'and', 'button', 'in', 'of', 'on', 'the', 'with'})
+# Words, which only modify the emoji, those of one group contradict each other
+CONTRAST_GROUPS = (
+    frozenset({'up', 'down', 'upwards', 'downwards', 'left', 'right'}),
+    frozenset({'red', 'orange', 'yellow', 'green', 'blue', 'purple', 'brown', 'black', 'white', 'pink', 'grey'}),
+    frozenset({'smiling', 'frowning'}),
+)
+# Modifiers, which do not contradict, f.e. :thumbs_up_dark_skin_tone: is still :thumbs_up:
+MODIFIER_WORDS = frozenset({'skin', 'tone', 'light', 'medium', 'dark'}).union(*CONTRAST_GROUPS)
+
+
+def name_words(emoji_code: str) -> frozenset[str]:
+    """Returns the words of emoji code, f.e. {'grinning', 'cat'} for ":grinning_cat:"."""
+    words = emoji_code.strip(':').lower().replace('-', '_').split('_')
+    return frozenset(word for word in words if word and word not in STOP_WORDS)
+
+
+@lru_cache(maxsize=1)
+def _word_weights() -> tuple[dict[str, float], float]:
+    """Inverse document frequencies of the words in all emoji names and the weight of an unknown word."""
+    names_num = len(emoji.EMOJI_DATA)
+    counts = Counter(word for data in emoji.EMOJI_DATA.values() for word in name_words(data['en']))
+    return {word: math.log(names_num / count) for word, count in counts.items()}, math.log(names_num)
+
+
+@lru_cache(maxsize=4096)
+def _profile(emoji_code: str) -> tuple[dict[str, float], float, tuple[frozenset[str], ...]]:
+    """Returns weights of the words of the emoji without modifiers, their sum and contrast words by group."""
+    weights, unknown_weight = _word_weights()
+    all_words = name_words(emoji_code)
+    words = {word: weights.get(word, unknown_weight) for word in all_words - MODIFIER_WORDS}
+    return words, sum(words.values()), tuple(all_words & group for group in CONTRAST_GROUPS)
+
+
+def similarity(emoji_code: str, other_code: str) -> float:
+    """Returns weighted share of the common words, 0 for unrelated or contrary emoji and 1 for the same words."""
+    words, total, contrasts = _profile(emoji_code)
+    other_words, other_total, other_contrasts = _profile(other_code)
+    if any(group and other_group and group != other_group for group, other_group in zip(contrasts, other_contrasts)):
+        return 0.0
+    shared = sum(weight for word, weight in words.items() if word in other_words)
+    return shared / math.sqrt(total * other_total) if shared else 0.0
+
+
+def warm_up() -> None:
+    """Computes word weights in advance, so that they are not computed on the first miss."""
+    _word_weights()
+
+
+# Word -> covered emoji codes with it
+_covered: defaultdict[str, set[str]] = defaultdict(set)
+# Emoji code -> (similarity, related covered code), most similar first
+_related: dict[str, list[tuple[float, str]]] = {}
+# Word -> emoji codes in _related with it
+_related_by_word: defaultdict[str, set[str]] = defaultdict(set)
+
+
+def reset() -> None:
+    """Forgets covered emoji, f.e. before the index is loaded again."""
+    _covered.clear()
+    _related.clear()
+    _related_by_word.clear()
+
+
+def _consider(emoji_code: str, candidate: str) -> None:
+    if candidate == emoji_code:
+        return
+    score = similarity(emoji_code, candidate)
+    if score < min_similarity:
+        return
+    related = _related[emoji_code]
+    if len(related) < related_limit or score > related[-1][0]:
+        related.append((score, candidate))
+        related.sort(key=lambda item: -item[0])
+        del related[related_limit:]
+
+
+def add_covered(emoji_code: str) -> None:
+    """Registers emoji, which got its first stickers, and updates the emoji it is related to.
+
+    Args:
+        emoji_code (str): demojized emoji.
+    """
+    words = _profile(emoji_code)[0]
+    affected = set()
+    for word in words:
+        _covered[word].add(emoji_code)
+        affected.update(_related_by_word.get(word, ()))
+    for related_code in affected:
+        _consider(related_code, emoji_code)
+
+
+def related(emoji_code: str) -> list[str]:
+    """Returns covered emoji most related to the emoji, most similar first.
+
+    Args:
+        emoji_code (str): demojized emoji.
+
+    Returns:
+        list[str]: emoji codes, up to related_limit.
+    """
+    related_codes = _related.get(emoji_code)
+    if related_codes is None:
+        # Found once, then updated by add_covered()
+        related_codes = _related[emoji_code] = []
+        words = _profile(emoji_code)[0]
+        candidates = set()
+        for word in words:
+            _related_by_word[word].add(emoji_code)
+            candidates.update(_covered.get(word, ()))
+        for candidate in candidates:
+            _consider(emoji_code, candidate)
+    return [code for _, code in related_codes]
@@ -0,0 +1,158 @@
+"""Versioned db schema.
+
+Schema version is kept in `PRAGMA user_version`. Each migration is applied once,
+in order, inside its own transaction, together with the version bump.
+New migrations are appended to the end of the migrations list and are never changed afterwards.
+"""
+
+import datetime, sqlite3, os
+from typing import Callable
+
+from logs.log import db_logger
+from . import aggregates, analytics, daily_db, sets_cache, stickers_db, users_db
+from .connection import get_connection
+from .date_func import todays_date
+from .tablenames import stickers_tablename, users_statistics_tablename, daily_statistics_tablename, aggregates_tablename, db_name
+
+
+def create_base_tables(connection: sqlite3.Connection, db_filename: os.PathLike) -> None:
+    """Tables, which existed before migrations. They are created with IF NOT EXISTS, 
+    so the migration is safe to repeat, even though the functions commit on their own."""
+    daily_db.create_dailystats_table(db_filename=db_filename)
+    stickers_db.create_stickers_table(db_filename=db_filename)
+    users_db.create_userstats_table(db_filename=db_filename)
+    sets_cache.create_known_sets_table(db_filename=db_filename)
+
+
+def index_stickers(connection: sqlite3.Connection, db_filename: os.PathLike) -> None:
+    """Index for emoji lookups in select_reply and (set, emoji) check in check_sticker and add_set."""
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {stickers_tablename}_emoji_setname '
+                       f'ON {stickers_tablename} (emoji, setname);')
+
+
+def unique_daily_records(connection: sqlite3.Connection, db_filename: os.PathLike) -> None:
+    """Merges duplicated daily records into the earliest one and makes the day unique."""
+    tablename = daily_statistics_tablename
+    duplicated = f'SELECT MIN(dayID) FROM {tablename} GROUP BY day HAVING COUNT(*) > 1'
+    connection.execute(f'''UPDATE {tablename} SET
+                       commands_use = (SELECT SUM(commands_use) FROM {tablename} AS d WHERE d.day = {tablename}.day),
+                       stickers_send = (SELECT SUM(stickers_send) FROM {tablename} AS d WHERE d.day = {tablename}.day),
+                       other_messages = (SELECT SUM(other_messages) FROM {tablename} AS d WHERE d.day = {tablename}.day)
+                       WHERE dayID IN ({duplicated});''')
+    connection.execute(f'DELETE FROM {tablename} WHERE dayID NOT IN (SELECT MIN(dayID) FROM {tablename} GROUP BY day);')
+    connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {tablename}_day ON {tablename} (day);')
+
+
+def add_aggregates(connection: sqlite3.Connection, db_filename: os.PathLike) -> None:
+    """Aggregates table for /stats and triggers, which keep it up to date."""
+    stickers, users, table = stickers_tablename, users_statistics_tablename, aggregates_tablename
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (name TEXT PRIMARY KEY, value INT NOT NULL DEFAULT 0);')
+    # Index for 'is it the only sticker of the set' checks of the triggers
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {stickers}_setname ON {stickers} (setname);')
+
+    # Distinct values of the column are counted: +1 for the first row with the value, -1 for the last one
+    for aggregate, column in (('sets', 'setname'), ('emoji', 'emoji')):
+        increase = (f"UPDATE {table} SET value = value + 1 WHERE name = '{aggregate}' AND NOT EXISTS "
+                    f"(SELECT 1 FROM {stickers} WHERE {column} = NEW.{column} AND rowid != NEW.rowid);")
+        decrease = (f"UPDATE {table} SET value = value - 1 WHERE name = '{aggregate}' AND NOT EXISTS "
+                    f"(SELECT 1 FROM {stickers} WHERE {column} = OLD.{column});")
+        connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{aggregate}_insert 
+                           AFTER INSERT ON {stickers} BEGIN {increase} END;''')
+        connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{aggregate}_delete 
+                           AFTER DELETE ON {stickers} BEGIN {decrease} END;''')
+        connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{aggregate}_update 
+                           AFTER UPDATE OF {column} ON {stickers} WHEN OLD.{column} != NEW.{column} 
+                           BEGIN {decrease} {increase} END;''')
+
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_users_insert AFTER INSERT ON {users} BEGIN
+                       UPDATE {table} SET value = value + 1 WHERE name = 'users';
+                       UPDATE {table} SET value = value + NEW.stickers_send_to WHERE name = 'stickers_send';
+                       END;''')
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_users_delete AFTER DELETE ON {users} BEGIN
+                       UPDATE {table} SET value = value - 1 WHERE name = 'users';
+                       UPDATE {table} SET value = value - OLD.stickers_send_to WHERE name = 'stickers_send';
+                       END;''')
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_users_update 
+                       AFTER UPDATE OF stickers_send_to ON {users} BEGIN
+                       UPDATE {table} SET value = value + NEW.stickers_send_to - OLD.stickers_send_to 
+                       WHERE name = 'stickers_send';
+                       END;''')
+
+    # Initial values
+    for name, query in aggregates.aggregates_queries.items():
+        connection.execute(f'INSERT OR REPLACE INTO {table} (name, value) VALUES (?, ({query}));', (name, ))
+
+
+def add_rollups(connection: sqlite3.Connection, db_filename: os.PathLike) -> None:
+    """Weekly and monthly rollups of daily stats for range analytics, filled with the existing days."""
+    analytics.create_rollup_tables(connection)
+    first_day, last_day = connection.execute(f'SELECT MIN(day), MAX(day) FROM {daily_statistics_tablename};').fetchone()
+    if first_day is not None:
+        analytics.roll_up(connection, first_day, last_day)
+        # Rolled up days are not rolled up again by the first close_days(), today is still open
+        yesterday = (datetime.date.fromisoformat(todays_date()) - datetime.timedelta(days=1)).isoformat()
+        analytics.set_closed_through(connection, min(last_day, yesterday))
+
+
+def normalize_emoji_codes(connection: sqlite3.Connection, db_filename: os.PathLike) -> None:
+    """Emoji codes of the stickers, saved before normalization, are folded the same way as new ones."""
+    stickers_db._renormalize_emoji(connection)
+
+
+# Migration number is its position in the list plus one
+migrations: list[Callable[[sqlite3.Connection, os.PathLike], None]] = [
+    create_base_tables,
+    index_stickers,
+    unique_daily_records,
+    add_aggregates,
+    add_rollups,
+    normalize_emoji_codes,
+]
+
+
+def get_version(db_filename: os.PathLike = db_name) -> int:
+    """Returns current schema version of the db.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        int: number of applied migrations.
+    """
+    return get_connection(db_filename).execute('PRAGMA user_version;').fetchone()[0]
+
+
+def migrate(db_filename: os.PathLike = db_name, target_version: int | None = None) -> int:
+    """Applies migrations, which are not applied yet. Is called on startup.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        target_version (int | None, optional): version to stop at. Defaults to the latest one.
+
+    Returns:
+        int: schema version after migration.
+    """
+    if target_version is None:
+        target_version = len(migrations)
+    # Get shared connection
+    connection = get_connection(db_filename)
+
+    version = get_version(db_filename)
+    while version < target_version:
+        migration = migrations[version]
+        # Write lock is taken at once, so that two processes do not migrate simultaneously
+        connection.execute('BEGIN IMMEDIATE;')
+        try:
+            # Another process could have migrated while waiting for the lock
+            if get_version(db_filename) == version:
+                migration(connection, db_filename)
+                connection.execute(f'PRAGMA user_version = {version + 1};')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            db_logger.exception(f'MIGRATIONS. Migration {version + 1} ({migration.__name__}) failed')
+            raise
+        version = get_version(db_filename)
+        db_logger.info(f'MIGRATIONS. Schema version is {version} ({migration.__name__})')
+
+    return version
@@ -0,0 +1,142 @@
+"""Known sticker sets cache.
+
+Set is known, when all its stickers were saved to db not longer than
+set_cache_ttl seconds ago. Known sets do not need to be requested from Telegram.
+"""
+
+import os, time
+
+import metrics
+from logs.log import db_logger
+from .connection import get_connection
+from .tablenames import known_sets_tablename, stickers_tablename, db_name
+
+
+# Seconds after which known set is requested again to collect new stickers. Defaults to a week
+set_cache_ttl = float(os.environ.get('SET_CACHE_TTL', default=7 * 24 * 60 * 60))
+
+# Set name -> time of the last check
+_checked_at: dict[str, float] = {}
+
+
+def create_known_sets_table(tablename: str = known_sets_tablename, db_filename: os.PathLike = db_name) -> None:
+    """Creates known sets table, if it doesn't exist.
+
+    Args:
+        tablename (str, optional): name of the table. Defaults to known_sets_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Create table and save changes
+    db_connection.execute(f'''CREATE TABLE IF NOT EXISTS {tablename}
+                          (setname TEXT PRIMARY KEY,
+                          checked_at REAL NOT NULL);''')
+    db_connection.commit()
+
+    db_logger.info(f'SETS CACHE. Table {tablename} is setup')
+
+
+def load_known_sets(tablename: str = known_sets_tablename, stickers_table: str = stickers_tablename,
+                    db_filename: os.PathLike = db_name) -> int:
+    """Loads known sets to memory. Sets, which are in stickers table, but were never
+    checked (f.e. collected before the cache appeared), are considered checked now.
+
+    Args:
+        tablename (str, optional): name of the table. Defaults to known_sets_tablename.
+        stickers_table (str, optional): name of stickers table. Defaults to stickers_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        int: number of known sets.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Back the cache by stickers table
+    with db_connection:
+        db_connection.execute(f'''INSERT OR IGNORE INTO {tablename} (setname, checked_at)
+                              SELECT DISTINCT setname, ? FROM {stickers_table};''', (time.time(), ))
+    rows = db_connection.execute(f'SELECT setname, checked_at FROM {tablename};').fetchall()
+
+    _checked_at.clear()
+    _checked_at.update(rows)
+
+    db_logger.info(f'SETS CACHE. {len(_checked_at)} known sets loaded')
+    return len(_checked_at)
+
+
+def refresh(tablename: str = known_sets_tablename, db_filename: os.PathLike = db_name) -> int:
+    """Reads the sets checked by other workers, which share the db.
+
+    Args:
+        tablename (str, optional): name of the table. Defaults to known_sets_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        int: number of known sets.
+    """
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    for setname, checked_at in db_connection.execute(f'SELECT setname, checked_at FROM {tablename};'):
+        if checked_at > _checked_at.get(setname, 0):
+            _checked_at[setname] = checked_at
+    return len(_checked_at)
+
+
+def export_state() -> dict[str, float]:
+    """Returns known sets with the time of their last check, f.e. for a snapshot."""
+    return dict(_checked_at)
+
+
+def restore_state(checked_at: dict[str, float], tablename: str = known_sets_tablename, db_filename: os.PathLike = db_name) -> int:
+    """Replaces known sets with exported ones and adds the sets checked after the export.
+
+    Args:
+        checked_at (dict[str, float]): known sets, returned by export_state().
+        tablename (str, optional): name of the table. Defaults to known_sets_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        int: number of known sets.
+    """
+    _checked_at.clear()
+    _checked_at.update(checked_at)
+    # Known sets table is small, unlike stickers table, which load_known_sets() reads
+    known_sets_num = refresh(tablename=tablename, db_filename=db_filename)
+
+    db_logger.info(f'SETS CACHE. {known_sets_num} known sets restored')
+    return known_sets_num
+
+
+def is_fresh(setname: str) -> bool:
+    """Checks if the set was checked recently, so it doesn't need to be requested again.
+
+    Args:
+        setname (str): name of the set.
+
+    Returns:
+        bool: True, if set is known and fresh.
+    """
+    checked_at = _checked_at.get(setname)
+    fresh = checked_at is not None and time.time() - checked_at < set_cache_ttl
+    metrics.count_cache_lookup('known_sets', fresh)
+    return fresh
+
+
+def mark_checked(setname: str, tablename: str = known_sets_tablename, db_filename: os.PathLike = db_name) -> None:
+    """Remembers that the set was requested and saved just now.
+
+    Args:
+        setname (str): name of the set.
+        tablename (str, optional): name of the table. Defaults to known_sets_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+    """
+    checked_at = time.time()
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Save check time
+    with db_connection:
+        db_connection.execute(f'''INSERT INTO {tablename} (setname, checked_at) VALUES (?, ?)
+                              ON CONFLICT(setname) DO UPDATE SET checked_at=excluded.checked_at;''',
+                              (setname, checked_at))
+    _checked_at[setname] = checked_at
@@ -0,0 +1,113 @@
+"""Snapshot of in-memory caches for fast start.
+
+Sticker index and known sets are saved to a file on shutdown and are read back on startup
+instead of scanning stickers table. The file is memory-mapped and decoded with marshal,
+so no copy of it is read to memory and no Python code runs per object.
+
+The snapshot is used only if it was made from the same db with the same schema and emoji
+normalization, and the last sticker in it is still in the db under the same rowid.
+Stickers are never deleted, so then the newer rows are simply added by sticker_index.refresh().
+"""
+
+import marshal, mmap, os, struct
+
+from logs.log import db_logger
+from . import migrations, sets_cache, sticker_index, stickers_db
+from .connection import get_connection
+from .tablenames import known_sets_tablename, stickers_tablename, db_name
+
+
+# Path to snapshot file, empty to always load caches from db
+snapshot_filepath = os.environ.get('CACHE_SNAPSHOT_PATH', default=f'{db_name}.snapshot')
+
+# Changed, when the layout of the snapshot changes
+SNAPSHOT_FORMAT = 1
+# Header length prefix, header is read before the large body is decoded
+_prefix = struct.Struct('<I')
+
+
+def _last_sticker(db_filename: os.PathLike, tablename: str, rowid: int) -> str | None:
+    row = get_connection(db_filename).execute(f'SELECT file_id FROM {tablename} WHERE rowid=?;', (rowid, )).fetchone()
+    return row[0] if row else None
+
+
+def _header(db_filename: os.PathLike, tablename: str, max_rowid: int) -> dict:
+    """Describes the db state, which the caches represent."""
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'db': os.path.realpath(db_filename),
+        'table': tablename,
+        'schema': migrations.get_version(db_filename),
+        'emoji_folding': sorted(stickers_db.emoji_folding),
+        'max_rowid': max_rowid,
+        'last_sticker': _last_sticker(db_filename, tablename, max_rowid),
+    }
+
+
+def save(filepath: os.PathLike | None = snapshot_filepath, db_filename: os.PathLike = db_name,
+         tablename: str = stickers_tablename) -> bool:
+    """Writes the loaded caches to the snapshot file. Is called on shutdown.
+
+    Args:
+        filepath (os.PathLike | None, optional): path to snapshot file. Defaults to snapshot_filepath.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of stickers table. Defaults to stickers_tablename.
+
+    Returns:
+        bool: True, if snapshot is written.
+    """
+    if not filepath or not sticker_index.is_loaded(db_filename, tablename):
+        return False
+    # Stickers saved by add_set are in the index already, but its last rowid is moved by refresh only
+    sticker_index.refresh(db_filename=db_filename, tablename=tablename)
+    index_state = sticker_index.export_state()
+    header = marshal.dumps(_header(db_filename, tablename, index_state['max_rowid']))
+    body = marshal.dumps({'sticker_index': index_state, 'known_sets': sets_cache.export_state()})
+
+    # Workers, which share the db, write their own temporary files, the last replace wins
+    tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+    with open(tmp_filepath, 'wb') as snapshot_file:
+        snapshot_file.write(_prefix.pack(len(header)))
+        snapshot_file.write(header)
+        snapshot_file.write(body)
+    os.replace(tmp_filepath, filepath)
+
+    db_logger.info(f'SNAPSHOT. {len(index_state["emoji"])} emoji and known sets saved, {len(header) + len(body)} bytes')
+    return True
+
+
+def load(filepath: os.PathLike | None = snapshot_filepath, db_filename: os.PathLike = db_name,
+         tablename: str = stickers_tablename, known_sets_table: str = known_sets_tablename) -> bool:
+    """Restores sticker index and known sets from the snapshot, if it matches the db,
+    and brings them up to date with the db.
+
+    Args:
+        filepath (os.PathLike | None, optional): path to snapshot file. Defaults to snapshot_filepath.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of stickers table. Defaults to stickers_tablename.
+        known_sets_table (str, optional): name of known sets table. Defaults to known_sets_tablename.
+
+    Returns:
+        bool: True, if caches are restored, False, if they must be loaded from db.
+    """
+    if not filepath:
+        return False
+    try:
+        with open(filepath, 'rb') as snapshot_file, mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                header_end = _prefix.size + _prefix.unpack_from(view)[0]
+                header = marshal.loads(view[_prefix.size:header_end])
+                if header != _header(db_filename, tablename, header.get('max_rowid', 0)):
+                    db_logger.info('SNAPSHOT. Snapshot does not match the db, caches are loaded from db')
+                    return False
+                body = marshal.loads(view[header_end:])
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, EOFError, TypeError, struct.error, AttributeError):
+        db_logger.warning(f'SNAPSHOT. Snapshot {filepath} is damaged, caches are loaded from db')
+        return False
+
+    sticker_index.restore_state(body['sticker_index'], db_filename=db_filename, tablename=tablename)
+    sticker_index.refresh(db_filename=db_filename, tablename=tablename)
+    sets_cache.restore_state(body['known_sets'], tablename=known_sets_table, db_filename=db_filename)
+    return True
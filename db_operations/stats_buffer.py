@@ -0,0 +1,139 @@
+"""Write-behind statistics counters.
+
+Counters of users and days are accumulated in memory and are written to db
+in a single transaction: on a timer, when too many updates are pending and on shutdown.
+Deltas are added to the stored values by upserts, so nothing is read before writing.
+"""
+
+import os, threading
+
+from logs.log import db_logger
+from . import analytics
+from .connection import get_connection, retry_locked
+from .date_func import todays_date
+from .tablenames import users_statistics_tablename, daily_statistics_tablename, db_name
+
+
+# Seconds between timer flushes
+flush_interval = float(os.environ.get('STATS_FLUSH_INTERVAL', default=10))
+# Number of pending updates, which causes immediate flush
+flush_threshold = int(os.environ.get('STATS_FLUSH_THRESHOLD', default=500))
+
+# Positions of the counters in delta lists
+COMMANDS, STICKERS, OTHER_MESSAGES = range(3)
+
+_lock = threading.Lock()
+_users: dict[int, list[int]] = {}  # user id -> counters deltas
+_last_usage: dict[int, str] = {}  # user id -> last usage date
+_days: dict[str, list[int]] = {}  # day -> counters deltas
+_pending = 0
+
+
+def record(user_id: int, counter: int) -> None:
+    """Adds 1 to the counter of the user and of today, and updates user last usage.
+    Never fails after the counter is added, so that callers, which repeat failed db calls,
+    don't count the update twice: failed flush keeps the deltas for the next one.
+
+    Args:
+        user_id (int): user TG ID.
+        counter (int): one of COMMANDS, STICKERS, OTHER_MESSAGES.
+    """
+    global _pending
+
+    day = todays_date()
+    with _lock:
+        _users.setdefault(user_id, [0, 0, 0])[counter] += 1
+        _last_usage[user_id] = day
+        _days.setdefault(day, [0, 0, 0])[counter] += 1
+        _pending += 1
+        flush_needed = _pending >= flush_threshold
+
+    if flush_needed:
+        # Only the flush transaction is repeated, if the db is locked
+        try:
+            retry_locked(flush)
+        except Exception:
+            pass  # deltas are restored and the error is logged by flush()
+
+
+def add_command_use(user_id: int) -> None:
+    """Counts command, received from user."""
+    record(user_id, COMMANDS)
+
+
+def add_sticker_send(user_id: int) -> None:
+    """Counts sticker, sent to user."""
+    record(user_id, STICKERS)
+
+
+def add_other_message(user_id: int) -> None:
+    """Counts other message, received from user."""
+    record(user_id, OTHER_MESSAGES)
+
+
+def _restore(users: dict[int, list[int]], last_usage: dict[int, str], days: dict[str, list[int]]) -> None:
+    """Returns not written deltas back to the buffer."""
+    global _pending
+
+    with _lock:
+        for deltas_from, deltas_to in ((users, _users), (days, _days)):
+            for key, deltas in deltas_from.items():
+                current = deltas_to.setdefault(key, [0, 0, 0])
+                for counter, delta in enumerate(deltas):
+                    current[counter] += delta
+        for user_id, day in last_usage.items():
+            _last_usage[user_id] = max(day, _last_usage.get(user_id, day))
+        _pending += sum(map(sum, users.values()))
+
+
+def flush(users_tablename: str = users_statistics_tablename, daily_tablename: str = daily_statistics_tablename,
+          db_filename: os.PathLike = db_name) -> int:
+    """Writes accumulated deltas to db in one transaction.
+
+    Args:
+        users_tablename (str, optional): name of users table. Defaults to users_statistics_tablename.
+        daily_tablename (str, optional): name of daily table. Defaults to daily_statistics_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        int: number of updates written.
+    """
+    global _users, _last_usage, _days, _pending
+
+    # Take the deltas, new updates are accumulated meanwhile
+    with _lock:
+        users, last_usage, days, pending = _users, _last_usage, _days, _pending
+        _users, _last_usage, _days, _pending = {}, {}, {}, 0
+    if not pending:
+        return 0
+
+    users_rows = [(user_id, last_usage[user_id], last_usage[user_id], *deltas) for user_id, deltas in users.items()]
+    days_rows = [(day, *deltas) for day, deltas in days.items()]
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    try:
+        with db_connection:
+            db_connection.executemany(f'''INSERT INTO {users_tablename}
+                                      (user_id, first_usage, last_usage, commands_use, stickers_send_to, other_messages)
+                                      VALUES (?, ?, ?, ?, ?, ?)
+                                      ON CONFLICT(user_id) DO UPDATE SET
+                                      last_usage=excluded.last_usage,
+                                      commands_use=commands_use + excluded.commands_use,
+                                      stickers_send_to=stickers_send_to + excluded.stickers_send_to,
+                                      other_messages=other_messages + excluded.other_messages;''', users_rows)
+            db_connection.executemany(f'''INSERT INTO {daily_tablename}
+                                      (day, commands_use, stickers_send, other_messages)
+                                      VALUES (?, ?, ?, ?)
+                                      ON CONFLICT(day) DO UPDATE SET
+                                      commands_use=commands_use + excluded.commands_use,
+                                      stickers_send=stickers_send + excluded.stickers_send,
+                                      other_messages=other_messages + excluded.other_messages;''', days_rows)
+            # Days, which are rolled up already, are rolled up again with the late stats
+            analytics.roll_up_late(db_connection, list(days))
+    except Exception:
+        _restore(users, last_usage, days)
+        db_logger.exception(f'STATS BUFFER. Flush of {pending} updates failed, they are kept in memory')
+        raise
+
+    db_logger.info(f'STATS BUFFER. {pending} updates of {len(users_rows)} users flushed')
+    return pending
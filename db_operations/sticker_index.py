@@ -0,0 +1,219 @@
+"""In-memory emoji -> sticker index.
+
+For every emoji code the index keeps a list of sets, which have stickers with it,
+and the stickers themselves grouped by set. Reply is chosen in constant time:
+random set except the excluded one, then random sticker from that set.
+When there is no such sticker, it is chosen for the most related emoji, see emoji_fallback.
+
+The index is loaded once on startup and then updated by stickers_db.add_set
+and, when several workers share the db, by refresh() with the stickers saved by the others.
+It is used from db thread only, so it doesn't need locks.
+"""
+
+import os, random, sys
+
+import metrics
+from logs.log import db_logger
+from . import emoji_fallback
+from .connection import get_connection
+from .tablenames import stickers_tablename, db_name
+
+
+class EmojiBucket:
+    """Stickers of a single emoji, grouped by set."""
+
+    __slots__ = ('sets', 'positions', 'stickers')
+
+    def __init__(self):
+        self.sets: list[str] = []  # set names
+        self.positions: dict[str, int] = {}  # set name -> position in sets
+        self.stickers: list[list[str]] = []  # file ids of each set, in the same order as sets
+
+    def add(self, file_id: str, setname: str) -> None:
+        position = self.positions.get(setname)
+        if position is None:
+            self.positions[setname] = len(self.sets)
+            self.sets.append(setname)
+            self.stickers.append([file_id])
+        elif file_id not in self.stickers[position]:
+            self.stickers[position].append(file_id)
+
+    def choose(self, except_set: str) -> str | None:
+        """Picks random sticker from any set but except_set without copying the lists."""
+        sets_num = len(self.sets)
+        excluded = self.positions.get(except_set)
+        if excluded is None:
+            position = random.randrange(sets_num)
+        elif sets_num == 1:
+            return None
+        else:
+            # Skip the excluded position
+            position = random.randrange(sets_num - 1)
+            if position >= excluded:
+                position += 1
+        return random.choice(self.stickers[position])
+
+
+# Emoji code -> its bucket
+_index: dict[str, EmojiBucket] = {}
+# (db file, table name) the index was loaded from, None if it wasn't loaded
+_source: tuple[str, str] | None = None
+# Stickers up to this rowid are in the index
+_max_rowid = 0
+
+
+def is_loaded(db_filename: os.PathLike = db_name, tablename: str = stickers_tablename) -> bool:
+    """Checks if the index represents the table.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of the table. Defaults to stickers_tablename.
+
+    Returns:
+        bool: True, if the index is loaded from this table.
+    """
+    return _source == (os.fspath(db_filename), tablename)
+
+
+def add_stickers(rows: list[tuple[str, str, str]]) -> None:
+    """Adds stickers to the index.
+
+    Args:
+        rows (list[tuple[str, str, str]]): stickers as (file id, emoji code, set name).
+    """
+    for file_id, emoji_code, setname in rows:
+        bucket = _index.get(emoji_code)
+        if bucket is None:
+            bucket = _index[emoji_code] = EmojiBucket()
+            emoji_fallback.add_covered(emoji_code)
+        bucket.add(file_id, setname)
+
+
+def load(db_filename: os.PathLike = db_name, tablename: str = stickers_tablename) -> int:
+    """Builds the index from stickers table.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of the table. Defaults to stickers_tablename.
+
+    Returns:
+        int: number of emoji in the index.
+    """
+    global _source, _max_rowid
+
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    # Rows added during the scan are taken once more by refresh(), which doesn't duplicate them
+    _max_rowid = db_connection.execute(f'SELECT MAX(rowid) FROM {tablename};').fetchone()[0] or 0
+    cursor = db_connection.execute(f'SELECT file_id, emoji, setname FROM {tablename};')
+
+    _index.clear()
+    emoji_fallback.reset()
+    add_stickers(cursor)
+    _source = (os.fspath(db_filename), tablename)
+
+    db_logger.info(f'STICKER INDEX. Index of {len(_index)} emoji is loaded')
+    return len(_index)
+
+
+def export_state() -> dict:
+    """Returns the index as plain lists and dicts, f.e. for a snapshot."""
+    # Set names are repeated in many buckets, interned ones are written once by marshal
+    return {'max_rowid': _max_rowid,
+            'emoji': {emoji_code: (list(map(sys.intern, bucket.sets)), bucket.stickers) for emoji_code, bucket in _index.items()}}
+
+
+def restore_state(state: dict, db_filename: os.PathLike = db_name, tablename: str = stickers_tablename) -> int:
+    """Replaces the index with exported one. Stickers saved after the export are added by refresh().
+
+    Args:
+        state (dict): index, returned by export_state().
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of the table. Defaults to stickers_tablename.
+
+    Returns:
+        int: number of emoji in the index.
+    """
+    global _source, _max_rowid
+
+    _index.clear()
+    emoji_fallback.reset()
+    for emoji_code, (sets, stickers) in state['emoji'].items():
+        bucket = _index[emoji_code] = EmojiBucket()
+        bucket.sets, bucket.stickers = sets, stickers
+        bucket.positions = {setname: position for position, setname in enumerate(sets)}
+        emoji_fallback.add_covered(emoji_code)
+    _max_rowid = state['max_rowid']
+    _source = (os.fspath(db_filename), tablename)
+
+    db_logger.info(f'STICKER INDEX. Index of {len(_index)} emoji is restored')
+    return len(_index)
+
+
+def get_max_rowid() -> int:
+    """Returns the last rowid of the table, which is in the index."""
+    return _max_rowid
+
+
+def refresh(db_filename: os.PathLike = db_name, tablename: str = stickers_tablename) -> int:
+    """Adds stickers, which were saved after the last load or refresh, f.e. by other workers.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of the table. Defaults to stickers_tablename.
+
+    Returns:
+        int: number of new rows.
+    """
+    global _max_rowid
+    if not is_loaded(db_filename, tablename):
+        return 0
+
+    # Get shared connection
+    db_connection = get_connection(db_filename)
+    rows = db_connection.execute(f'SELECT rowid, file_id, emoji, setname FROM {tablename} WHERE rowid > ?;',
+                                 (_max_rowid, )).fetchall()
+    if rows:
+        add_stickers(row[1:] for row in rows)
+        _max_rowid = max(row[0] for row in rows)
+        db_logger.info(f'STICKER INDEX. {len(rows)} new stickers added')
+    return len(rows)
+
+
+def choose(emoji_code: str, except_set: str) -> str | None:
+    """Chooses random sticker with the emoji from any set, but except_set.
+
+    Args:
+        emoji_code (str): demojized emoji.
+        except_set (str): set to skip.
+
+    Returns:
+        str | None: file id of the sticker, if found.
+    """
+    bucket = _index.get(emoji_code)
+    chosen = bucket.choose(except_set) if bucket is not None else None
+    metrics.count_cache_lookup('sticker_index', chosen is not None)
+    return chosen
+
+
+def choose_related(emoji_code: str, except_set: str) -> tuple[str | None, str | None]:
+    """Chooses random sticker with the emoji or, if there is none, with the most related emoji, which has one.
+
+    Args:
+        emoji_code (str): demojized emoji.
+        except_set (str): set to skip.
+
+    Returns:
+        tuple[str | None, str | None]: file id of the sticker, if found,
+            and the related emoji code, if the sticker is chosen for it.
+    """
+    chosen = choose(emoji_code, except_set)
+    if chosen is not None:
+        return chosen, None
+    for related_code in emoji_fallback.related(emoji_code):
+        chosen = _index[related_code].choose(except_set)
+        if chosen is not None:
+            metrics.count_cache_lookup('related_emoji', True)
+            return chosen, related_code
+    metrics.count_cache_lookup('related_emoji', False)
+    return None, None
@@ -1,12 +1,97 @@
-import sqlite3, os, random
+import os, random, sqlite3
 import emoji
 from aiogram import types
-from functools import partial
+from functools import lru_cache, partial
 
+import metrics
 from logs.log import db_logger
+from . import emoji_fallback, sticker_index
+from .connection import get_connection
 from .tablenames import stickers_tablename, db_name
 
 
+""" Emoji normalization """
+
+# Variants, which are folded to the base emoji, so that f.e. 👍🏽 and 👍 get the same code: 
+# 'skin_tone' and 'variation_selector', comma separated. Empty to keep the variants
+emoji_folding = {variant.strip() for variant in os.environ.get('EMOJI_FOLDING', default='skin_tone,variation_selector').split(',') 
+                 if variant.strip()}
+# Number of different emoji, which codes are remembered
+emoji_cache_size = int(os.environ.get('EMOJI_CACHE_SIZE', default=4096))
+
+SKIN_TONES = '\U0001F3FB\U0001F3FC\U0001F3FD\U0001F3FE\U0001F3FF'
+VARIATION_SELECTORS = '\uFE0E\uFE0F'
+# Characters, which are removed from emoji before decoding
+_folded_chars = {ord(char): None for variant, chars in (('skin_tone', SKIN_TONES), ('variation_selector', VARIATION_SELECTORS)) 
+                 if variant in emoji_folding for char in chars}
+
+
+@lru_cache(maxsize=emoji_cache_size)
+def normalize_emoji(sticker_emoji: str) -> str:
+    """Returns the code of sticker emoji, which stickers are matched by, f.e. ":thumbs_up:" for 👍🏽.
+    The same few hundred emoji come again and again, so the codes are cached.
+
+    Args:
+        sticker_emoji (str): emoji of the sticker.
+
+    Returns:
+        str: emoji code.
+    """
+    folded = sticker_emoji.translate(_folded_chars)
+    # Some sequences have no base form, f.e. people holding hands with different skin tones
+    if folded != sticker_emoji and emoji.is_emoji(sticker_emoji) and not emoji.is_emoji(folded):
+        folded = sticker_emoji
+    return emoji.demojize(folded)
+
+
+metrics.Gauge('bot_emoji_cache_hits', 'Emoji normalizations answered from cache', lambda: normalize_emoji.cache_info().hits)
+metrics.Gauge('bot_emoji_cache_misses', 'Emoji normalizations decoded anew', lambda: normalize_emoji.cache_info().misses)
+
+
+def warm_up() -> None:
+    """Builds the lookup tables, which emoji package and related emoji make on first use,
+    so that the first reply after start is as fast as the next ones."""
+    emoji.demojize('\N{THUMBS UP SIGN}')
+    emoji_fallback.warm_up()
+
+
+def _renormalize_emoji(connection: sqlite3.Connection, tablename: str = stickers_tablename) -> int:
+    """Recomputes emoji codes of saved stickers in the current transaction.
+
+    Returns:
+        int: number of changed codes.
+    """
+    codes = [row[0] for row in connection.execute(f'SELECT DISTINCT emoji FROM {tablename};')]
+    changed = 0
+    for code in codes:
+        new_code = normalize_emoji(emoji.emojize(code))
+        if new_code != code:
+            connection.execute(f'UPDATE {tablename} SET emoji=? WHERE emoji=?;', (new_code, code))
+            changed += 1
+    return changed
+
+
+def renormalize_emoji(db_filename: os.PathLike = db_name, tablename: str = stickers_tablename) -> int:
+    """Brings emoji codes of saved stickers to the current normalization, f.e. after EMOJI_FOLDING is changed.
+    Aggregates are kept by triggers, the index is reloaded.
+
+    Args:
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of the table in db. Defaults to stickers_tablename.
+
+    Returns:
+        int: number of changed codes.
+    """
+    # Get shared connection
+    connection = get_connection(db_filename)
+    with connection:
+        changed = _renormalize_emoji(connection, tablename)
+    if changed and sticker_index.is_loaded(db_filename, tablename):
+        sticker_index.load(db_filename, tablename)
+    db_logger.info(f'STICKERS DB. {changed} emoji codes renormalized')
+    return changed
+
+
 """ Database create, update and select """
 
 
@@ -20,7 +105,7 @@ def gather_sticker_data(sticker: types.Sticker) -> tuple[str, str, str]:
         tuple: (sticker id, sticker emoji code, sticker set name)
     """
     stick_id = sticker.file_id  # file id of the sticker 
-    stick_code = emoji.demojize(sticker.emoji)  # emoji code decoded, f.e. ":smiling face:"
+    stick_code = normalize_emoji(sticker.emoji)  # emoji code decoded, f.e. ":smiling face:"
     stick_set = sticker.set_name  # set name, which sticker belongs to
     return (stick_id, stick_code, stick_set)
 
@@ -32,15 +117,13 @@ def create_stickers_table(tablename: str = stickers_tablename, db_filename: os.P
         tablename (str, optional): name of the table in db. Defaults to stickers_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection 
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection 
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Create table 
     db_cursor.execute(f'CREATE TABLE IF NOT EXISTS {tablename} (file_id TEXT PRIMARY KEY, emoji TEXT NOT NULL, setname TEXT NOT NULL);')
     # Save changes 
     db_connection.commit()
-    # Close the connection
-    db_connection.close()
     db_logger.info(f'STICKERS DB. Table {tablename} is setup')
 
 
@@ -58,14 +141,12 @@ def check_sticker(sticker: types.Sticker, db_filename: os.PathLike = db_name,
     """
     # Get sticker's data
     received_emoji_id, received_emoji_code, received_emoji_set = gather_sticker_data(sticker)   
-    # Establish connection
-    connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    connection = get_connection(db_filename)
     cursor = connection.cursor()
     # Select matching data
     query_text = f'SELECT * FROM {tablename} WHERE file_id="{received_emoji_id}" OR (setname="{received_emoji_set}" AND emoji="{received_emoji_code}");'
     same_in_db = cursor.execute(query_text).fetchone()
-    # Close the connection
-    connection.close()
     # Return matching status 
     return same_in_db is None
 
@@ -81,31 +162,87 @@ def add_sticker(sticker: types.Sticker, db_filename: os.PathLike = db_name,
     """
     # Gather sticker's data
     received_emoji_id, received_emoji_code, received_emoji_set = gather_sticker_data(sticker)
-    # Establish the connection
-    connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    connection = get_connection(db_filename)
     cursor = connection.cursor()
     # Add new data and save changes 
     cursor.execute(f'INSERT INTO {tablename} VALUES ("{received_emoji_id}", "{received_emoji_code}", "{received_emoji_set}");')
     connection.commit()
-    # Close the connection
-    connection.close()
     
     db_logger.info(f'STICKERS DB. New sticker saved: from {received_emoji_set} for {received_emoji_code}')
 
 
-def add_set(*stickers: list) -> None:
-    """Adds a set of stickers to db. 
+def add_set(*stickers: list, db_filename: os.PathLike = db_name, tablename: str = stickers_tablename) -> int:
+    """Adds a set of stickers to db in a single transaction. 
+    Sticker is skipped, if its file id is in db already, or there is a sticker 
+    with the same emoji in the same set, the same way as check_sticker does.
 
     Args:
-        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
         *stickers (list): list of stickers to add. 
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        tablename (str, optional): name of the table in db. Defaults to stickers_tablename.
+
+    Returns:
+        int: number of new stickers saved.
     """
-    global db_name
-    for sticker in stickers:
-        if check_sticker(sticker=sticker, db_filename=db_name):
-            add_sticker(sticker=sticker, db_filename=db_name)
-        else:
-            continue
+    # Gather stickers' data once
+    rows = [(stick_id, stick_code, stick_set, stick_set, stick_code) 
+            for stick_id, stick_code, stick_set in map(gather_sticker_data, stickers)]
+    if not rows:
+        return 0
+    # Get shared connection
+    connection = get_connection(db_filename)
+    # Insert all new stickers at once and save changes
+    with connection:
+        cursor = connection.executemany(f'''INSERT OR IGNORE INTO {tablename} (file_id, emoji, setname) 
+                               SELECT ?, ?, ? WHERE NOT EXISTS 
+                               (SELECT 1 FROM {tablename} WHERE setname=? AND emoji=?);''', rows)
+    # Unlike total_changes, it doesn't count the rows written by the aggregates triggers
+    new_stickers_num = cursor.rowcount
+    
+    if new_stickers_num:
+        # Keep the index up to date with what was actually saved
+        if sticker_index.is_loaded(db_filename, tablename):
+            saved_sets = {row[2] for row in rows}
+            for saved_set in saved_sets:
+                saved_rows = connection.execute(f'SELECT file_id, emoji, setname FROM {tablename} WHERE setname=?;', 
+                                                (saved_set, )).fetchall()
+                sticker_index.add_stickers(saved_rows)
+        db_logger.info(f'STICKERS DB. New stickers saved: {new_stickers_num} from {rows[0][2]}')
+    return new_stickers_num
+
+
+def select_random_sticker(tablename: str = stickers_tablename, db_filename: os.PathLike = db_name, attempts: int = 8) -> str | None:
+    """Selects uniformly random sticker from the whole table without reading it. 
+    Random rowid between the smallest and the largest one is looked up by primary key, 
+    and the attempt is repeated, if there is no row with this rowid. Stickers are never deleted, 
+    so the rowids have no gaps and the first attempt almost always succeeds.
+    
+    Args:
+        tablename (str, optional): table name in db. Defaults to stickers_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+        attempts (int, optional): number of lookups before taking the next existing row. Defaults to 8.
+
+    Returns:
+        str | None: id of random sticker, if table is not empty.
+    """
+    # Get shared connection
+    connection = get_connection(db_filename)
+    # Separate subqueries, as SQLite reads the b-tree edge only for a single MIN or MAX in a query
+    min_rowid, max_rowid = connection.execute(f'SELECT (SELECT MIN(rowid) FROM {tablename}), '
+                                              f'(SELECT MAX(rowid) FROM {tablename});').fetchone()
+    if max_rowid is None:  # if table is empty
+        return None
+    
+    for _ in range(attempts):
+        answer = connection.execute(f'SELECT file_id FROM {tablename} WHERE rowid=?;', 
+                                    (random.randint(min_rowid, max_rowid), )).fetchone()
+        if answer is not None:
+            return answer[0]
+    # Too many gaps, the next existing row is slightly less uniform, but always found
+    answer = connection.execute(f'SELECT file_id FROM {tablename} WHERE rowid>=? ORDER BY rowid LIMIT 1;', 
+                                (random.randint(min_rowid, max_rowid), )).fetchone()
+    return answer[0]
 
 
 def select_reply(sticker_to_reply: types.Sticker, tablename: str = stickers_tablename, anything: bool = False, db_filename: os.PathLike = db_name) -> str | None:
@@ -119,19 +256,21 @@ def select_reply(sticker_to_reply: types.Sticker, tablename: str = stickers_tabl
     Returns:
         (str | None): id of sticker to reply with, if found.   
     """
-    # Establish connection
-    connection = sqlite3.connect(db_filename)
-    cursor = connection.cursor()
     # Define filters 
-    target_emoji = emoji.demojize(sticker_to_reply.emoji)
+    target_emoji = normalize_emoji(sticker_to_reply.emoji)
     except_set = sticker_to_reply.set_name
+    # Any sticker is chosen without reading the whole table
+    if anything == True:
+        return select_random_sticker(tablename=tablename, db_filename=db_filename)
+    # Use in-memory index, when it is loaded
+    if sticker_index.is_loaded(db_filename, tablename):
+        return sticker_index.choose(emoji_code=target_emoji, except_set=except_set)
+    
+    # Get shared connection
+    connection = get_connection(db_filename)
+    cursor = connection.cursor()
     # Apply all the filters and perform search
-    if anything == False:
-        possible_answers = cursor.execute(f'SELECT file_id FROM {tablename} WHERE emoji = "{target_emoji}" AND NOT setname="{except_set}"').fetchall()
-    else:
-        possible_answers = cursor.execute(f'SELECT file_id FROM {tablename}').fetchall()    
-    # Close the connection
-    connection.close()
+    possible_answers = cursor.execute(f'SELECT file_id FROM {tablename} WHERE emoji = "{target_emoji}" AND NOT setname="{except_set}"').fetchall()
     
     # Return result 
     try: 
@@ -140,6 +279,26 @@ def select_reply(sticker_to_reply: types.Sticker, tablename: str = stickers_tabl
     except IndexError:  # if nothing is found 
         return None
     
+
+
+def select_related_reply(sticker_to_reply: types.Sticker, tablename: str = stickers_tablename,
+                         db_filename: os.PathLike = db_name) -> tuple[str | None, str | None]:
+    """Selects random sticker as a reply, with the related emoji, if no other set has the same one.
+
+    Args:
+        sticker_to_reply (types.Sticker): sticker, which alternative must be found.
+        tablename (str, optional): table name in db. Defaults to stickers_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+
+    Returns:
+        tuple[str | None, str | None]: id of sticker to reply with, if found,
+            and the related emoji code, if the sticker has another emoji.
+    """
+    # Related emoji are known from the index only
+    if sticker_index.is_loaded(db_filename, tablename):
+        return sticker_index.choose_related(emoji_code=normalize_emoji(sticker_to_reply.emoji),
+                                            except_set=sticker_to_reply.set_name)
+    return select_reply(sticker_to_reply, tablename=tablename, db_filename=db_filename), None
     
 """ Statistics """
 
@@ -154,13 +313,11 @@ def count_unique(value: str, tablename: str = stickers_tablename, db_filename: o
     Returns:
         int: number of unique items.
     """
-    # Establish connection
-    connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    connection = get_connection(db_filename)
     cursor = connection.cursor()
     # Perform select
     selected_items = cursor.execute(f'SELECT {value} FROM {tablename}').fetchall()
-    # Close the connection
-    connection.close()
     # Count unique sets
     unique_num = len(set(selected_items))
     
@@ -9,5 +9,10 @@ dotenv.load_dotenv()
 stickers_tablename = 'stickers'
 users_statistics_tablename = 'users_stats'
 daily_statistics_tablename = 'daily_stats'
+known_sets_tablename = 'known_sets'
+aggregates_tablename = 'aggregates'
+weekly_statistics_tablename = 'weekly_stats'
+monthly_statistics_tablename = 'monthly_stats'
+rollup_state_tablename = 'rollup_state'
 
 db_name = os.path.abspath(os.environ.get('DB_NAME', default='data/database.db'))
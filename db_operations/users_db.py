@@ -1,10 +1,11 @@
 """User activity stats"""
 
-import sqlite3, os
+import os
 from functools import partial
 
 from logs.log import db_logger
 from .date_func import todays_date
+from .connection import get_connection
 from .tablenames import users_statistics_tablename, db_name
 
 
@@ -15,8 +16,8 @@ def create_userstats_table(tablename: str = users_statistics_tablename, db_filen
         tablename (str, optional): name of the table. Defaults to users_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Create table 
     db_cursor.execute(f'''CREATE TABLE IF NOT EXISTS {tablename} 
@@ -28,31 +29,29 @@ def create_userstats_table(tablename: str = users_statistics_tablename, db_filen
                       other_messages INT DEFAULT 0);''')
     # Save changes 
     db_connection.commit()
-    # Close the connection
-    db_connection.close()
     
     db_logger.info(f'USERS DB. Table {tablename} is setup')
 
     
 def add_user_on_start(user_id: int, tablename: str = users_statistics_tablename, db_filename: os.PathLike = db_name):
     """Adds a row of user to table and sets both first and last usages to today's date. 
+    Existing user is left as is, so that workers, which get /start of the same user at once, do not race.
 
     Args:
         user_id (int): user ID from TG.
         tablename (str, optional): name of the table. Defaults to users_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
-    # Add a record
-    db_cursor.execute(f'''INSERT INTO {tablename} (user_id, first_usage, last_usage)
-                      VALUES ({user_id}, "{todays_date()}", "{todays_date()}")''')
+    # Add a record, unless there is one
+    db_cursor.execute(f'''INSERT INTO {tablename} (user_id, first_usage, last_usage) VALUES (?, ?, ?)
+                      ON CONFLICT(user_id) DO NOTHING;''', (user_id, todays_date(), todays_date()))
     db_connection.commit()
-    # Close connection 
-    db_connection.close()
     
-    db_logger.info(f'USERS DB. User creation')
+    if db_cursor.rowcount:
+        db_logger.info(f'USERS DB. User creation')
     
 
 def user_exists(user_id: int, tablename: str = users_statistics_tablename, db_filename: os.PathLike = db_name) -> bool:
@@ -66,13 +65,11 @@ def user_exists(user_id: int, tablename: str = users_statistics_tablename, db_fi
     Returns:
         bool: True, if exists. 
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     # Add a record
     result = db_cursor.execute(f'''SELECT * FROM {tablename} WHERE user_id={user_id}''').fetchall()
-    # Close connection 
-    db_connection.close()
     # Generate result
     if len(result) == 1:
         return True
@@ -93,8 +90,8 @@ def update_user_record(user_id: int, column_name: str, new_value: int | str, tab
         tablename (str, optional): name or the table. Defaults to users_statistics_tablename.
         db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     
     # Update the data
@@ -103,13 +100,21 @@ def update_user_record(user_id: int, column_name: str, new_value: int | str, tab
     db_cursor.execute(f'''UPDATE {tablename} SET {column_name}={new_value} WHERE user_id={user_id};''')
     db_connection.commit()
     
-    # Close connection 
-    db_connection.close()
     
     db_logger.info(f'USERS DB. User record update: {column_name} is set to {new_value}')
 
 
-update_last_usage = partial(update_user_record, column_name='last_usage', new_value=todays_date())
+def update_last_usage(user_id: int, tablename: str = users_statistics_tablename, db_filename: os.PathLike = db_name) -> None:
+    """Sets user last usage to today's date.
+
+    Args:
+        user_id (int): user TG ID.
+        tablename (str, optional): name of the table. Defaults to users_statistics_tablename.
+        db_filename (os.PathLike, optional): path to db file. Defaults to db_name.
+    """
+    update_user_record(user_id, column_name='last_usage', new_value=todays_date(), tablename=tablename, db_filename=db_filename)
+
+
 update_commands_count = partial(update_user_record, column_name='commands_use')
 update_stickers_count = partial(update_user_record, column_name='stickers_send_to')
 update_other_messages_count = partial(update_user_record, column_name='other_messages')
@@ -127,15 +132,13 @@ def get_user_value(user_id: int, column_name: str, tablename: str = users_statis
     Returns:
         int | str: current value of the specified column.
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     
     # Update the data
     result = db_cursor.execute(f'''SELECT {column_name} FROM {tablename} WHERE user_id={user_id};''').fetchone()
     
-    # Close connection 
-    db_connection.close()
     
     return result[0]
 
@@ -197,15 +200,13 @@ def count_users(tablename: str = users_statistics_tablename, db_filename: os.Pat
     Returns:
         int: number of users. 
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     
     # Gather data 
     users = db_cursor.execute(f'''SELECT * FROM {tablename}''').fetchall()
     
-    # Close connection 
-    db_connection.close()
     
     return len(users)
     
@@ -221,14 +222,12 @@ def count_stickers(column_name: str = 'stickers_send_to', tablename: str = users
     Returns:
         int: result. 
     """
-    # Establish connection
-    db_connection = sqlite3.connect(db_filename)
+    # Get shared connection
+    db_connection = get_connection(db_filename)
     db_cursor = db_connection.cursor()
     
     # Update the data
     result = db_cursor.execute(f'''SELECT SUM({column_name}) FROM {tablename}''').fetchone()
     
-    # Close connection 
-    db_connection.close()
     
     return result[0]
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""Outbound messages delivery.
+
+Every message to a user goes through the delivery scheduler, which keeps the sending rate
+under Telegram limits with a global and per chat token buckets, waits as long as Telegram
+asks on flood control (RetryAfter) and retries transient failures with jittered backoff.
+Files to upload are kept as paths or bytes, and every attempt sends a new InputFile,
+as the request closes the file it has sent.
+"""
+
+import asyncio, io, os, random, time
+from dataclasses import dataclass, field
+from typing import Any
+
+import aiohttp
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import NetworkError, RestartingTelegram, RetryAfter
+
+from logs.log import activity_logger
+
+
+# Messages per second to all chats and to a single chat, according to Telegram limits
+global_rate = float(os.environ.get('SEND_GLOBAL_RATE', default=30))
+chat_rate = float(os.environ.get('SEND_CHAT_RATE', default=1))
+# Messages, which can be sent to a chat at once, f.e. notification and sticker
+chat_burst = int(os.environ.get('SEND_CHAT_BURST', default=3))
+# Attempts after transient failures and flood control
+max_retries = int(os.environ.get('SEND_MAX_RETRIES', default=5))
+# Number of concurrent requests to Telegram
+send_workers = int(os.environ.get('SEND_WORKERS', default=8))
+
+# Backoff after transient failure: base * 2 ** attempt, but not more than the cap, from 50% to 100% of it
+backoff_base = 0.5
+backoff_cap = 30
+
+TRANSIENT_ERRORS = (NetworkError, RestartingTelegram, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class TokenBucket:
+    """Token bucket with reservations: a token can be taken in advance, the caller waits for it."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Takes a token.
+
+        Returns:
+            float: seconds to wait until the token is available.
+        """
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Makes the next token available not earlier than in the given seconds."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    @property
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+def upload_source(upload: InputFile) -> tuple[str | os.PathLike | bytes, str | None]:
+    """Returns the path or the content of the file to upload and its name.
+    The file is closed by the request, which sends it, so a retry needs a new InputFile made of them.
+
+    Args:
+        upload (InputFile): file to upload.
+
+    Returns:
+        tuple[str | os.PathLike | bytes, str | None]: path or content, and file name.
+    """
+    if upload._path is not None:
+        upload.file.close()
+        return upload._path, upload.filename
+    with upload.file:
+        content = upload.file.getvalue() if isinstance(upload.file, io.BytesIO) else upload.file.read()
+    return content, upload.filename
+
+
+@dataclass
+class Delivery:
+    method: str
+    chat_id: int | str
+    kwargs: dict
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.monotonic)
+    attempt: int = 0
+    # Argument name -> path or content, and name of the file to upload
+    uploads: dict[str, tuple[str | os.PathLike | bytes, str | None]] = field(default_factory=dict)
+
+    def call_kwargs(self) -> dict:
+        """Returns the arguments of the call with new InputFile for every upload."""
+        if not self.uploads:
+            return self.kwargs
+        files = {name: InputFile(io.BytesIO(source) if isinstance(source, bytes) else source, filename=filename)
+                 for name, (source, filename) in self.uploads.items()}
+        return {**self.kwargs, **files}
+
+
+class DeliveryScheduler:
+    """Queue of outbound Bot API calls, processed by several workers under rate limits."""
+
+    # Number of chat buckets, after which the full (idle) ones are dropped
+    max_chat_buckets = 10_000
+
+    def __init__(self, bot, global_rate: float = global_rate, chat_rate: float = chat_rate,
+                 chat_burst: int = chat_burst, max_retries: int = max_retries, workers: int = send_workers):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.workers_num = workers
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._retries: set[asyncio.TimerHandle] = set()
+        # Metrics
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of deliveries, waiting for a worker or for a retry."""
+        return (self._queue.qsize() if self._queue is not None else 0) + len(self._retries)
+
+    @property
+    def delay_mean(self) -> float:
+        """Mean seconds from enqueuing to successful delivery."""
+        return self.delay_total / self.sent if self.sent else 0.0
+
+    def metrics(self) -> dict[str, float]:
+        return {'queue_depth': self.queue_depth, 'sent': self.sent, 'retried': self.retried, 'failed': self.failed,
+                'delay_mean': self.delay_mean, 'delay_max': self.delay_max}
+
+    def start(self) -> None:
+        """Starts workers. Is called on startup, or on the first send."""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers_num)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Waits for queued deliveries and stops workers. Is called on shutdown.
+
+        Args:
+            timeout (float, optional): seconds to wait for the queue. Defaults to 10.
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            activity_logger.warning(f'{self.queue_depth} deliveries are dropped on shutdown')
+        for worker in self._workers:
+            worker.cancel()
+        for retry in self._retries:
+            retry.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._queue, self._workers = None, []
+        self._retries.clear()
+
+    async def send(self, method: str, chat_id: int | str, **kwargs) -> Any:
+        """Queues Bot API call and waits for its result.
+
+        Args:
+            method (str): name of the bot method, f.e. 'send_message'.
+            chat_id (int | str): target chat.
+            **kwargs: other method arguments.
+
+        Returns:
+            Any: result of the call.
+        """
+        self.start()
+        # Files from URL are streamed, they are not kept for retries
+        uploads = {name: upload_source(value) for name, value in kwargs.items()
+                   if isinstance(value, InputFile) and isinstance(value.file, io.IOBase)}
+        kwargs = {name: value for name, value in kwargs.items() if name not in uploads}
+        delivery = Delivery(method=method, chat_id=chat_id, kwargs=kwargs, uploads=uploads,
+                            future=asyncio.get_running_loop().create_future())
+        self._queue.put_nowait(delivery)
+        return await delivery.future
+
+    async def send_message(self, chat_id: int | str, **kwargs) -> Any:
+        return await self.send('send_message', chat_id, **kwargs)
+
+    async def send_sticker(self, chat_id: int | str, **kwargs) -> Any:
+        return await self.send('send_sticker', chat_id, **kwargs)
+
+    async def send_document(self, chat_id: int | str, **kwargs) -> Any:
+        return await self.send('send_document', chat_id, **kwargs)
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chat_buckets:
+                self.chat_buckets = {chat: bucket for chat, bucket in self.chat_buckets.items() if not bucket.is_full}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+        return bucket
+
+    def _retry_later(self, delivery: Delivery, delay: float) -> None:
+        """Puts delivery back to the queue after delay, without holding a worker."""
+        def requeue():
+            self._retries.discard(handle)
+            self._queue.put_nowait(delivery)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retries.add(handle)
+        self.retried += 1
+
+    async def _work(self) -> None:
+        while True:
+            delivery = await self._queue.get()
+            try:
+                await self._deliver(delivery)
+            except Exception:
+                # Failure of a single delivery must not stop the worker
+                activity_logger.exception(f'{delivery.method} to {delivery.chat_id} failed unexpectedly')
+                if not delivery.future.done():
+                    delivery.future.set_exception(RuntimeError('Delivery failed unexpectedly'))
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, delivery: Delivery) -> None:
+        if delivery.future.done():  # f.e. sender was cancelled
+            return
+        wait = max(self.global_bucket.reserve(), self._chat_bucket(delivery.chat_id).reserve())
+        if wait:
+            await asyncio.sleep(wait)
+
+        try:
+            result = await getattr(self.bot, delivery.method)(chat_id=delivery.chat_id, **delivery.call_kwargs())
+        except RetryAfter as error:
+            # Nothing is sent to the chat until Telegram allows
+            self._chat_bucket(delivery.chat_id).pause(error.timeout)
+            self._fail_or_retry(delivery, error, delay=error.timeout)
+        except TRANSIENT_ERRORS as error:
+            backoff = min(backoff_cap, backoff_base * 2 ** delivery.attempt)
+            self._fail_or_retry(delivery, error, delay=backoff * random.uniform(0.5, 1))
+        except Exception as error:
+            self.failed += 1
+            # Sender may be cancelled, while the request is in flight
+            if not delivery.future.done():
+                delivery.future.set_exception(error)
+        else:
+            delay = time.monotonic() - delivery.enqueued
+            self.sent += 1
+            self.delay_total += delay
+            self.delay_max = max(self.delay_max, delay)
+            if not delivery.future.done():
+                delivery.future.set_result(result)
+
+    def _fail_or_retry(self, delivery: Delivery, error: Exception, delay: float) -> None:
+        delivery.attempt += 1
+        if delivery.attempt > self.max_retries:
+            self.failed += 1
+            activity_logger.warning(f'{delivery.method} to {delivery.chat_id} failed after {self.max_retries} retries: {error}')
+            if not delivery.future.done():
+                delivery.future.set_exception(error)
+        elif not delivery.future.done():
+            self._retry_later(delivery, delay)
@@ -0,0 +1,146 @@
+"""Message texts in the language of the user.
+
+Templates are read and prepared once: texts with placeholders are split into parts in advance.
+Resolved locale of each user is cached, so it is found once per user and language,
+and unsupported locales are reported to improvements log not more often than once in a while.
+"""
+
+import json, os, string, time
+from collections import OrderedDict
+from typing import Any
+
+from aiogram import types
+
+import metrics
+from logs.log import improvements_logger
+
+
+templates_filepath = os.path.abspath('data/message_templates.json')
+default_locale = 'en'
+# Number of users, whose locales are cached
+locale_cache_size = int(os.environ.get('LOCALE_CACHE_SIZE', default=10_000))
+# Seconds between reports of the same unsupported locale
+unsupported_report_interval = float(os.environ.get('UNSUPPORTED_LOCALE_REPORT_INTERVAL', default=60 * 60))
+
+
+class Template:
+    """Text with positional {} placeholders, split into literal parts once."""
+
+    __slots__ = ('text', 'parts', 'fields_num')
+
+    def __init__(self, text: str):
+        self.text = text
+        parsed = list(string.Formatter().parse(text))
+        self.fields_num = sum(field is not None for _, field, _, _ in parsed)
+        # Only plain {} placeholders are prepared, others are formatted with str.format
+        if all(field in (None, '') and not spec and conversion is None for _, field, spec, conversion in parsed):
+            # (literal text, if it is followed by a placeholder)
+            self.parts = [(literal, field is not None) for literal, field, _, _ in parsed]
+        else:
+            self.parts = None
+
+    def format(self, *values: Any) -> str:
+        if self.parts is None:
+            return self.text.format(*values)
+        if len(values) < self.fields_num:
+            raise IndexError(f'Template expects {self.fields_num} values, {len(values)} given')
+        result = []
+        values_iter = iter(values)
+        for literal, has_field in self.parts:
+            result.append(literal)
+            if has_field:
+                result.append(str(next(values_iter)))
+        return ''.join(result)
+
+
+class LocaleResolver:
+    """Finds the texts in the language of the user."""
+
+    def __init__(self, templates: dict[str, dict[str, str]], default: str = default_locale,
+                 cache_size: int = locale_cache_size, report_interval: float = unsupported_report_interval):
+        self.texts = templates
+        self.templates = {locale: {key: Template(text) for key, text in texts.items()}
+                          for locale, texts in templates.items()}
+        self.default = default
+        self.cache_size = cache_size
+        self.report_interval = report_interval
+        self._cache: OrderedDict[int, tuple[str | None, str]] = OrderedDict()  # user id -> (language code, locale)
+        self._reported: dict[str, tuple[float, int]] = {}  # locale -> (last report time, suppressed reports)
+
+    @classmethod
+    def from_file(cls, filepath: os.PathLike = templates_filepath, **kwargs) -> 'LocaleResolver':
+        with open(filepath) as templates_file:
+            return cls(json.load(templates_file), **kwargs)
+
+    def _match(self, language_code: str | None) -> str:
+        """Matches language code of TG user to a supported locale, f.e. 'ru-RU' to 'ru'."""
+        if not language_code:
+            return self.default
+        code = language_code.replace('-', '_')
+        for candidate in (code, code.split('_')[0].lower()):
+            if candidate in self.texts:
+                return candidate
+        self._report_unsupported(language_code)
+        return self.default
+
+    def _report_unsupported(self, language_code: str) -> None:
+        now = time.monotonic()
+        reported_at, suppressed = self._reported.get(language_code, (None, 0))
+        if reported_at is not None and now - reported_at < self.report_interval:
+            self._reported[language_code] = (reported_at, suppressed + 1)
+            return
+        repeats = f' ({suppressed} more times since last report)' if suppressed else ''
+        improvements_logger.info(f'As {language_code} is not a supported locale, {self.default} locale was turned on{repeats}')
+        self._reported[language_code] = (now, 0)
+
+    def resolve(self, user: types.User) -> str:
+        """Returns locale of the user.
+
+        Args:
+            user (types.User): message sender.
+
+        Returns:
+            str: supported locale.
+        """
+        language_code = user.language_code
+        cached = self._cache.get(user.id)
+        if cached is not None and cached[0] == language_code:
+            metrics.count_cache_lookup('locale', True)
+            self._cache.move_to_end(user.id)
+            return cached[1]
+        metrics.count_cache_lookup('locale', False)
+
+        locale = self._match(language_code)
+        self._cache[user.id] = (language_code, locale)
+        self._cache.move_to_end(user.id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return locale
+
+    def text(self, user: types.User, key: str) -> str:
+        """Returns the text in the language of the user.
+
+        Args:
+            user (types.User): message sender.
+            key (str): name of the text in templates, f.e. 'help'.
+
+        Returns:
+            str: text.
+        """
+        return self.texts[self.resolve(user)][key]
+
+    def format(self, user: types.User, key: str, *values: Any) -> str:
+        """Returns the text in the language of the user with values put into placeholders.
+
+        Args:
+            user (types.User): message sender.
+            key (str): name of the template, f.e. 'stats'.
+            *values (Any): values for placeholders.
+
+        Returns:
+            str: formatted text.
+        """
+        return self.templates[self.resolve(user)][key].format(*values)
+
+
+locale_resolver = LocaleResolver.from_file()
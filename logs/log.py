@@ -1,31 +1,120 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import random
 
 formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
 
-def setup_logger(name: str, filepath: os.PathLike, level: int | str = logging.INFO):
-    """Returns logger that is setup to use. 
+# Size based rotation: max size of a log file in bytes and number of old files to keep
+log_max_bytes = int(os.environ.get('LOG_MAX_BYTES', default=10 * 1024 * 1024))
+log_backup_count = int(os.environ.get('LOG_BACKUP_COUNT', default=5))
+# Time based rotation instead of size based, f.e. 'midnight'. Empty to rotate by size
+log_rotate_when = os.environ.get('LOG_ROTATE_WHEN', default='')
+# Worker processes write the same files, then none of them rotates the files, as rotations would race
+log_shared_by_workers = int(os.environ.get('BOT_WORKERS', default=1)) > 1
+# Share of db info lines to write, warnings and errors are always written
+db_log_sample_rate = float(os.environ.get('DB_LOG_SAMPLE_RATE', default=1))
+
+
+class SamplingFilter(logging.Filter):
+    """Passes only a share of records below warning level."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class RoutingHandler(logging.Handler):
+    """Passes records to the file handler of their logger."""
+
+    def __init__(self):
+        super().__init__()
+        self.handlers: dict[str, logging.Handler] = {}
+
+    def handle(self, record: logging.LogRecord) -> None:
+        handler = self.handlers.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+    def close(self) -> None:
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+# Loggers only put records to the queue, files are written by the listener thread
+log_queue = queue.SimpleQueue()
+router = RoutingHandler()
+listener = logging.handlers.QueueListener(log_queue, router)
+
+
+def create_file_handler(filepath: os.PathLike) -> logging.Handler:
+    """Returns rotating file handler, or appending one, if several workers write the file.
 
     Args:
-        name (str): logger name. 
-        filepath (os.Pathlike): path to file to write logs. 
-        level (int | str, optional): level of logging. Defaults to logging.INFO.
+        filepath (os.PathLike): path to file to write logs.
 
     Returns:
-        _type_: _description_
+        logging.Handler: handler, which writes to the file.
     """
-    # Setup handler
-    handler = logging.FileHandler(filepath)
+    if log_shared_by_workers:
+        # Records of every process are appended, files are rotated outside, f.e. by logrotate with copytruncate
+        handler = logging.FileHandler(filepath, encoding='utf-8')
+    elif log_rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(filepath, when=log_rotate_when, backupCount=log_backup_count,
+                                                            encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(filepath, maxBytes=log_max_bytes, backupCount=log_backup_count,
+                                                       encoding='utf-8')
     handler.setFormatter(formatter)
-    # Setup logger 
+    return handler
+
+
+def setup_logger(name: str, filepath: os.PathLike, level: int | str = logging.INFO, sample_rate: float = 1):
+    """Returns logger that is setup to use.
+    Logger doesn't write to the file itself, the file is written in the background.
+
+    Args:
+        name (str): logger name.
+        filepath (os.Pathlike): path to file to write logs.
+        level (int | str, optional): level of logging. Defaults to logging.INFO.
+        sample_rate (float, optional): share of records below warning to write. Defaults to 1.
+
+    Returns:
+        logging.Logger: logger to use.
+    """
+    # Setup file handler in the listener
+    router.handlers[name] = create_file_handler(filepath)
+    # Setup logger
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    # Add handler to logger 
+    # Add queue handler to logger
+    handler = logging.handlers.QueueHandler(log_queue)
+    if sample_rate < 1:
+        handler.addFilter(SamplingFilter(sample_rate))
     logger.addHandler(handler)
-    # Return the logger 
+    # Start writing, if not started yet
+    if listener._thread is None:
+        listener.start()
+    # Return the logger
     return logger
 
+
+def stop_logging() -> None:
+    """Writes queued records and closes the files. Is called on shutdown."""
+    if listener._thread is not None:
+        listener.stop()
+        router.close()
+
+
+atexit.register(stop_logging)
+
 # Loggers to use
 activity_logger = setup_logger(name='activity_logger', filepath=os.path.abspath('logs/activity.log'))
-db_logger = setup_logger(name='db_logger', filepath=os.path.abspath('logs/db.log'))
-improvements_logger = setup_logger(name='improve_logger', filepath=os.path.abspath('logs/improvements.log'))
\ No newline at end of file
+db_logger = setup_logger(name='db_logger', filepath=os.path.abspath('logs/db.log'), sample_rate=db_log_sample_rate)
+improvements_logger = setup_logger(name='improve_logger', filepath=os.path.abspath('logs/improvements.log'))
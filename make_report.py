@@ -1,14 +1,150 @@
-from db_operations import stickers_db, daily_db, date_func
+import glob, hashlib, json, os, tempfile, zipfile
+
+from db_operations import aggregates, analytics, daily_db, date_func
+
+
+# Lengths in days of the periods in the report, each is compared to the previous one
+report_periods = [7, 30]
 
 
 def collect_stats() -> str:
     stickers_sent_today = daily_db.get_stickers_send(day=date_func.todays_date())
-    total_packs = stickers_db.count_sets()
+    total_packs = aggregates.get_value('sets')
     
     report_text = f'REPORT\n\nStickers sent today: {stickers_sent_today}\nTotal sets count: {total_packs}'
+    for days in report_periods:
+        report_text += '\n\n' + analytics.format_stats(analytics.last_days_stats(days))
     return report_text
 
 
 filepaths = ['logs/activity.log', 'logs/db.log', 'logs/improvements.log']
-filenames = [f'ActivityLog{date_func.todays_date()}.log', f'DBLog{date_func.todays_date()}.log', f'ImprovementLog{date_func.todays_date()}.log']
-file_captions = ['Activity logs', 'Database logs', 'Improvements logs']
\ No newline at end of file
+# Names of the logs in the archive, date is added on packing
+log_names = ['ActivityLog', 'DBLog', 'ImprovementLog']
+# Where positions of already sent log parts are kept between reports
+offsets_filepath = os.environ.get('REPORT_OFFSETS_PATH', default='logs/report_offsets.json')
+
+CHUNK_SIZE = 1024 * 1024
+# Bytes at the start of log file, which identify it together with inode, as inodes of removed files are reused
+HEAD_SIZE = 128
+
+
+def read_offsets(filepath: os.PathLike = offsets_filepath) -> dict[str, dict[str, int]]:
+    """Returns log path -> inode, head hash and size of the log file, up to which it was sent."""
+    try:
+        with open(filepath) as offsets_file:
+            return json.load(offsets_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def commit_offsets(offsets: dict[str, dict[str, int]], filepath: os.PathLike = offsets_filepath) -> None:
+    """Saves the positions, up to which logs are sent. Is called after the archive is delivered."""
+    saved = read_offsets(filepath)
+    saved.update(offsets)
+    tmp_filepath = f'{filepath}.tmp'
+    with open(tmp_filepath, 'w') as offsets_file:
+        json.dump(saved, offsets_file)
+    os.replace(tmp_filepath, filepath)
+
+
+def log_files(filepath: os.PathLike) -> list[str]:
+    """Returns the log file and its rotated copies (`activity.log.1`, `activity.log.2024-01-01`), oldest first."""
+    paths = [path for path in glob.glob(f'{glob.escape(filepath)}.*') if os.path.isfile(path)]
+    # Size based copies are numbered from the newest one, time based ones are named by date
+    suffix = lambda path: path.rpartition('.')[2]
+    paths.sort(key=lambda path: (-int(suffix(path)), '') if suffix(path).isdigit() else (0, suffix(path)))
+    if os.path.isfile(filepath):
+        paths.append(filepath)
+    return paths
+
+
+def file_head(log_file, size: int) -> str:
+    """Returns hash of the first bytes of the file, up to size."""
+    log_file.seek(0)
+    return hashlib.sha1(log_file.read(min(HEAD_SIZE, size))).hexdigest()
+
+
+def new_log_segments(filepath: os.PathLike, sent: dict[str, int] | None) -> tuple[list[tuple], dict[str, int] | None]:
+    """Finds the parts of the log, which were written after the sent position.
+
+    File, which was current at the last report, is found by inode among rotated copies,
+    so the lines written before its rotation are not lost, and the newer files are taken whole.
+
+    Args:
+        filepath (os.PathLike): path to log file.
+        sent (dict[str, int] | None): inode and size of the file, up to which the log was sent.
+
+    Returns:
+        tuple[list[tuple], dict[str, int] | None]: (opened file, start, end) parts, oldest first,
+            and the position to save after sending.
+    """
+    opened = []
+    for path in log_files(filepath):
+        try:
+            log_file = open(path, 'rb')
+        except FileNotFoundError:  # removed by rotation just now
+            continue
+        # Size is fixed now, lines written later are sent next time
+        stat = os.fstat(log_file.fileno())
+        opened.append((log_file, stat.st_ino, stat.st_size))
+
+    # The file sent last time, if it is still kept
+    sent_position = None
+    if sent is not None:
+        for position, (log_file, inode, size) in enumerate(opened):
+            if inode == sent['inode'] and sent['offset'] <= size and file_head(log_file, sent['offset']) == sent.get('head'):
+                sent_position = position
+    segments = []
+    for position, (log_file, _, size) in enumerate(opened):
+        if sent_position is not None and position < sent_position:
+            log_file.close()
+        else:
+            segments.append((log_file, sent['offset'] if position == sent_position else 0, size))
+
+    if not opened:
+        return segments, sent
+    current_file, current_inode, current_size = opened[-1]
+    return segments, {'inode': current_inode, 'offset': current_size, 'head': file_head(current_file, current_size)}
+
+
+def pack_new_logs(archive_dir: os.PathLike | None = None) -> tuple[str | None, dict[str, dict[str, int]]]:
+    """Compresses the log parts written since the last sent report into one zip archive.
+    Logs are copied to the archive by chunks, so they are never read to memory whole.
+
+    Args:
+        archive_dir (os.PathLike | None, optional): directory for the archive. Defaults to None, temporary directory.
+
+    Returns:
+        tuple[str | None, dict[str, dict[str, int]]]: path to archive, None if there is nothing new,
+            and positions to commit with commit_offsets() after the archive is sent.
+    """
+    sent_offsets = read_offsets()
+    new_offsets = {}
+    archive_fd, archive_path = tempfile.mkstemp(prefix='logs', suffix='.zip', dir=archive_dir)
+    new_bytes = 0
+    with os.fdopen(archive_fd, 'wb') as archive_file, zipfile.ZipFile(archive_file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for filepath, log_name in zip(filepaths, log_names):
+            segments, new_offsets[filepath] = new_log_segments(filepath, sent_offsets.get(filepath))
+            if new_offsets[filepath] is None:
+                del new_offsets[filepath]
+            if not any(end > start for _, start, end in segments):
+                for log_file, _, _ in segments:
+                    log_file.close()
+                continue
+            with archive.open(f'{log_name}{date_func.todays_date()}.log', 'w') as entry:
+                for log_file, start, end in segments:
+                    with log_file:
+                        log_file.seek(start)
+                        left = end - start
+                        while left > 0:
+                            chunk = log_file.read(min(CHUNK_SIZE, left))
+                            if not chunk:
+                                break
+                            entry.write(chunk)
+                            left -= len(chunk)
+                            new_bytes += len(chunk)
+
+    if not new_bytes:
+        os.remove(archive_path)
+        return None, new_offsets
+    return archive_path, new_offsets
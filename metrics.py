@@ -0,0 +1,236 @@
+"""Bot metrics in Prometheus text format.
+
+Counters and histograms are updated from the event loop and from db thread,
+and are served over local HTTP endpoint at /metrics, if METRICS_PORT is set.
+"""
+
+import asyncio, functools, os, threading, time
+from contextlib import contextmanager
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiohttp import web
+
+from logs.log import activity_logger
+from workers import worker_index
+
+
+metrics_host = os.environ.get('METRICS_HOST', default='127.0.0.1')
+# Port of metrics endpoint, 0 to disable it. Each worker listens on the next port
+metrics_port = int(os.environ.get('METRICS_PORT', default=0))
+metrics_port = metrics_port + worker_index if metrics_port else 0
+# Seconds between event loop lag checks
+loop_lag_interval = 0.5
+
+# Upper bounds of latency histograms buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels_text(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{_labels_text(key)} {value}' for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """Value, which is read from the function on every scrape."""
+    type = 'gauge'
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.func = func
+
+    def samples(self) -> list[str]:
+        return [f'{self.name} {self.func()}']
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[position] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes duration of the with block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, values in self._values.items():
+                for bound, bucket_count in zip(self.buckets, values):
+                    lines.append(f'{self.name}_bucket{_labels_text(key + (("le", bound), ))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_labels_text(key + (("le", "+Inf"), ))} {values[-1]}')
+                lines.append(f'{self.name}_sum{_labels_text(key)} {values[-2]}')
+                lines.append(f'{self.name}_count{_labels_text(key)} {values[-1]}')
+        return lines
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    """Returns all the metrics in Prometheus text format."""
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+# Metrics of the bot parts
+handler_latency = Histogram('bot_handler_seconds', 'Time of handling an update')
+handler_updates = Counter('bot_handler_updates_total', 'Handled updates by result')
+db_latency = Histogram('bot_db_operation_seconds', 'Time of db operation in db thread')
+db_operations = Counter('bot_db_operations_total', 'Db operations by result')
+db_lock_retries = Counter('bot_db_lock_retries_total', 'Db operations repeated, because db was locked')
+api_latency = Histogram('bot_api_request_seconds', 'Time of Bot API request')
+api_requests = Counter('bot_api_requests_total', 'Bot API requests by result')
+cache_requests = Counter('bot_cache_requests_total', 'Cache lookups by result')
+loop_lag = Histogram('bot_event_loop_lag_seconds', 'Delay of event loop callbacks')
+
+
+def instrument_handler(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """Decorator, which measures handler time and counts its results."""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            result = await handler(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            handler_latency.observe(time.perf_counter() - started, handler=handler.__name__)
+            handler_updates.inc(handler=handler.__name__, status=status)
+
+    return wrapper
+
+
+def observe_db_call(operation: str, func: Callable, *args, **kwargs):
+    """Calls the db function and records its time and result. Is called in db thread."""
+    status = 'error'
+    started = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        status = 'ok'
+        return result
+    finally:
+        db_latency.observe(time.perf_counter() - started, operation=operation)
+        db_operations.inc(operation=operation, status=status)
+
+
+def count_cache_lookup(cache: str, hit: bool) -> None:
+    cache_requests.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+class InstrumentedBot(Bot):
+    """Bot, which measures every Bot API request. Result is 'ok' or the name of the error."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            result = await super().request(method, data, files, **kwargs)
+            status = 'ok'
+            return result
+        except Exception as error:
+            status = type(error).__name__
+            raise
+        finally:
+            api_latency.observe(time.perf_counter() - started, method=method)
+            api_requests.inc(method=method, status=status)
+
+
+async def monitor_loop_lag(interval: float = loop_lag_interval) -> None:
+    """Measures how late the loop wakes up after sleep, which is the time callbacks wait for the loop."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+_runner: web.AppRunner | None = None
+_lag_task: asyncio.Task | None = None
+
+
+async def start(host: str = metrics_host, port: int = metrics_port) -> None:
+    """Starts loop lag monitoring and metrics endpoint, if port is set. Is called on startup."""
+    global _runner, _lag_task
+    _lag_task = asyncio.create_task(monitor_loop_lag())
+    if not port:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    activity_logger.info(f'Metrics are served at http://{host}:{port}/metrics')
+
+
+async def stop() -> None:
+    """Stops metrics endpoint and monitoring. Is called on shutdown."""
+    global _runner, _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
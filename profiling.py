@@ -0,0 +1,222 @@
+"""On-demand profiling of the running bot.
+
+Profiler is attached to the event loop thread only for the requested time
+or number of processed updates, so it covers the dispatcher, handlers and
+everything else the loop runs, and costs nothing while it is not running.
+Two modes are supported:
+- deterministic: cProfile, exact call counts, but slows down every call;
+- sampling: stacks of the loop thread are read by a separate thread every
+  few milliseconds, overhead doesn't depend on the number of calls.
+"""
+
+import asyncio, cProfile, io, os, pstats, sys, threading, time
+from collections import Counter
+from types import FrameType
+from typing import Callable
+
+from logs.log import activity_logger
+
+
+# Limit of profiling time, also when profiling for a number of updates
+profile_max_seconds = float(os.environ.get('PROFILE_MAX_SECONDS', default=300))
+# Seconds between stack samples in sampling mode
+sampling_interval = float(os.environ.get('PROFILE_SAMPLING_INTERVAL', default=0.005))
+# Functions in each table of the report
+report_lines = 60
+
+MODES = ('deterministic', 'sampling')
+USAGE = ('/profile [N[s|u]] [deterministic|sampling]\n'
+         'N seconds (s, default) or N processed updates (u), f.e. /profile 30s or /profile 500u sampling')
+
+
+_running = False
+
+
+def is_running() -> bool:
+    return _running
+
+
+def parse_options(args: str) -> dict:
+    """Parses /profile command arguments.
+
+    Args:
+        args (str): text after the command.
+
+    Raises:
+        ValueError: if arguments are wrong.
+
+    Returns:
+        dict: seconds, updates and mode for profile().
+    """
+    options = {'seconds': 30.0, 'updates': None, 'mode': 'deterministic'}
+    for arg in args.split():
+        arg = arg.lower()
+        if arg in MODES:
+            options['mode'] = arg
+        elif arg.endswith('u'):
+            options['seconds'], options['updates'] = profile_max_seconds, int(arg[:-1])
+        else:
+            options['seconds'] = float(arg.removesuffix('s'))
+    if options['seconds'] <= 0 or (options['updates'] is not None and options['updates'] <= 0):
+        raise ValueError('Profiling length must be positive')
+    options['seconds'] = min(options['seconds'], profile_max_seconds)
+    return options
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})'
+
+
+class Sampler:
+    """Reads stacks of the thread with the interval from a background thread.
+
+    Args:
+        thread_id (int): identifier of the thread to sample.
+        interval (float): seconds between samples.
+    """
+
+    def __init__(self, thread_id: int, interval: float = sampling_interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            # Root first, as in collapsed stacks format
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def report(self) -> str:
+        """Returns functions by own and total samples and the collapsed stacks for flame graph tools."""
+        total = sum(self.stacks.values())
+        if not total:
+            return 'No samples collected'
+        own, inclusive = Counter(), Counter()
+        for stack, samples in self.stacks.items():
+            own[stack[-1]] += samples
+            for name in set(stack):
+                inclusive[name] += samples
+
+        lines = [f'{total} samples every {self.interval * 1000:g} ms', '']
+        for title, counter in (('Own samples', own), ('Total samples', inclusive)):
+            lines.append(f'{title}:')
+            lines.extend(f'{samples:8d} {samples / total:7.2%}  {name}' for name, samples in counter.most_common(report_lines))
+            lines.append('')
+        lines.append('Collapsed stacks:')
+        lines.extend(f'{";".join(stack)} {samples}' for stack, samples in self.stacks.most_common())
+        return '\n'.join(lines)
+
+
+def _cprofile_report(profiler: cProfile.Profile) -> str:
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    for sort_key in ('cumulative', 'tottime'):
+        stats.sort_stats(sort_key).print_stats(report_lines)
+    return output.getvalue()
+
+
+class Session:
+    """Running profiler of the event loop thread. Is created by try_start()."""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        if mode == 'sampling':
+            self.profiler = Sampler(threading.get_ident())
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            # Fails, if another profiler is attached to the thread
+            self.profiler.enable()
+        self.started = time.monotonic()
+
+    async def run(self, seconds: float, updates: int | None = None, processed: Callable[[], int] | None = None) -> str:
+        """Profiles for the time or until the number of updates is processed, then stops the profiler.
+
+        Args:
+            seconds (float): seconds to profile, limit of time, if updates are set.
+            updates (int | None, optional): number of updates to profile. Defaults to None.
+            processed (Callable[[], int] | None, optional): returns number of processed updates,
+                required if updates are set. Defaults to None.
+
+        Returns:
+            str: report text.
+        """
+        global _running
+        first_update = processed() if processed is not None else 0
+        try:
+            if updates is None:
+                await asyncio.sleep(seconds - (time.monotonic() - self.started))
+            else:
+                target = first_update + updates
+                while processed() < target and time.monotonic() - self.started < seconds:
+                    await asyncio.sleep(0.1)
+        finally:
+            if self.mode == 'sampling':
+                self.profiler.stop()
+            else:
+                self.profiler.disable()
+            _running = False
+
+        duration = time.monotonic() - self.started
+        activity_logger.info(f'Profiling ({self.mode}) finished after {duration:.1f} s')
+        header = f'Profile ({self.mode}) of {duration:.1f} s'
+        if processed is not None:
+            header += f', {processed() - first_update} updates processed'
+        report = self.profiler.report() if self.mode == 'sampling' else _cprofile_report(self.profiler)
+        return f'{header}\n\n{report}'
+
+
+def try_start(mode: str = 'deterministic') -> Session | None:
+    """Starts profiling, unless it is running. Check and start happen without a switch of the event loop,
+    so two commands can't both start it.
+
+    Args:
+        mode (str, optional): 'deterministic' or 'sampling'. Defaults to 'deterministic'.
+
+    Returns:
+        Session | None: started session, None if profiling is already running.
+    """
+    global _running
+    if _running:
+        return None
+    session = Session(mode)
+    _running = True
+    activity_logger.info(f'Profiling ({mode}) started')
+    return session
+
+
+async def profile(seconds: float, updates: int | None = None, mode: str = 'deterministic',
+                  processed: Callable[[], int] | None = None) -> str:
+    """Profiles the event loop thread for the time or until the number of updates is processed.
+
+    Args:
+        seconds (float): seconds to profile, limit of time, if updates are set.
+        updates (int | None, optional): number of updates to profile. Defaults to None.
+        mode (str, optional): 'deterministic' or 'sampling'. Defaults to 'deterministic'.
+        processed (Callable[[], int] | None, optional): returns number of processed updates,
+            required if updates are set. Defaults to None.
+
+    Raises:
+        RuntimeError: if profiling is already running.
+
+    Returns:
+        str: report text.
+    """
+    session = try_start(mode)
+    if session is None:
+        raise RuntimeError('Profiling is already running')
+    return await session.run(seconds, updates=updates, processed=processed)
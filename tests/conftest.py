@@ -0,0 +1,19 @@
+"""Fixtures shared by the tests."""
+
+import pytest
+
+from db_operations import connection, migrations
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Path to a new db file, connections to it are closed after the test."""
+    yield tmp_path / 'test.db'
+    connection.close_connections()
+
+
+@pytest.fixture
+def db_filename(db_path):
+    """Empty db of the latest schema."""
+    migrations.migrate(db_filename=db_path)
+    return db_path
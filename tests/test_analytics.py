@@ -0,0 +1,82 @@
+"""Rollups of daily stats stay equal to the daily records, also when stats come after a day is closed."""
+
+import datetime
+
+import pytest
+
+from db_operations import analytics, connection, date_func, migrations, stats_buffer
+from db_operations.tablenames import daily_statistics_tablename, weekly_statistics_tablename, monthly_statistics_tablename
+
+
+class FixedDay:
+    def __init__(self, day: str):
+        self.today = day
+
+    def day(self, now: float | None = None) -> str:
+        return self.today
+
+
+@pytest.fixture
+def today(monkeypatch):
+    fixed_day = FixedDay('2024-02-11')
+    monkeypatch.setattr(date_func, 'current_day', fixed_day)
+    return fixed_day
+
+
+@pytest.fixture
+def db_filename(db_path, today):
+    # History is written before rollups appear
+    migrations.migrate(db_filename=db_path, target_version=migrations.migrations.index(migrations.add_rollups))
+    db_connection = connection.get_connection(db_path)
+    first_day = datetime.date(2024, 1, 1)
+    with db_connection:
+        db_connection.executemany(f'INSERT INTO {daily_statistics_tablename} (day, commands_use, stickers_send, other_messages) '
+                                  'VALUES (?, ?, ?, ?);',
+                                  (((first_day + datetime.timedelta(days=number)).isoformat(), number, 2 * number, 1)
+                                   for number in range(41)))
+    migrations.migrate(db_filename=db_path)
+    return db_path
+
+
+def daily_totals(db_filename, start: str, end: str) -> dict[str, int]:
+    sums = ', '.join(f'COALESCE(SUM({counter}), 0)' for counter in analytics.COUNTERS)
+    row = connection.get_connection(db_filename).execute(
+        f'SELECT {sums} FROM {daily_statistics_tablename} WHERE day BETWEEN ? AND ?;', (start, end)).fetchone()
+    return dict(zip(analytics.COUNTERS, row))
+
+
+def rollup_total(db_filename, tablename: str) -> int:
+    return connection.get_connection(db_filename).execute(f'SELECT SUM(stickers_send) FROM {tablename};').fetchone()[0]
+
+
+def test_migration_closes_rolled_up_days(db_filename):
+    # The last day of history is yesterday, so it is closed, today is not
+    assert analytics.get_closed_through(db_filename) == '2024-02-10'
+    assert analytics.range_totals('2024-01-01', '2024-02-10', db_filename=db_filename) == \
+        daily_totals(db_filename, '2024-01-01', '2024-02-10')
+
+
+def test_late_stats_are_rolled_up(db_filename, today):
+    # Stats are buffered before midnight and flushed after the day is closed
+    today.today = '2024-02-10'
+    for user_id in range(5):
+        stats_buffer.add_sticker_send(user_id)
+    today.today = '2024-02-11'
+    stats_buffer.flush(db_filename=db_filename)
+
+    expected = daily_totals(db_filename, '2024-01-01', '2024-02-10')
+    assert analytics.range_totals('2024-01-01', '2024-02-10', db_filename=db_filename) == expected
+    assert rollup_total(db_filename, monthly_statistics_tablename) == daily_totals(db_filename, '2024-01-01', '2024-02-29')['stickers_send']
+    assert rollup_total(db_filename, weekly_statistics_tablename) == daily_totals(db_filename, '2024-01-01', '2024-02-11')['stickers_send']
+
+
+@pytest.mark.parametrize('start, end', [('2024-01-01', '2024-02-11'), ('2024-01-03', '2024-01-29'),
+                                        ('2024-01-15', '2024-02-05'), ('2024-02-10', '2024-02-11')])
+def test_range_totals_match_daily_records(db_filename, start, end):
+    assert analytics.range_totals(start, end, db_filename=db_filename) == daily_totals(db_filename, start, end)
+
+
+def test_longest_last_days_range(db_filename):
+    stats = analytics.last_days_stats(analytics.max_range_days, db_filename=db_filename)
+    assert stats['days'] == analytics.max_range_days
+    assert stats['totals'] == daily_totals(db_filename, stats['start'], stats['end'])
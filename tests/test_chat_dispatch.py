@@ -0,0 +1,87 @@
+"""Order of updates within a chat, also when new updates wait for free space."""
+
+import asyncio
+
+from chat_dispatch import ChatDispatcher
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=10))
+
+
+def test_chat_order_with_concurrent_chats():
+    async def scenario():
+        dispatcher = ChatDispatcher(max_concurrency=4)
+        handled = []
+
+        async def handle(chat_id, number):
+            await asyncio.sleep(0.01 * (3 - number))
+            handled.append((chat_id, number))
+
+        for number in range(3):
+            for chat_id in (1, 2):
+                await dispatcher.submit(chat_id, handle, chat_id, number)
+        await dispatcher.wait_closed()
+        return dispatcher, handled
+
+    dispatcher, handled = run(scenario())
+    for chat_id in (1, 2):
+        assert [number for chat, number in handled if chat == chat_id] == [0, 1, 2]
+    assert dispatcher.pending == 0 and dispatcher.processed == 6
+
+
+def test_waiting_update_is_not_overtaken_by_newer_one():
+    async def scenario():
+        dispatcher = ChatDispatcher(max_pending=1)
+        release = asyncio.Event()
+        handled, submits = [], []
+
+        async def handle(text):
+            handled.append(text)
+
+        async def first(text):
+            await release.wait()
+            handled.append(text)
+            # Newer update of chat 1 comes, when the place of this one is about to be free
+            submits.append(asyncio.create_task(dispatcher.submit(1, handle, 'A2')))
+
+        await dispatcher.submit(2, first, 'X')
+        # Older update of chat 1 waits for free space
+        submits.append(asyncio.create_task(dispatcher.submit(1, handle, 'A1')))
+        await asyncio.sleep(0.01)
+        release.set()
+        while len(submits) < 2:
+            await asyncio.sleep(0)
+        await asyncio.gather(*submits)
+        await dispatcher.wait_closed()
+        return dispatcher, handled
+
+    dispatcher, handled = run(scenario())
+    assert handled == ['X', 'A1', 'A2']
+    assert dispatcher.pending == 0
+
+
+def test_cancelled_waiter_does_not_block_others():
+    async def scenario():
+        dispatcher = ChatDispatcher(max_pending=1)
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(text):
+            if text == 'X':
+                await release.wait()
+            handled.append(text)
+
+        await dispatcher.submit(1, handle, 'X')
+        cancelled = asyncio.create_task(dispatcher.submit(2, handle, 'cancelled'))
+        waiting = asyncio.create_task(dispatcher.submit(3, handle, 'B'))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        release.set()
+        await waiting
+        await dispatcher.wait_closed()
+        return dispatcher, handled
+
+    dispatcher, handled = run(scenario())
+    assert handled == ['X', 'B']
+    assert dispatcher.pending == 0
@@ -0,0 +1,162 @@
+"""Delivery scheduler against a stub bot: results, flood control, retries and cancellation."""
+
+import asyncio, io, time
+
+import pytest
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import BadRequest, NetworkError, RetryAfter
+
+import delivery
+from delivery import DeliveryScheduler
+
+
+class StubBot:
+    """Records sent messages. Errors, queued for a chat, are raised instead of sending, one per call."""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.sent: list[tuple[float, int, str]] = []
+        self.errors: dict[int, list[Exception]] = {}
+
+    async def send_message(self, chat_id: int, text: str):
+        await asyncio.sleep(self.latency)
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+        return text
+
+    async def send_document(self, chat_id: int, document: InputFile, caption: str = ''):
+        # Like aiohttp, the file is read and closed, before the answer comes
+        with document.file:
+            content = document.file.read().decode()
+        return await self.send_message(chat_id, f'{document.filename}: {content}')
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=10))
+
+
+def test_sends_and_returns_result():
+    async def scenario():
+        bot = StubBot()
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100)
+        results = await asyncio.gather(*(sender.send_message(chat_id=chat, text=f'm{chat}') for chat in range(5)))
+        await sender.stop()
+        return bot, sender, results
+
+    bot, sender, results = run(scenario())
+    assert results == [f'm{chat}' for chat in range(5)]
+    assert len(bot.sent) == 5
+    assert sender.sent == 5 and sender.failed == 0
+
+
+def test_retry_after_pauses_chat_and_retries():
+    async def scenario():
+        bot = StubBot()
+        bot.errors[1] = [RetryAfter(1)]
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100, chat_burst=10)
+        started = time.monotonic()
+        results = await asyncio.gather(sender.send_message(chat_id=1, text='first'),
+                                       sender.send_message(chat_id=2, text='other chat'))
+        await sender.stop()
+        return bot, sender, results, started
+
+    bot, sender, results, started = run(scenario())
+    assert results == ['first', 'other chat']
+    sent_at = {text: at - started for at, _, text in bot.sent}
+    # Only the chat under flood control waits
+    assert sent_at['first'] >= 1
+    assert sent_at['other chat'] < 0.5
+    assert sender.retried == 1 and sender.failed == 0
+
+
+def test_transient_errors_are_retried_until_limit(monkeypatch):
+    monkeypatch.setattr(delivery, 'backoff_base', 0.01)
+
+    async def scenario():
+        bot = StubBot()
+        bot.errors[1] = [NetworkError('timeout')]
+        bot.errors[2] = [NetworkError('timeout')] * 3
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100, max_retries=2)
+        recovered = await sender.send_message(chat_id=1, text='recovered')
+        with pytest.raises(NetworkError):
+            await sender.send_message(chat_id=2, text='lost')
+        await sender.stop()
+        return sender, recovered
+
+    sender, recovered = run(scenario())
+    assert recovered == 'recovered'
+    assert sender.failed == 1
+
+
+def test_permanent_error_is_raised_without_retries():
+    async def scenario():
+        bot = StubBot()
+        bot.errors[1] = [BadRequest('Chat not found')]
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100)
+        with pytest.raises(BadRequest):
+            await sender.send_message(chat_id=1, text='lost')
+        await sender.stop()
+        return sender
+
+    sender = run(scenario())
+    assert sender.retried == 0 and sender.failed == 1
+
+
+@pytest.mark.parametrize('from_path', [True, False])
+@pytest.mark.parametrize('error', [NetworkError('timeout'), RetryAfter(1)])
+def test_retried_upload_is_sent_again(monkeypatch, tmp_path, from_path, error):
+    monkeypatch.setattr(delivery, 'backoff_base', 0.01)
+    if from_path:
+        filepath = tmp_path / 'logs.txt'
+        filepath.write_text('new logs')
+        document = InputFile(path_or_bytesio=str(filepath), filename='logs.txt')
+    else:
+        document = InputFile(path_or_bytesio=io.BytesIO(b'new logs'), filename='logs.txt')
+
+    async def scenario():
+        bot = StubBot()
+        bot.errors[1] = [error]
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100)
+        result = await sender.send_document(chat_id=1, document=document, caption='New logs')
+        await sender.stop()
+        return sender, result
+
+    sender, result = run(scenario())
+    assert result == 'logs.txt: new logs'
+    assert sender.retried == 1 and sender.failed == 0
+
+
+@pytest.mark.parametrize('error', [None, BadRequest('Chat not found'), NetworkError('timeout')])
+def test_cancelled_sender_does_not_stop_worker(monkeypatch, error):
+    monkeypatch.setattr(delivery, 'backoff_base', 0.01)
+
+    async def scenario():
+        bot = StubBot(latency=0.05)
+        if error is not None:
+            bot.errors[1] = [error]
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100, workers=1)
+        cancelled = asyncio.create_task(sender.send_message(chat_id=1, text='cancelled'))
+        await asyncio.sleep(0.01)  # request is in flight
+        cancelled.cancel()
+        # The single worker must still deliver the next messages
+        result = await sender.send_message(chat_id=2, text='next')
+        await sender.stop()
+        return result
+
+    assert run(scenario()) == 'next'
+
+
+def test_stop_waits_for_queued_deliveries():
+    async def scenario():
+        bot = StubBot()
+        sender = DeliveryScheduler(bot, global_rate=100, chat_rate=100)
+        tasks = [asyncio.create_task(sender.send_message(chat_id=1, text=str(number))) for number in range(3)]
+        await asyncio.sleep(0)
+        await sender.stop()
+        return bot, await asyncio.gather(*tasks)
+
+    bot, results = run(scenario())
+    assert results == ['0', '1', '2']
+    assert [text for _, _, text in bot.sent] == ['0', '1', '2']
@@ -0,0 +1,37 @@
+"""Related emoji share meaningful words and never are the opposite of the emoji asked."""
+
+import pytest
+
+from db_operations import emoji_fallback
+
+
+@pytest.fixture
+def covered():
+    emoji_fallback.reset()
+    yield emoji_fallback.add_covered
+    emoji_fallback.reset()
+
+
+@pytest.mark.parametrize('emoji_code, other_code', [(':thumbs_down:', ':thumbs_up:'), (':blue_heart:', ':red_heart:'),
+                                                    (':slightly_frowning_face:', ':slightly_smiling_face:'),
+                                                    (':down_arrow:', ':up_arrow:'), (':red_circle:', ':red_heart:')])
+def test_contrary_or_modifier_only_emoji_are_not_related(emoji_code, other_code):
+    assert emoji_fallback.similarity(emoji_code, other_code) == 0
+    assert emoji_fallback.similarity(other_code, emoji_code) == 0
+
+
+@pytest.mark.parametrize('emoji_code, other_code', [(':grinning_cat:', ':grinning_face:'), (':blue_heart:', ':beating_heart:'),
+                                                    (':thumbs_up_dark_skin_tone:', ':thumbs_up:')])
+def test_similar_emoji_are_related(emoji_code, other_code):
+    assert emoji_fallback.similarity(emoji_code, other_code) >= emoji_fallback.min_similarity
+
+
+def test_related_skips_opposites(covered):
+    covered(':thumbs_up:')
+    covered(':red_heart:')
+    assert emoji_fallback.related(':thumbs_down:') == []
+    assert emoji_fallback.related(':blue_heart:') == []
+    # Emoji covered later is found for the emoji asked before
+    covered(':beating_heart:')
+    assert emoji_fallback.related(':blue_heart:') == [':beating_heart:']
+    assert emoji_fallback.related(':thumbs_up_medium_skin_tone:') == [':thumbs_up:']
@@ -0,0 +1,27 @@
+"""Only one profiling runs at a time, also when two commands come at once."""
+
+import asyncio
+
+import pytest
+
+import profiling
+
+
+@pytest.mark.parametrize('mode', profiling.MODES)
+def test_second_start_is_refused_until_finished(mode):
+    async def scenario():
+        session = profiling.try_start(mode)
+        assert session is not None and profiling.is_running()
+        # Second command before the first profiling task runs
+        assert profiling.try_start(mode) is None
+        with pytest.raises(RuntimeError):
+            await profiling.profile(0.01, mode=mode)
+        report = await session.run(0.05)
+        assert not profiling.is_running()
+        return report
+
+    report = asyncio.run(scenario())
+    assert report.startswith(f'Profile ({mode})')
+    session = profiling.try_start(mode)
+    assert session is not None
+    asyncio.run(session.run(0))
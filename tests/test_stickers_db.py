@@ -0,0 +1,65 @@
+"""Distribution of the random fallback sticker, which is picked by rowid lookups."""
+
+import math, random
+from collections import Counter
+
+from db_operations import connection, stickers_db
+from db_operations.tablenames import stickers_tablename
+
+
+def chi_square_limit(degrees: int, z: float = 3.09) -> float:
+    """Critical chi-square value for p = 0.001 (z of the normal distribution), Wilson-Hilferty approximation."""
+    return degrees * (1 - 2 / (9 * degrees) + z * math.sqrt(2 / (9 * degrees))) ** 3
+
+
+def chi_square(counts: Counter, expected: float) -> float:
+    return sum((count - expected) ** 2 / expected for count in counts.values())
+
+
+def fill(db_filename, stickers: int) -> None:
+    db_connection = connection.get_connection(db_filename)
+    with db_connection:
+        db_connection.executemany(f'INSERT INTO {stickers_tablename} (file_id, emoji, setname) VALUES (?, ?, ?);',
+                                  ((f'sticker{number}', ':dog:', f'set{number // 10}') for number in range(stickers)))
+
+
+def delete(db_filename, file_ids: list[str]) -> None:
+    db_connection = connection.get_connection(db_filename)
+    with db_connection:
+        db_connection.executemany(f'DELETE FROM {stickers_tablename} WHERE file_id=?;', ((file_id, ) for file_id in file_ids))
+
+
+def draw(db_filename, draws: int) -> Counter:
+    random.seed(0)
+    return Counter(stickers_db.select_random_sticker(db_filename=db_filename) for _ in range(draws))
+
+
+def test_empty_table(db_filename):
+    assert stickers_db.select_random_sticker(db_filename=db_filename) is None
+
+
+def test_uniform_on_dense_table(db_filename):
+    fill(db_filename, 50)
+    counts = draw(db_filename, 20_000)
+    assert set(counts) == {f'sticker{number}' for number in range(50)}
+    assert chi_square(counts, 20_000 / 50) < chi_square_limit(49)
+
+
+def test_uniform_with_deleted_gaps(db_filename):
+    fill(db_filename, 90)
+    # Every third sticker is deleted, the pick must stay uniform among the rest
+    delete(db_filename, [f'sticker{number}' for number in range(0, 90, 3)])
+    counts = draw(db_filename, 20_000)
+    assert set(counts) == {f'sticker{number}' for number in range(90) if number % 3}
+    assert chi_square(counts, 20_000 / 60) < chi_square_limit(59)
+
+
+def test_large_gap_returns_only_existing_stickers(db_filename):
+    fill(db_filename, 100)
+    # Most of the rowid range is empty, so some picks fall back to the next existing row
+    delete(db_filename, [f'sticker{number}' for number in range(5, 95)])
+    counts = draw(db_filename, 5_000)
+    remaining = {f'sticker{number}' for number in (*range(5), *range(95, 100))}
+    assert set(counts) == remaining
+    # Fallback favours the row after the gap, but every sticker keeps a fair share
+    assert min(counts.values()) > 5_000 / len(remaining) / 2
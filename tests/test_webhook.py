@@ -0,0 +1,77 @@
+"""Webhook mode runs updates and scheduled jobs on the same event loop."""
+
+import asyncio, os, signal, socket, threading, time
+
+from aiogram import Bot, Dispatcher, types
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+
+import webhook
+from tools.post_updates import make_text_update, post_updates
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'Port {port} is not open')
+
+
+def test_interval_job_runs_while_updates_are_posted():
+    # The scheduler is started before the server, as bot.py does
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    dispatcher = Dispatcher(Bot(token='123456:TEST'))
+    handled, job_runs = [], []
+
+    @dispatcher.message_handler()
+    async def handle(message: types.Message):
+        handled.append(message.message_id)
+
+    async def job():
+        job_runs.append(time.monotonic())
+
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(func=job, trigger=IntervalTrigger(seconds=0.1))
+    scheduler.start()
+
+    async def nothing(_):
+        pass
+
+    async def stop_scheduler(_):
+        # The loop is closed, when the server stops
+        scheduler.shutdown(wait=False)
+
+    port = free_port()
+    statuses = []
+
+    def post_and_stop():
+        try:
+            wait_for_port(port)
+            updates = [make_text_update(update_id, user_id=1) for update_id in range(1, 6)]
+            statuses.extend(asyncio.run(post_updates(f'http://127.0.0.1:{port}{webhook.webhook_path}', updates)))
+            time.sleep(0.5)
+        finally:
+            os.kill(os.getpid(), signal.SIGINT)
+
+    poster = threading.Thread(target=post_and_stop)
+    poster.start()
+    try:
+        webhook.start_webhook(dispatcher=dispatcher, on_startup=nothing, on_shutdown=stop_scheduler,
+                              set_webhook_on_startup=False, host='127.0.0.1', port=port)
+    finally:
+        poster.join()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    assert statuses == [200] * 5
+    assert sorted(handled) == [1, 2, 3, 4, 5]
+    assert len(job_runs) >= 3
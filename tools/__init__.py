@@ -0,0 +1 @@
+"""Development tools to run the bot without Telegram. Run from the project root, f.e. `python -m tools.post_updates`"""
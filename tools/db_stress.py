@@ -0,0 +1,162 @@
+"""Stress test of several worker processes sharing one db file.
+
+Every process does the same mix of operations as a bot worker: buffered stats with periodic flushes
+and flushes by the buffer itself, when it is full, saving of overlapping sticker sets, known sets checks,
+index refreshes and reply selection. All the db calls go through connection.retry_locked, like in async_db.run,
+stats recording too, as it may flush.
+In the end the counters in the db are compared with the numbers of operations the processes did,
+and the aggregates with their full recomputation.
+
+Usage:
+    python -m tools.db_stress --processes 8 --ops 2000
+    python -m tools.db_stress --processes 16 --busy-timeout 0.05   # make lock contention visible
+"""
+
+import argparse, json, multiprocessing, os, random, tempfile, time
+from types import SimpleNamespace
+
+
+# Emoji of the stickers in generated sets
+SET_EMOJI = '😀😂🐱🐶👍❤️🔥🎉😢😡'
+
+
+def make_set(set_number: int) -> list[SimpleNamespace]:
+    """Same stickers for the same set number in every process."""
+    return [SimpleNamespace(file_id=f'set{set_number}_{position}', emoji=emoji, set_name=f'set{set_number}')
+            for position, emoji in enumerate(SET_EMOJI)]
+
+
+def worker(number: int, db_filename: str, ops: int, users: int, sets: int, flush_every: int, flush_threshold: int,
+           start: multiprocessing.Barrier, results: multiprocessing.Queue) -> None:
+    """Runs operations in one process and puts the numbers of done operations to results."""
+    import metrics
+    from db_operations import connection, sets_cache, stats_buffer, sticker_index, stickers_db
+
+    rng = random.Random(number)
+    done = {'stickers': 0, 'commands': 0, 'other': 0, 'sets_added': 0, 'replies': 0, 'errors': 0}
+    call = connection.retry_locked
+    stats_buffer.flush_threshold = flush_threshold
+    call(sticker_index.load, db_filename=db_filename)
+    call(sets_cache.load_known_sets, db_filename=db_filename)
+
+    start.wait()
+    started = time.perf_counter()
+    for op in range(ops):
+        try:
+            user_id = rng.randint(1, users)
+            choice = rng.random()
+            if choice < 0.6:
+                call(stats_buffer.add_sticker_send, user_id)
+                done['stickers'] += 1
+                setname = f'set{rng.randrange(sets)}'
+                if not sets_cache.is_fresh(setname):
+                    call(stickers_db.add_set, *make_set(int(setname[3:])), db_filename=db_filename)
+                    call(sets_cache.mark_checked, setname, db_filename=db_filename)
+                    done['sets_added'] += 1
+                sticker = SimpleNamespace(file_id='incoming', emoji=rng.choice(SET_EMOJI), set_name=setname)
+                if call(stickers_db.select_reply, sticker, db_filename=db_filename) is not None:
+                    done['replies'] += 1
+            elif choice < 0.8:
+                call(stats_buffer.add_command_use, user_id)
+                done['commands'] += 1
+            else:
+                call(stats_buffer.add_other_message, user_id)
+                done['other'] += 1
+
+            if op % flush_every == flush_every - 1:
+                call(stats_buffer.flush, db_filename=db_filename)
+                call(sticker_index.refresh, db_filename=db_filename)
+                call(sets_cache.refresh, db_filename=db_filename)
+        except Exception as error:
+            done['errors'] += 1
+            print(f'Process {number}: {type(error).__name__}: {error}')
+    call(stats_buffer.flush, db_filename=db_filename)
+
+    done['seconds'] = time.perf_counter() - started
+    done['lock_retries'] = sum(metrics.db_lock_retries._values.values())
+    connection.close_connections()
+    results.put(done)
+
+
+def check_db(db_filename: str, totals: dict[str, int]) -> dict[str, bool]:
+    """Compares the db counters with the operations done."""
+    from db_operations import aggregates, connection
+    from db_operations.tablenames import daily_statistics_tablename, stickers_tablename, users_statistics_tablename
+
+    db_connection = connection.get_connection(db_filename)
+    users_sums = db_connection.execute(f'''SELECT SUM(stickers_send_to), SUM(commands_use), SUM(other_messages)
+                                       FROM {users_statistics_tablename};''').fetchone()
+    daily_sums = db_connection.execute(f'''SELECT SUM(stickers_send), SUM(commands_use), SUM(other_messages)
+                                       FROM {daily_statistics_tablename};''').fetchone()
+    expected = (totals['stickers'], totals['commands'], totals['other'])
+    saved_sets = db_connection.execute(f'SELECT COUNT(DISTINCT setname) FROM {stickers_tablename};').fetchone()[0]
+    saved_stickers = db_connection.execute(f'SELECT COUNT(*) FROM {stickers_tablename};').fetchone()[0]
+    return {
+        'users_counters': tuple(users_sums) == expected,
+        'daily_counters': tuple(daily_sums) == expected,
+        'stickers_not_duplicated': saved_stickers == saved_sets * len(SET_EMOJI),
+        'aggregates': aggregates.get_stats(db_filename=db_filename) == aggregates.compute_stats(db_filename=db_filename),
+        'no_errors': totals['errors'] == 0,
+    }
+
+
+def stress(processes: int, ops: int, users: int, sets: int, flush_every: int, flush_threshold: int) -> dict:
+    """Runs the processes against a new db and checks the result."""
+    from db_operations import connection, migrations
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_filename = os.path.join(tmp_dir, 'stress.db')
+        migrations.migrate(db_filename=db_filename)
+
+        # Buffer flushes itself to the default db, processes read it on import
+        os.environ['DB_NAME'] = db_filename
+        context = multiprocessing.get_context('spawn')
+        start = context.Barrier(processes)
+        results = context.Queue()
+        started = time.perf_counter()
+        workers = [context.Process(target=worker, args=(number, db_filename, ops, users, sets, flush_every, flush_threshold,
+                                                              start, results))
+                   for number in range(processes)]
+        for process in workers:
+            process.start()
+        done = [results.get() for _ in workers]
+        for process in workers:
+            process.join()
+        duration = time.perf_counter() - started
+
+        totals = {key: sum(result[key] for result in done) for key in done[0] if key != 'seconds'}
+        checks = check_db(db_filename, totals)
+        connection.close_connections()
+
+    return {
+        'processes': processes,
+        'ops_per_process': ops,
+        'ops_per_second': processes * ops / duration,
+        'totals': totals,
+        'checks': checks,
+        'passed': all(checks.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=1000, help='operations of each process')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sets', type=int, default=50, help='number of different sets, shared by processes')
+    parser.add_argument('--flush-every', type=int, default=50, help='operations between stats flushes')
+    parser.add_argument('--flush-threshold', type=int, default=20, help='pending updates, which make the buffer flush itself')
+    parser.add_argument('--busy-timeout', type=float, help='DB_BUSY_TIMEOUT of the processes, seconds')
+    args = parser.parse_args()
+
+    if args.busy_timeout is not None:
+        # Processes read it on import
+        os.environ['DB_BUSY_TIMEOUT'] = str(args.busy_timeout)
+    report = stress(args.processes, ops=args.ops, users=args.users, sets=args.sets, flush_every=args.flush_every,
+                    flush_threshold=args.flush_threshold)
+    print(json.dumps(report, indent=2))
+    raise SystemExit(0 if report['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Local stub of Telegram Bot API for running the bot without network.
+
+Answers getUpdates from a queue of fake updates, getStickerSet with synthetic sets,
+and records sendMessage, sendSticker and sendDocument calls. Every method can answer with a delay.
+Point the bot to it with BOT_API_SERVER=http://<host>:<port>.
+"""
+
+import asyncio, json, time
+from collections import deque
+from typing import Callable
+
+from aiohttp import web
+
+
+# Emoji of the stickers in synthetic sets
+SET_EMOJI = '😀😂🐱🐶👍❤️🔥🎉😢😡'
+
+
+def make_sticker(file_id: str, emoji: str, set_name: str) -> dict:
+    return {'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512,
+            'is_animated': False, 'is_video': False, 'emoji': emoji, 'set_name': set_name}
+
+
+def make_sticker_set(name: str) -> dict:
+    stickers = [make_sticker(f'{name}_{emoji}', emoji, name) for emoji in SET_EMOJI]
+    return {'name': name, 'title': name, 'is_animated': False, 'is_video': False,
+            'contains_masks': False, 'stickers': stickers}
+
+
+class FakeBotAPI:
+    """Bot API stub.
+
+    Args:
+        latency (dict[str, float], optional): method name -> seconds to wait before the answer.
+        on_send (Callable[[str, int, float], None], optional): called with method name, chat id
+            and time of every send request.
+    """
+
+    # Methods, which are recorded as sent messages
+    send_methods = ('sendMessage', 'sendSticker', 'sendDocument')
+
+    def __init__(self, latency: dict[str, float] | None = None, on_send: Callable[[str, int, float], None] | None = None):
+        self.latency = latency or {}
+        self.on_send = on_send
+        self.updates: deque[dict] = deque()
+        self.new_updates = asyncio.Event()
+        self.calls: dict[str, int] = {}
+        self.sent: list[tuple[str, int, float]] = []
+        self._message_id = 0
+
+    def add_update(self, update: dict) -> None:
+        """Makes the update available to getUpdates."""
+        self.updates.append(update)
+        self.new_updates.set()
+
+    async def get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        # Updates before offset are confirmed by the bot
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)[:limit]
+
+    def sent_message(self, method: str, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        sent_at = time.perf_counter()
+        self.sent.append((method, chat_id, sent_at))
+        if self.on_send is not None:
+            self.on_send(method, chat_id, sent_at)
+
+        self._message_id += 1
+        message = {'message_id': self._message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendMessage':
+            message['text'] = params.get('text', '')
+        elif method == 'sendSticker':
+            message['sticker'] = make_sticker(str(params.get('sticker')), '😀', 'unknown')
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        delay = self.latency.get(method, 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if method == 'getUpdates':
+            result = await self.get_updates(params)
+        elif method == 'getStickerSet':
+            result = make_sticker_set(params['name'])
+        elif method in self.send_methods:
+            result = self.sent_message(method, params)
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        elif method == 'getWebhookInfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': len(self.updates)}
+        else:  # deleteWebhook, setWebhook and others
+            result = True
+        return web.json_response({'ok': True, 'result': result}, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Starts the server in the running loop.
+
+        Returns:
+            str: base URL of the server for BOT_API_SERVER.
+        """
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}'
+
+    async def stop(self) -> None:
+        # Pending long polls are released, so that server stops at once
+        self.new_updates.set()
+        await self._runner.cleanup()
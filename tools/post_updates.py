@@ -0,0 +1,114 @@
+"""Posts fake updates to the bot running in webhook mode, the way Telegram does.
+
+Usage: `python -m tools.post_updates --url http://127.0.0.1:8080/webhook --secret <WEBHOOK_SECRET> --count 10`
+"""
+
+import argparse, asyncio, itertools, random, time
+
+import aiohttp
+
+from webhook import SECRET_HEADER
+
+
+def make_user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'language_code': 'en'}
+
+
+def make_message(update_id: int, user_id: int, **content) -> dict:
+    """Creates an update with a private message from the user.
+
+    Args:
+        update_id (int): update ID.
+        user_id (int): user ID, which is also chat ID.
+        **content: message content, f.e. text='hi'.
+
+    Returns:
+        dict: update as Telegram sends it.
+    """
+    message = {'message_id': update_id, 'date': int(time.time()),
+               'chat': {'id': user_id, 'type': 'private'}, 'from': make_user(user_id), **content}
+    return {'update_id': update_id, 'message': message}
+
+
+def make_sticker_update(update_id: int, user_id: int, emoji: str = '😀', set_name: str = 'FakeSet') -> dict:
+    sticker = {'file_id': f'{set_name}_{emoji}', 'file_unique_id': f'{set_name}_{emoji}', 'width': 512, 'height': 512,
+               'is_animated': False, 'is_video': False, 'emoji': emoji, 'set_name': set_name}
+    return make_message(update_id, user_id, sticker=sticker)
+
+
+def make_command_update(update_id: int, user_id: int, command: str = '/help') -> dict:
+    return make_message(update_id, user_id, text=command,
+                        entities=[{'type': 'bot_command', 'offset': 0, 'length': len(command)}])
+
+
+def make_text_update(update_id: int, user_id: int, text: str = 'Hello') -> dict:
+    return make_message(update_id, user_id, text=text)
+
+
+def make_updates(count: int, users: int = 10, seed: int = 0) -> list[dict]:
+    """Creates a mix of sticker, command and text updates.
+
+    Args:
+        count (int): number of updates.
+        users (int, optional): number of different users. Defaults to 10.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        list[dict]: updates.
+    """
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = rng.randint(1, users)
+        kind = rng.choices(['sticker', 'command', 'text'], weights=[8, 1, 1])[0]
+        if kind == 'sticker':
+            updates.append(make_sticker_update(update_id, user_id, emoji=rng.choice('😀😂🐱🐶👍'),
+                                               set_name=f'FakeSet{rng.randint(1, 5)}'))
+        elif kind == 'command':
+            updates.append(make_command_update(update_id, user_id, command=rng.choice(['/start', '/help', '/stats'])))
+        else:
+            updates.append(make_text_update(update_id, user_id))
+    return updates
+
+
+async def post_updates(url: str, updates: list[dict], secret: str = '', rate: float = 0) -> list[int]:
+    """Posts updates to webhook endpoint.
+
+    Args:
+        url (str): webhook URL.
+        updates (list[dict]): updates to post.
+        secret (str, optional): secret token. Defaults to ''.
+        rate (float, optional): updates per second, 0 to post as fast as possible. Defaults to 0.
+
+    Returns:
+        list[int]: response statuses.
+    """
+    headers = {SECRET_HEADER: secret} if secret else {}
+    statuses = []
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        for number, update in zip(itertools.count(), updates):
+            if rate:
+                await asyncio.sleep(max(0, started + number / rate - time.perf_counter()))
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses.append(response.status)
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 for no limit')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    updates = make_updates(args.count, users=args.users, seed=args.seed)
+    statuses = asyncio.run(post_updates(args.url, updates, secret=args.secret, rate=args.rate))
+    print({status: statuses.count(status) for status in set(statuses)})
+
+
+if __name__ == '__main__':
+    main()
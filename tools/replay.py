@@ -0,0 +1,148 @@
+"""Load test of the whole bot without Telegram.
+
+Starts the real dispatcher from bot.py in polling mode against the local fake Bot API,
+replays a stream of updates at a target rate and reports handler latency
+(from the moment update is available to getUpdates to the reply) and throughput.
+The bot works with a temporary db.
+
+Usage:
+    python -m tools.replay --count 2000 --rate 200 --latency getStickerSet=0.2 sendSticker=0.02
+    python -m tools.replay --updates recorded_updates.jsonl --rate 50
+"""
+
+import argparse, asyncio, json, os, tempfile, time
+from collections import deque
+
+from tools.fake_bot_api import FakeBotAPI
+from tools.post_updates import make_updates
+
+
+def percentile(values: list[float], share: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def read_updates(filepath: os.PathLike) -> list[dict]:
+    """Reads updates, one JSON per line. Update IDs are renumbered, so that they grow."""
+    with open(filepath) as updates_file:
+        updates = [json.loads(line) for line in updates_file if line.strip()]
+    for update_id, update in enumerate(updates, start=1):
+        update['update_id'] = update_id
+    return updates
+
+
+def reply_method(update: dict) -> str:
+    """Bot API method of the last reply to the update: sticker to sticker, message to the rest."""
+    return 'sendSticker' if 'sticker' in update['message'] else 'sendMessage'
+
+
+async def replay(updates: list[dict], rate: float, latency: dict[str, float], relax: float = 0.1,
+                 drain_timeout: float = 30) -> dict:
+    """Replays updates through the bot.
+
+    Args:
+        updates (list[dict]): updates to send.
+        rate (float): updates per second.
+        latency (dict[str, float]): Bot API method -> seconds of fake API delay.
+        relax (float, optional): pause between getUpdates calls, as in polling. Defaults to 0.1.
+        drain_timeout (float, optional): seconds to wait for replies after the last update. Defaults to 30.
+
+    Returns:
+        dict: report.
+    """
+    # Chat id -> (expected reply method, time update was available) of updates without reply yet
+    pending: dict[int, deque[tuple[str, float]]] = {}
+    latencies, completed_at = [], []
+    all_replied = asyncio.Event()
+
+    def on_send(method: str, chat_id: int, sent_at: float):
+        chat_updates = pending.get(chat_id)
+        # Replies within a chat are ordered, so the reply belongs to the oldest update
+        if chat_updates and chat_updates[0][0] == method:
+            _, available_at = chat_updates.popleft()
+            latencies.append(sent_at - available_at)
+            completed_at.append(sent_at)
+            if len(latencies) == len(updates):
+                all_replied.set()
+
+    api = FakeBotAPI(latency=latency, on_send=on_send)
+    api_url = await api.start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Bot and db modules read these on import
+        os.environ['DEMO_TOKEN'] = '123456789:FAKE_TOKEN_FOR_LOCAL_REPLAY_ONLY_000'
+        os.environ['BOT_API_SERVER'] = api_url
+        os.environ['DB_NAME'] = os.path.join(tmp_dir, 'replay.db')
+        import bot as bot_module
+
+        dispatcher = bot_module.dp
+        await bot_module.startup(dispatcher)
+        polling = asyncio.create_task(dispatcher.start_polling(relax=relax))
+
+        started = time.perf_counter()
+        for number, update in enumerate(updates):
+            await asyncio.sleep(max(0, started + number / rate - time.perf_counter()))
+            chat_id = update['message']['chat']['id']
+            pending.setdefault(chat_id, deque()).append((reply_method(update), time.perf_counter()))
+            api.add_update(update)
+        sending_time = time.perf_counter() - started
+
+        try:
+            await asyncio.wait_for(all_replied.wait(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        dispatcher.stop_polling()
+        await asyncio.wait_for(polling, timeout=drain_timeout)
+        await bot_module.shutdown(dispatcher)
+        await (await bot_module.bot.get_session()).close()
+    await api.stop()
+
+    latencies.sort()
+    duration = (max(completed_at) - started) if completed_at else sending_time
+    return {
+        'updates': len(updates),
+        'replied': len(latencies),
+        'lost': len(updates) - len(latencies),
+        'target_rate': rate,
+        'actual_rate': len(updates) / sending_time if sending_time else None,
+        'throughput': len(latencies) / duration if duration else None,
+        'latency_ms': {name: percentile(latencies, share) * 1000
+                       for name, share in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1))},
+        'api_calls': api.calls,
+        'fake_api_latency': latency,
+    }
+
+
+def parse_latency(values: list[str]) -> dict[str, float]:
+    """Parses method=seconds pairs."""
+    latency = {}
+    for value in values:
+        method, seconds = value.split('=')
+        latency[method] = float(seconds)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', help='JSON lines file with recorded updates, synthetic ones if not set')
+    parser.add_argument('--count', type=int, default=1000, help='number of synthetic updates')
+    parser.add_argument('--users', type=int, default=100, help='number of synthetic users')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=100, help='updates per second')
+    parser.add_argument('--latency', nargs='*', default=[], metavar='METHOD=SECONDS',
+                        help='fake API delay, f.e. getStickerSet=0.2')
+    parser.add_argument('--relax', type=float, default=0.1, help='pause between getUpdates calls')
+    parser.add_argument('--drain-timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    updates = read_updates(args.updates) if args.updates else make_updates(args.count, users=args.users, seed=args.seed)
+    report = asyncio.run(replay(updates, rate=args.rate, latency=parse_latency(args.latency),
+                                relax=args.relax, drain_timeout=args.drain_timeout))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Webhook mode: Telegram posts updates to the bot HTTP endpoint instead of long polling.
+
+Endpoint answers at once and the update is processed in background by the same dispatcher,
+so slow handlers don't hold Telegram connections.
+"""
+
+import asyncio, os, secrets
+from typing import Awaitable, Callable
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from logs.log import activity_logger
+
+
+# Public HTTPS address of the bot, f.e. https://example.com. Telegram posts updates to webhook_host + webhook_path
+webhook_host = os.environ.get('WEBHOOK_HOST', default='')
+webhook_path = os.environ.get('WEBHOOK_PATH', default='/webhook')
+# Local address to listen to
+webapp_host = os.environ.get('WEBAPP_HOST', default='127.0.0.1')
+webapp_port = int(os.environ.get('WEBAPP_PORT', default=8080))
+# Telegram sends it in every request, so that nobody else can post updates. Required with WEBHOOK_HOST
+webhook_secret = os.environ.get('WEBHOOK_SECRET', default='')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Seconds to wait for updates being processed on shutdown
+shutdown_timeout = 10
+
+
+async def process_update(dispatcher: Dispatcher, update: types.Update) -> None:
+    """Processes update with dispatcher handlers, logging the errors.
+
+    Args:
+        dispatcher (Dispatcher): dispatcher with handlers.
+        update (types.Update): update to process.
+    """
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    try:
+        await dispatcher.process_update(update)
+    except Exception:
+        activity_logger.exception(f'Update {update.update_id} processing failed')
+
+
+async def receive_update(request: web.Request) -> web.Response:
+    """Webhook endpoint. Checks secret token, schedules update processing and answers at once."""
+    secret = request.app['secret']
+    if secret and not secrets.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+        activity_logger.warning('Webhook request with wrong secret token rejected')
+        return web.Response(status=401)
+
+    try:
+        update = types.Update(**await request.json())
+    except (ValueError, TypeError):
+        return web.Response(status=400)
+
+    task = asyncio.create_task(process_update(request.app['dispatcher'], update))
+    # Keep the reference until the task is done, otherwise it can be garbage collected
+    tasks = request.app['tasks']
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return web.Response()
+
+
+def create_app(dispatcher: Dispatcher, secret: str = webhook_secret, path: str = webhook_path) -> web.Application:
+    """Creates aiohttp application with webhook endpoint.
+
+    Args:
+        dispatcher (Dispatcher): dispatcher to pass updates to.
+        secret (str, optional): expected secret token, empty to accept any request,
+            which is allowed only for local endpoint (see check_secret). Defaults to webhook_secret.
+        path (str, optional): endpoint path. Defaults to webhook_path.
+
+    Returns:
+        web.Application: application to run.
+    """
+    app = web.Application()
+    app['dispatcher'] = dispatcher
+    app['secret'] = secret
+    app['tasks'] = set()
+    app.router.add_post(path, receive_update)
+    return app
+
+
+async def wait_for_updates(app: web.Application, timeout: float = shutdown_timeout) -> None:
+    """Waits for the updates, which are being processed.
+
+    Args:
+        app (web.Application): webhook application.
+        timeout (float, optional): seconds to wait. Defaults to shutdown_timeout.
+    """
+    tasks = app['tasks']
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+
+async def set_webhook(bot: Bot, url: str, secret: str = webhook_secret) -> None:
+    """Tells Telegram where to post updates.
+    Request is sent directly, as secret_token is not supported by aiogram set_webhook.
+
+    Args:
+        bot (Bot): bot to set webhook for.
+        url (str): full public URL of webhook endpoint.
+        secret (str, optional): secret token. Defaults to webhook_secret.
+    """
+    payload = {'url': url, 'drop_pending_updates': True}
+    if secret:
+        payload['secret_token'] = secret
+    await bot.request('setWebhook', payload)
+    activity_logger.info(f'Webhook is set to {url}')
+
+
+def check_secret(host: str = webhook_host, secret: str = webhook_secret) -> None:
+    """Refuses to run public webhook without secret token, as anybody, who finds the URL, could post updates.
+
+    Raises:
+        SystemExit: if host is set, but secret is empty.
+    """
+    if host and not secret:
+        activity_logger.error('WEBHOOK_SECRET must be set, when WEBHOOK_HOST is set')
+        raise SystemExit('WEBHOOK_SECRET must be set, when WEBHOOK_HOST is set: '
+                         'without it anybody could post updates to the webhook')
+
+
+def start_webhook(dispatcher: Dispatcher, on_startup: Callable[[Dispatcher], Awaitable],
+                  on_shutdown: Callable[[Dispatcher], Awaitable], set_webhook_on_startup: bool = True,
+                  host: str = webapp_host, port: int = webapp_port, reuse_port: bool = False) -> None:
+    """Runs webhook server on the current event loop until interrupted. Works like executor.start_polling.
+
+    Args:
+        dispatcher (Dispatcher): dispatcher with handlers.
+        on_startup (Callable[[Dispatcher], Awaitable]): called when server starts.
+        on_shutdown (Callable[[Dispatcher], Awaitable]): called when server stops.
+        set_webhook_on_startup (bool, optional): register webhook in Telegram. Defaults to True.
+        host (str, optional): address to listen to. Defaults to webapp_host.
+        port (int, optional): port to listen to. Defaults to webapp_port.
+        reuse_port (bool, optional): share the port with other worker processes. Defaults to False.
+
+    Raises:
+        SystemExit: if public webhook has no secret token.
+    """
+    check_secret()
+    app = create_app(dispatcher)
+
+    async def startup(app: web.Application):
+        await on_startup(dispatcher)
+        # Without public address webhook is not registered, f.e. when updates are posted locally
+        if set_webhook_on_startup and webhook_host:
+            await set_webhook(dispatcher.bot, url=webhook_host + webhook_path)
+
+    async def shutdown(app: web.Application):
+        await wait_for_updates(app)
+        await on_shutdown(dispatcher)
+        session = await dispatcher.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    # Without the loop run_app creates a new one, and the scheduler, started on the current loop, never runs
+    web.run_app(app, host=host, port=port, print=None, reuse_port=reuse_port or None, loop=asyncio.get_event_loop())
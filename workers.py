@@ -0,0 +1,129 @@
+"""Running the bot in several worker processes.
+
+Workers are separate processes, which receive webhook updates on the same port
+(the kernel spreads connections between them) and share one SQLite db in WAL mode.
+Scheduled jobs, which must run once per deployment, are run only by the process
+holding the scheduler lock. The lock is released by the OS, when its holder exits,
+so another worker takes over.
+
+Per-chat order of updates is kept by chat_dispatch only within a worker: connections
+are not routed by chat, so updates of one chat may be handled by different workers
+at the same time and answered out of order. Db writes, which may race between workers,
+are single statements, f.e. users_db.add_user_on_start() inserts or leaves the user.
+Log files are shared too, so they are only appended to and not rotated (see logs.log).
+"""
+
+import multiprocessing, os, signal, time
+from typing import Callable
+
+from logs.log import activity_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, there is one process anyway
+    fcntl = None
+
+
+# Number of worker processes, more than one requires webhook mode
+bot_workers = int(os.environ.get('BOT_WORKERS', default=1))
+# Index of the current worker, is set for each started worker
+worker_index = int(os.environ.get('BOT_WORKER', default=0))
+# Seconds before restart of a worker, which exited unexpectedly
+restart_delay = 5
+
+
+class SchedulerLock:
+    """Exclusive non-blocking lock on a file, which elects the process to run scheduled jobs.
+
+    Args:
+        filepath (os.PathLike): path to lock file.
+    """
+
+    def __init__(self, filepath: os.PathLike):
+        self.filepath = os.fspath(filepath)
+        self._file = None
+
+    @property
+    def acquired(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        """Takes the lock, if no other process holds it.
+
+        Returns:
+            bool: True, if the lock is held by this process.
+        """
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            self._file = True
+            return True
+        lock_file = open(self.filepath, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        activity_logger.info(f'Worker {worker_index} (pid {os.getpid()}) runs scheduled jobs')
+        return True
+
+    def release(self) -> None:
+        if self._file is not None and fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        self._file = None
+
+
+def detach() -> None:
+    """Moves the worker to its own process group, so that signals sent to the whole group
+    (Ctrl+C in terminal) reach the workers only once, when the main process passes them.
+    A second signal would interrupt graceful shutdown of the worker."""
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+
+
+def run(target: Callable[[], None], workers: int = bot_workers) -> None:
+    """Runs target in the worker processes and restarts the ones, which exit unexpectedly,
+    until SIGINT or SIGTERM, which is passed to the workers.
+
+    Target is run in fresh interpreters (spawn), so that every worker has its own
+    threads, loops and connections. It must be importable, f.e. a function of bot module.
+
+    Args:
+        target (Callable[[], None]): function, which runs a single worker.
+        workers (int, optional): number of workers. Defaults to bot_workers.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def start_worker(index: int) -> None:
+        # Environment is copied to the worker on start
+        os.environ['BOT_WORKER'] = str(index)
+        process = processes[index] = context.Process(target=target, name=f'worker-{index}')
+        process.start()
+        activity_logger.info(f'Worker {index} started, pid {process.pid}')
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        start_worker(index)
+
+    while not stopping:
+        for index, process in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                activity_logger.warning(f'Worker {index} exited with code {process.exitcode}, restarting')
+                time.sleep(restart_delay)
+                start_worker(index)
+        time.sleep(1)
+    for process in processes.values():
+        process.join()
+    activity_logger.info('All workers stopped')